@@ -1,41 +1,33 @@
 import gradio as gr
 import json
-from PIL import Image
 
 # Placeholder imports for your pipeline
-from src.char_detection import PersonCropper
-from src.vlm_blip3 import CharacterAttributeExtractor
+from src.model_registry import get_batched_extractor, get_cropper, get_result_cache, registry
+
+result_cache = get_result_cache()
 
 def pipeline(image):
     if not image:
         return None, "No image provided."
 
-    input_path = "temp_input.jpg"
-    image.save(input_path)
-
     # 1) Crop persons
-    cropper = PersonCropper()
-    cropped_paths = cropper.crop_persons(input_path, "cropped_persons")
+    # Shared models: loaded once per process (on first use, or at launch by the warm-up)
+    cropper = get_cropper()
+    crops = cropper.detect_crops(image)
 
-    if not cropped_paths:
+    if not crops:
         return None, "No valid characters detected."
 
     # 2) Extract attributes
-    extractor = CharacterAttributeExtractor(
-        model_name="blip2_t5",
-        model_type="pretrain_flant5xl"
-    )
-
-    cropped_images = []
-    results = {}
-    for path in cropped_paths:
-        # Load the cropped image for the gallery
-        cropped_img = Image.open(path).convert("RGB")
-        cropped_images.append(cropped_img)
-
-        # Run attribute extraction
-        attributes = extractor.extract_attributes(path)
-        results[path] = attributes
+    # Crops of concurrent requests share VLM batches (waiting at most 20 ms for each other)
+    extractor = get_batched_extractor("blip2_t5", "pretrain_flant5xl", max_wait_ms=20, result_cache=result_cache)
+
+    # Cropped images for the gallery (already in memory)
+    cropped_images = [crop.to_pil() for crop in crops]
+
+    # Run attribute extraction for all crops in one batched pass
+    attributes = extractor.extract_attributes_batch(cropped_images)
+    results = {crop.key: attrs for crop, attrs in zip(crops, attributes)}
 
     # Return a list of PIL images + JSON string
     return cropped_images, json.dumps(results, indent=4)
@@ -57,4 +49,10 @@ with gr.Blocks() as demo:
     run_button.click(fn=pipeline, inputs=img_in, outputs=[gallery_out, json_out])
 
 if __name__ == "__main__":
+    # Load and warm up the models before accepting requests (no first-request spike)
+    get_cropper()
+    get_batched_extractor("blip2_t5", "pretrain_flant5xl", max_wait_ms=20, result_cache=result_cache)
+    registry.warm_up()
+    # Several requests in flight at once, so the batcher has something to merge
+    demo.queue(default_concurrency_limit=8)
     demo.launch()
@@ -1,7 +1,8 @@
 import gradio as gr
 import json
-from src.char_detection import PersonCropper
-from src.vlm_blip3 import CharacterAttributeExtractor
+from src.model_registry import get_batched_extractor, get_cropper, get_result_cache, registry
+
+result_cache = get_result_cache()
 
 def extract_character_attributes_pipeline(image):
     """
@@ -11,29 +12,21 @@ def extract_character_attributes_pipeline(image):
         image (numpy array): Image uploaded via Gradio
     
     Returns:
-        dict: Dictionary mapping cropped character paths to their attributes
+        dict: Dictionary mapping cropped character keys to their attributes
     """
-    # Save input image temporarily
-    input_path = "temp_input.jpg"
-    image.save(input_path)
-    
-    # Step 1: Extract characters from the image
-    cropper = PersonCropper()
-    cropped_characters = cropper.crop_persons(input_path, "cropped_persons")
+    # Step 1: Extract characters from the image (models are shared, loaded once per process)
+    cropper = get_cropper()
+    cropped_characters = cropper.detect_crops(image)
     
     if not cropped_characters:
         return "No valid characters detected."
     
     # Step 2: Extract attributes for each character
-    extractor = CharacterAttributeExtractor(
-        model_name="blip2_t5",
-        model_type="pretrain_flant5xl"
-    )
+    # Crops of concurrent requests share VLM batches (waiting at most 20 ms for each other)
+    extractor = get_batched_extractor("blip2_t5", "pretrain_flant5xl", max_wait_ms=20, result_cache=result_cache)
     
-    results = {}
-    for char_path in cropped_characters:
-        attributes = extractor.extract_attributes(char_path)
-        results[char_path] = attributes
+    attributes = extractor.extract_attributes_batch(cropped_characters)
+    results = {crop.key: attrs for crop, attrs in zip(cropped_characters, attributes)}
     
     return json.dumps(results, indent=4)
 
@@ -48,4 +41,10 @@ iface = gr.Interface(
 
 # Launch the Gradio app
 if __name__ == "__main__":
+    # Load and warm up the models before accepting requests (no first-request spike)
+    get_cropper()
+    get_batched_extractor("blip2_t5", "pretrain_flant5xl", max_wait_ms=20, result_cache=result_cache)
+    registry.warm_up()
+    # Several requests in flight at once, so the batcher has something to merge
+    iface.queue(default_concurrency_limit=8)
     iface.launch()
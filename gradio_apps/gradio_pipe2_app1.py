@@ -1,80 +1,65 @@
 import gradio as gr
 import json
-from PIL import Image
+import os
 import time
 
 # Placeholder imports for your pipeline
-from src.char_detection import PersonCropper
-from src.vlm_blip3 import CharacterAttributeExtractor
-from deepdanbooru_tagger import DanbooruTagger
+from src.model_registry import get_batched_extractor, get_batched_tagger, get_cropper, get_result_cache, registry
+from src.pipeline2 import process_characters_batch
+from src.routing_policy import RoutingPolicy
 
-cropper = PersonCropper()
-tagger = DanbooruTagger()
-extractor = CharacterAttributeExtractor(
-    model_name="blip2_opt",
-    model_type="pretrain_opt2.7b",
-)
+result_cache = get_result_cache()
 
+cropper = get_cropper()
+# Crops of concurrent requests share forward passes (waiting at most 20 ms for each other)
+tagger = get_batched_tagger(max_wait_ms=20, result_cache=result_cache)
+extractor = get_batched_extractor("blip2_opt", "pretrain_opt2.7b", max_wait_ms=20, result_cache=result_cache)
 
-def process_character_attributes(char_path, tagger, extractor, threshold=0.4):
+# Per-attribute thresholds deciding tagger-only vs VLM (see utils/calibrate_routing_policy.py)
+if os.path.exists("routing_policy.json"):
+    routing_policy = RoutingPolicy.load("routing_policy.json")
+else:
+    routing_policy = RoutingPolicy()
+
+
+def process_characters(crops, tagger, extractor, threshold=0.4):
     """
-    Process character attributes using DanbooruTagger and CharacterAttributeExtractor.
+    Process the attributes of all characters of an image using DanbooruTagger and
+    CharacterAttributeExtractor: one tagger batch, and one batched VLM call for the
+    attributes the tagger is not confident about.
     
     Args:
-        char_path (str): Path to the cropped character image.
+        crops (List[PersonCrop]): In-memory crops of the image.
         tagger (DanbooruTagger): Instance of DanbooruTagger for predicting tags.
         extractor (CharacterAttributeExtractor): Instance of CharacterAttributeExtractor.
         threshold (float): Score threshold for filtering tags.
         
     Returns:
-        dict: Extracted character attributes.
+        List[dict]: Extracted character attributes, one dict per crop.
     """
     start_time = time.time()
-    danbooru_output = tagger.predict_all(char_path, threshold=threshold)
-    formatted_string = ", ".join(
-        [f"{category}: {', '.join(tag['tag'] for tag in tags)}" 
-         for category, tags in danbooru_output["categorized_tags"].items()]
-    )
-    low_score_keys = [
-        key for key, value in danbooru_output["best_candidates"].items() 
-        if value["score"] < threshold
-    ]
-    low_score_keys.append("Ethnicity") # As this is not being estimated by DanbooruTagger
-    danbooru_attributes = {key: ", ".join(item["tag"] for item in value) for key, value in danbooru_output["categorized_tags"].items()}
-    character_attributes = extractor.extract_attributes(char_path, topics=low_score_keys, context=formatted_string)
-    character_attributes.update(danbooru_attributes)
+    before = routing_policy.vlm_calls
+    attributes = process_characters_batch(crops, tagger, extractor, threshold=threshold, policy=routing_policy)
     end_time = time.time()
-    print(f"Time taken to process character attributes: {end_time - start_time} seconds")
-    return character_attributes
+    print(f"Time taken to process character attributes: {end_time - start_time} seconds "
+          f"({routing_policy.vlm_calls - before} VLM questions for {len(crops)} characters)")
+    return attributes
 
 
 def pipeline(image):
     if not image:
         return None, "No image provided."
 
-    input_path = "temp_input.jpg"
-    image.save(input_path)
-
     # 1) Crop persons
-    cropped_paths = cropper.crop_persons(input_path, "cropped_persons")
+    crops = cropper.detect_crops(image)
 
-    if not cropped_paths:
+    if not crops:
         return None, "No valid characters detected."
 
-    # 2) Extract attributes
-    cropped_images = []
-    results = {}
-    for path in cropped_paths:
-        # Load the cropped image for the gallery
-        cropped_img = Image.open(path).convert("RGB")
-        cropped_images.append(cropped_img)
-
-        # Run attribute extraction
-        results[path] = process_character_attributes(
-                            path, 
-                            tagger, 
-                            extractor
-        )
+    # 2) Extract attributes of all characters together
+    cropped_images = [crop.to_pil() for crop in crops]  # Cropped images for the gallery (already in memory)
+    attributes = process_characters(crops, tagger, extractor)
+    results = {crop.key: attrs for crop, attrs in zip(crops, attributes)}
 
     # Return a list of PIL images + JSON string
     return cropped_images, json.dumps(results, indent=4)
@@ -96,4 +81,7 @@ with gr.Blocks() as demo:
     run_button.click(fn=pipeline, inputs=img_in, outputs=[gallery_out, json_out])
 
 if __name__ == "__main__":
+    registry.warm_up()
+    # Several requests in flight at once, so the batchers have something to merge
+    demo.queue(default_concurrency_limit=8)
     demo.launch()
@@ -0,0 +1,31 @@
+import re
+from typing import List
+
+# Attribute-based questions asked to the VLM, keyed by attribute name
+ATTRIBUTE_QUESTIONS = {
+    "Art Style": "What is the art style? Choose one: anime, cartoon, semi-realistic, realistic, 3D-rendered.",
+    "Age": "What is the character’s age group? Choose from: child, teen, young adult, middle-aged, elderly.",
+    "Gender": "What is the character’s gender? Choose from: male or female.",
+    "Ethnicity": "What is the character’s ethnicity? Choose from: Asian, African, Caucasian, Hispanic, other.",
+    "Hair Color": "What is the character’s hair color? Choose from: black, blonde, red, blue, green, brown, white, gray.",
+    "Hair Style": "What is the character’s hair style? Choose from: ponytail, curly, straight, bun, braided, short bob.",
+    "Hair Length": "What is the character’s hair length? Choose from: short, medium, long.",
+    "Eye Color": "What is the character’s eye color? Choose from: black, brown, blue, green, gray, hazel, red.",
+    "Body Type": "What is the character’s body type? Choose from: slim, muscular, curvy, average.",
+    "Dress & Clothing": "What is the character’s outfit style? Choose from: casual, formal, traditional, futuristic, uniform.",
+    "Facial Expression": "What is the character’s facial expression? Choose from: neutral, smiling, serious, surprised, sad.",
+    "Accessories & Unique Traits": "Does the character have any unique traits? Choose from: scars, tattoos, glasses, hat, jewelry, none."
+}
+
+
+def parse_options(question: str) -> List[str]:
+    """Allowed answers listed in a question ("... Choose from: a, b or c."), or [] for open questions."""
+    match = re.search(r"Choose (?:one|from):\s*(.+)$", question)
+    if not match:
+        return []
+    options = re.split(r",\s*|\s+or\s+", match.group(1).strip().rstrip("."))
+    return [option.strip() for option in options if option.strip()]
+
+
+# Allowed answers of every attribute question, in question order
+ATTRIBUTE_OPTIONS = {key: parse_options(question) for key, question in ATTRIBUTE_QUESTIONS.items()}
@@ -0,0 +1,413 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Set
+
+from src.instrumentation import metrics
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def iter_inputs(sources: List[str]) -> Iterator[str]:
+    """
+    Streams image paths from a mix of sources, without listing everything up front.
+
+    Each source can be:
+      - a directory (walked recursively, in sorted order)
+      - a text file with one image path per line
+      - a glob pattern (e.g. "data/**/*.jpg")
+      - a single image path
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, filename)
+        elif os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+            with open(source, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        yield line
+        elif glob.has_magic(source):
+            for path in sorted(glob.iglob(source, recursive=True)):
+                if path.lower().endswith(IMAGE_EXTENSIONS):
+                    yield path
+        else:
+            yield source
+
+
+def load_completed(output_path: str, retry_errors: bool = False) -> Set[str]:
+    """
+    Reads the inputs already recorded in a JSONL output, which doubles as the checkpoint.
+
+    Only an unterminated last line (crash mid-write) is truncated away, so appending
+    resumes on a clean record boundary. Complete lines that do not parse are skipped
+    with a warning and left in place; their inputs are processed again.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line_number, raw_line in enumerate(f, 1):
+            if not raw_line.endswith(b"\n"):
+                break  # Only the last line can be unterminated
+            valid_bytes += len(raw_line)
+            try:
+                record = json.loads(raw_line)
+                image_path = record["input"]
+            except (json.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError):
+                print(f"Warning: skipping unreadable record on line {line_number} of {output_path}.")
+                continue
+            if retry_errors and "error" in record:
+                continue
+            completed.add(image_path)
+
+    if valid_bytes < os.path.getsize(output_path):
+        print(f"Warning: truncating partial record at the end of {output_path}.")
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return completed
+
+
+def crops_dir_for(image_path: str, crops_root: str) -> str:
+    """Per-image crop directory, so crops of different images never overwrite each other."""
+    stem = os.path.splitext(os.path.abspath(image_path).lstrip(os.sep))[0]
+    return os.path.join(crops_root, stem)
+
+
+class ThroughputReporter:
+    def __init__(self, report_every: int = 10):
+        """Prints running throughput every `report_every` processed images."""
+        self.report_every = report_every
+        self.start_time = time.time()
+        self.processed = 0
+        self.characters = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def update(self, num_characters: int = 0, error: bool = False):
+        self.processed += 1
+        self.characters += num_characters
+        self.errors += int(error)
+        if self.report_every and self.processed % self.report_every == 0:
+            print(self.summary())
+
+    def summary(self) -> str:
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return (
+            f"processed {self.processed} (skipped {self.skipped}, errors {self.errors}) | "
+            f"{self.processed / elapsed:.2f} images/s | {self.characters / elapsed:.2f} characters/s"
+        )
+
+
+def process_image(
+    pipeline_fn: Callable,
+    image_path: str,
+    crops_root: Optional[str] = None,
+    vlm_counter: Optional[Callable[[], int]] = None,
+) -> dict:
+    """
+    Runs one image through a pipeline function and returns its JSONL record. With
+    `vlm_counter` (a pipeline module's `vlm_calls`), the record also holds the number of
+    questions this image sent to the VLM.
+    """
+    start_time = time.time()
+    try:
+        output_dir = crops_dir_for(image_path, crops_root) if crops_root else None
+        vlm_calls_before = vlm_counter() if vlm_counter else 0
+        with metrics.span("image"):
+            characters = pipeline_fn(image_path, output_dir=output_dir)
+        record = {
+            "input": image_path,
+            "num_characters": len(characters),
+            "characters": characters,
+            "seconds": round(time.time() - start_time, 3),
+        }
+        if vlm_counter:
+            record["vlm_calls"] = vlm_counter() - vlm_calls_before
+        return record
+    except Exception as e:
+        return {"input": image_path, "error": repr(e), "seconds": round(time.time() - start_time, 3)}
+
+
+def process_images(
+    batch_fn: Callable,
+    image_paths: List[str],
+    crops_root: Optional[str] = None,
+    vlm_counter: Optional[Callable[[], int]] = None,
+    pipeline_fn: Optional[Callable] = None,
+) -> List[dict]:
+    """
+    Runs several images through a pipeline's batch entry point (`extract_character_attributes_batch`)
+    and returns their JSONL records. Seconds and VLM calls of the batch are split evenly
+    over its images. If the batch raises, its images are redone one at a time with
+    `pipeline_fn`, so a single bad image only fails its own record.
+    """
+    start_time = time.time()
+    try:
+        output_dirs = [crops_dir_for(path, crops_root) if crops_root else None for path in image_paths]
+        vlm_calls_before = vlm_counter() if vlm_counter else 0
+        with metrics.span("image_batch", size=len(image_paths)):
+            results = batch_fn(image_paths, output_dirs)
+    except Exception as e:
+        if pipeline_fn is None or len(image_paths) == 1:
+            return [{"input": path, "error": repr(e), "seconds": round(time.time() - start_time, 3)} for path in image_paths]
+        return [process_image(pipeline_fn, path, crops_root, vlm_counter=vlm_counter) for path in image_paths]
+
+    seconds = (time.time() - start_time) / len(image_paths)
+    vlm_calls = (vlm_counter() - vlm_calls_before) / len(image_paths) if vlm_counter else None
+    records = []
+    for path, characters in zip(image_paths, results):
+        record = {"input": path, "num_characters": len(characters), "characters": characters, "seconds": round(seconds, 3)}
+        if vlm_counter:
+            record["vlm_calls"] = round(vlm_calls, 2)
+        records.append(record)
+    return records
+
+
+def batched_records(
+    pipeline: str, batch_size: int = 8, crops_root: Optional[str] = None
+) -> Callable[[Iterable[str]], Iterator[dict]]:
+    """
+    Executor for `run_batch(process_records=...)` that runs the pipeline `batch_size`
+    images at a time, so detection and tagging work on whole batches (models of the
+    pipeline module as configured).
+    """
+    module = pipeline_module(pipeline)
+
+    def process_records(paths: Iterable[str]) -> Iterator[dict]:
+        paths = iter(paths)
+        while True:
+            batch = list(itertools.islice(paths, batch_size))
+            if not batch:
+                return
+            yield from process_images(
+                module.extract_character_attributes_batch, batch, crops_root,
+                vlm_counter=module.vlm_calls, pipeline_fn=module.extract_character_attributes_pipeline,
+            )
+
+    return process_records
+
+
+def run_batch(
+    pipeline_fn: Optional[Callable],
+    inputs: Iterable[str],
+    output_path: str,
+    crops_root: Optional[str] = None,
+    report_every: int = 10,
+    fsync_every: int = 100,
+    retry_errors: bool = False,
+    process_records: Optional[Callable[[Iterable[str]], Iterable[dict]]] = None,
+) -> ThroughputReporter:
+    """
+    Streams inputs through a pipeline and appends one JSONL record per image.
+
+    Records are flushed as they are written (and fsynced every `fsync_every` records),
+    so a crash loses at most the images in flight. Inputs already present in the output
+    are skipped, which makes re-running the same command resume the batch, and an input
+    listed twice is only processed once.
+
+    Args:
+        pipeline_fn (Optional[Callable]): `extract_character_attributes_pipeline(image_path, output_dir=...)`.
+        inputs (Iterable[str]): Image paths, e.g. from `iter_inputs`.
+        output_path (str): JSONL file to append to.
+        crops_root (Optional[str]): If given, crops are also saved under one directory per image.
+        report_every (int): Print throughput every N processed images (0 disables).
+        fsync_every (int): fsync the output every N records.
+        retry_errors (bool): Re-process inputs whose previous record is an error.
+        process_records (Optional[Callable]): Alternative executor turning the pending paths into
+            records, in order (e.g. `staged_records(...)`). Defaults to running `pipeline_fn`
+            on one image at a time.
+
+    Returns:
+        ThroughputReporter: Final counters.
+    """
+    completed = load_completed(output_path, retry_errors=retry_errors)
+    reporter = ThroughputReporter(report_every)
+
+    def pending_inputs():
+        for image_path in inputs:
+            if image_path in completed:
+                reporter.skipped += 1
+                continue
+            # Marked when handed out, not when its record is written: executors with images
+            # in flight (parallel, staged) would otherwise run a repeated input twice
+            completed.add(image_path)
+            yield image_path
+
+    if process_records is None:
+        records = (process_image(pipeline_fn, image_path, crops_root) for image_path in pending_inputs())
+    else:
+        records = process_records(pending_inputs())
+
+    with open(output_path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            if fsync_every and (reporter.processed + 1) % fsync_every == 0:
+                os.fsync(f.fileno())
+
+            reporter.update(record.get("num_characters", 0), error="error" in record)
+
+        os.fsync(f.fileno())
+
+    print(f"Done: {reporter.summary()}. Results in {output_path}.")
+    return reporter
+
+
+def pipeline_module(pipeline: str):
+    """Imports the requested pipeline module (its models are built on first use)."""
+    if pipeline == "1":
+        from src import pipeline as module
+    else:
+        from src import pipeline2 as module
+    return module
+
+
+def enable_cache(pipeline: str, cache_path: str, cache_mb: float = 2048):
+    """Opens the result cache at `cache_path` and attaches it to the pipeline's models."""
+    from src.result_cache import ResultCache
+
+    cache = ResultCache(cache_path, max_mb=cache_mb)
+    pipeline_module(pipeline).enable_result_cache(cache)
+    return cache
+
+
+def enable_dedup(pipeline: str, index_path: str, max_distance: int = 6):
+    """Opens the near-duplicate crop index at `index_path` and attaches it to the pipeline."""
+    from src.crop_index import CropIndex
+
+    index = CropIndex(index_path, max_distance=max_distance)
+    pipeline_module(pipeline).enable_crop_dedup(index)
+    return index
+
+
+def load_pipeline(
+    pipeline: str,
+    cache_path: Optional[str] = None,
+    cache_mb: float = 2048,
+    config: Optional[dict] = None,
+    dedup_path: Optional[str] = None,
+    dedup_distance: int = 6,
+) -> Callable:
+    """
+    Imports the requested pipeline module and returns its entry point (models are built
+    on the first image). With `cache_path`, results are served from / stored in a
+    persistent `ResultCache`. With `dedup_path`, near-duplicate crops reuse earlier
+    attributes (`CropIndex`). `config` is passed to the module's `configure`
+    (e.g. `{"extractor": {"answer_mode": "score"}}`).
+    """
+    if config:
+        pipeline_module(pipeline).configure(**config)
+    if cache_path:
+        enable_cache(pipeline, cache_path, cache_mb)
+    if dedup_path:
+        enable_dedup(pipeline, dedup_path, dedup_distance)
+    return pipeline_module(pipeline).extract_character_attributes_pipeline
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Resumable batch run of the character pipelines (JSONL output).")
+    parser.add_argument("inputs", nargs="+", help="Image directories, file lists (.txt), glob patterns or image paths")
+    parser.add_argument("--pipeline", choices=["1", "2"], default="2", help="Pipeline 1 (VLM) or 2 (tagger + VLM)")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL output, also used as the resume checkpoint")
+    parser.add_argument("--crops-dir", default=None, help="Also save crops here (one sub-directory per image)")
+    parser.add_argument("--report-every", type=int, default=10, help="Print throughput every N images")
+    parser.add_argument("--fsync-every", type=int, default=100, help="fsync the output every N records")
+    parser.add_argument("--retry-errors", action="store_true", help="Re-process inputs that previously failed")
+    parser.add_argument("--staged", action="store_true", help="Overlap decode/detect/tag/VLM stages on separate threads")
+    parser.add_argument("--decode-workers", type=int, default=2, help="Decode threads in --staged mode")
+    parser.add_argument("--queue-size", type=int, default=4, help="Inter-stage queue capacity in --staged mode")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes, each with its own models (0 = run in-process)")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="Intra-op threads per worker (default: cores / workers)")
+    parser.add_argument("--shard-size", type=int, default=8, help="Images processed together: one worker task, one detector / tagger batch")
+    parser.add_argument("--cache", default=None, help="SQLite result cache (images, crop tags, VLM answers), shared across runs")
+    parser.add_argument("--cache-mb", type=float, default=2048, help="Result cache size budget in MB")
+    parser.add_argument("--dedup", default=None, help="Near-duplicate crop index (SQLite); similar crops reuse earlier attributes")
+    parser.add_argument("--dedup-distance", type=int, default=6, help="Largest perceptual-hash Hamming distance counted as a duplicate")
+    parser.add_argument("--metrics", default=None, help="Write Prometheus-format metrics here at the end (in-process runs)")
+    parser.add_argument("--trace", default=None, help="Write a Chrome-trace timeline here at the end (in-process runs)")
+    parser.add_argument("--config", default=None, help='Pipeline settings as JSON, e.g. \'{"extractor": {"answer_mode": "score"}}\'')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_arg_parser().parse_args(argv)
+
+    pipeline_fn, process_records, staged, cache, crop_index = None, None, None, None, None
+    config = json.loads(args.config) if args.config else None
+    if args.metrics or args.trace:
+        metrics.enable(tracing=bool(args.trace))
+    if config and not args.workers:
+        pipeline_module(args.pipeline).configure(**config)
+    if args.workers:
+        from src.parallel_runner import ParallelRunner
+
+        runner = ParallelRunner(
+            args.pipeline,
+            num_workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            shard_size=args.shard_size,
+            crops_root=args.crops_dir,
+            cache_path=args.cache,
+            cache_mb=args.cache_mb,
+            config=config,
+            dedup_path=args.dedup,
+            dedup_distance=args.dedup_distance,
+        )
+        process_records = runner.process_records
+    elif args.staged:
+        from src.staged_pipeline import StagedPipeline, build_stages, staged_records
+
+        if args.cache:
+            cache = enable_cache(args.pipeline, args.cache, args.cache_mb)
+        if args.dedup:
+            print("Warning: --dedup is not used in --staged mode.")
+        stages = build_stages(args.pipeline, decode_workers=args.decode_workers, crops_root=args.crops_dir)
+        staged = StagedPipeline(stages, queue_size=args.queue_size)
+        process_records = staged_records(staged)
+    else:
+        if args.cache:
+            cache = enable_cache(args.pipeline, args.cache, args.cache_mb)
+        if args.dedup:
+            crop_index = enable_dedup(args.pipeline, args.dedup, args.dedup_distance)
+        process_records = batched_records(args.pipeline, batch_size=args.shard_size, crops_root=args.crops_dir)
+
+    run_batch(
+        pipeline_fn,
+        iter_inputs(args.inputs),
+        args.output,
+        crops_root=args.crops_dir,
+        report_every=args.report_every,
+        fsync_every=args.fsync_every,
+        retry_errors=args.retry_errors,
+        process_records=process_records,
+    )
+
+    if staged is not None:
+        print("Stage stats:", json.dumps(staged.stats(), indent=4))
+        print(f"Bottleneck stage: {staged.bottleneck()}")
+    if cache is not None:
+        print("Result cache:", json.dumps(cache.stats(), indent=4))
+    if crop_index is not None:
+        print("Near-duplicate crops:", json.dumps(crop_index.stats(), indent=4))
+    if args.pipeline == "2" and not args.workers:
+        print("VLM routing:", json.dumps(pipeline_module("2").routing_policy.stats(), indent=4))
+    if args.metrics:
+        metrics.save_prometheus(args.metrics)
+        print(f"Metrics written to {args.metrics}")
+    if args.trace:
+        metrics.save_trace(args.trace)
+        print(f"Trace written to {args.trace} (open in chrome://tracing or ui.perfetto.dev)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,26 @@
-import torch
-import torchvision.transforms as transforms
 from PIL import Image
 import json
-from transformers import BlipProcessor, BlipForConditionalGeneration
 
-# Load BLIP model and processor for attribute extraction
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
+_processor = None
+_model = None
+
+def _load_model():
+    """Load the BLIP model and processor for attribute extraction on first use."""
+    global _processor, _model
+    if _model is None:
+        from src.model_store import get_store
+
+        get_store()  # Hugging Face cache (and offline mode) of the local model store
+        from transformers import BlipProcessor, BlipForConditionalGeneration
+
+        _processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
+        _model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
+    return _processor, _model
 
 def preprocess_image(image_path):
     """Load and preprocess the image for model input."""
+    import torchvision.transforms as transforms
+
     image = Image.open(image_path).convert("RGB")
     transform_pipeline = transforms.Compose([
         transforms.Resize((384, 384)),
@@ -19,6 +30,9 @@ def preprocess_image(image_path):
 
 def extract_character_attributes(image_path):
     """Generate a description from an image and extract structured attributes."""
+    import torch
+
+    processor, model = _load_model()
     image = Image.open(image_path).convert("RGB")
     model_inputs = processor(images=image, return_tensors="pt")
     
@@ -1,30 +1,252 @@
 import cv2
 import os
-from imgutils.detect import detect_person
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from PIL import Image
+
+from src.instrumentation import metrics
+
+# Detector size by input resolution with level="auto": the first level whose bound exceeds
+# the longest side wins. Opt-in and not validated: smaller models trade detection quality
+# for speed whatever the input size, so check it with utils/evaluate.py before using it
+LEVEL_BY_RESOLUTION = ((512, "n"), (1024, "s"), (None, "m"))
+
+ImageInput = Union[str, Image.Image, np.ndarray]
+
+
+@dataclass
+class PersonCrop:
+    """A detected person kept in memory: RGB pixels, bbox in the source image and detection score."""
+    image: np.ndarray
+    bbox: Tuple[int, int, int, int]
+    score: float
+    index: int
+    path: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        """Identifier used in pipeline results: the saved path, or a stable name when kept in memory."""
+        return self.path if self.path else f"cropped_person_{self.index}"
+
+    def to_pil(self) -> Image.Image:
+        """Returns the crop as a PIL image (no copy of the pixel buffer)."""
+        return Image.fromarray(self.image)
+
+    def save(self, path: str) -> str:
+        """Writes the crop as a JPEG and remembers where it was written."""
+        cv2.imwrite(path, cv2.cvtColor(self.image, cv2.COLOR_RGB2BGR))
+        self.path = path
+        return path
+
 
 class PersonCropper:
-    def __init__(self):
-        """Initialize the person detector and cropper."""
-        pass
+    def __init__(
+        self,
+        level: str = "m",
+        version: str = "v1.1",
+        conf_threshold: float = 0.3,
+        iou_threshold: float = 0.5,
+        level_by_resolution: Sequence[Tuple[Optional[int], str]] = LEVEL_BY_RESOLUTION,
+        batch_size: int = 8,
+        decode_workers: int = 4,
+    ):
+        """
+        Initialize the person detector and cropper.
 
-    def crop_persons(self, image_path, output_dir):
-        """Detect and crop persons from an image, saving them to an output directory."""
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
-        image = cv2.imread(image_path)
-        detections = detect_person(image_path)
-        cropped_images = []
-        
+        Args:
+            level (str): imgutils detector size ("n", "s", "m", "x"; "m" is `detect_person`'s
+                default), or "auto" to pick it per image from `level_by_resolution`.
+            version (str): imgutils person detector version.
+            conf_threshold (float): Minimum detection score.
+            iou_threshold (float): IoU threshold of the non-maximum suppression.
+            level_by_resolution (Sequence[Tuple[Optional[int], str]]): (longest side bound, level)
+                pairs in increasing order, the last bound None.
+            batch_size (int): Images per detector run in `detect_crops_batch`.
+            decode_workers (int): Threads decoding images in `detect_crops_batch`.
+        """
+        self.level = level
+        self.version = version
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.level_by_resolution = tuple(level_by_resolution)
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+
+    def detector_level(self, width: int, height: int) -> str:
+        """Detector size used for an image of this resolution."""
+        if self.level != "auto":
+            return self.level
+        longest = max(width, height)
+        for bound, level in self.level_by_resolution:
+            if bound is None or longest < bound:
+                return level
+        return self.level_by_resolution[-1][1]
+
+    def levels(self) -> List[str]:
+        """Every detector size this cropper can use."""
+        if self.level != "auto":
+            return [self.level]
+        return list(dict.fromkeys(level for _, level in self.level_by_resolution))
+
+    @staticmethod
+    def decode(image: ImageInput) -> Image.Image:
+        """The image as RGB PIL image; a path is decoded exactly once, here."""
+        if isinstance(image, str):
+            with Image.open(image) as opened:
+                return opened.convert("RGB")
+        if isinstance(image, np.ndarray):
+            return Image.fromarray(image).convert("RGB")
+        return image.convert("RGB")
+
+    def _detect(self, images: List[Image.Image], level: str) -> List[list]:
+        """Raw detections of decoded images, all with the detector of `level`."""
+        # Imported on first use: imgutils loads ONNX Runtime and friends, and downloads its
+        # detector into the Hugging Face cache (the model store's, if one is set)
+        from src.model_store import get_store
+
+        get_store()
+        model_name = f"person_detect_{self.version}_{level}"
+        try:
+            detections = self._detect_batched(images, model_name)
+        except (ImportError, AttributeError, TypeError):
+            # Other imgutils release (the batched path uses its private helpers, written
+            # against dghs-imgutils==0.14.1 as pinned in requirements.txt)
+            detections = None
+        if detections is None:
+            # One public call per image (its session is cached too)
+            from imgutils.detect import detect_person
+
+            return [
+                detect_person(image, model_name=model_name, conf_threshold=self.conf_threshold, iou_threshold=self.iou_threshold)
+                for image in images
+            ]
+        return detections
+
+    def _detect_batched(self, images: List[Image.Image], model_name: str) -> Optional[List[list]]:
+        """
+        The same preprocessing, ONNX session (cached per model by imgutils) and
+        post-processing as `detect_person`, but for several images per run. Returns None
+        when the model is not a plain YOLO export, which only `detect_person` handles.
+
+        Relies on `_image_preprocess` resizing every image to the model's full input size
+        (imgutils' default `allow_dynamic=False`, as `detect_person` uses), so the images
+        stack into one batch.
+        """
+        from imgutils.data import rgb_encode
+        from imgutils.detect.person import _REPO_ID
+        from imgutils.generic.yolo import _image_preprocess, _open_models_for_repo_id, _yolo_postprocess
+
+        model = _open_models_for_repo_id(_REPO_ID)
+        if model._get_model_type(model_name) != "yolo":
+            return None
+        session, max_infer_size, labels = model._open_model(model_name)
+        prepared = [_image_preprocess(image, max_infer_size, allow_dynamic=False) for image in images]
+        data = np.stack([rgb_encode(new_image) for new_image, _, _ in prepared])
+        if isinstance(session.get_inputs()[0].shape[0], int):
+            # Exported with a fixed batch size of 1: one run per image, same session
+            outputs = [session.run(["output0"], {"images": data[i:i + 1]})[0][0] for i in range(len(images))]
+        else:
+            outputs = session.run(["output0"], {"images": data})[0]
+        return [
+            _yolo_postprocess(
+                output=output,
+                conf_threshold=self.conf_threshold,
+                iou_threshold=self.iou_threshold,
+                old_size=old_size,
+                new_size=new_size,
+                labels=labels,
+            )
+            for output, (_, old_size, new_size) in zip(outputs, prepared)
+        ]
+
+    def _crops(self, image: Image.Image, detections: list) -> List[PersonCrop]:
+        pixels = np.asarray(image)
+        crops = []
         for idx, (bbox, label, confidence) in enumerate(detections):
             if label == "person":
                 x1, y1, x2, y2 = bbox
-                cropped_image = image[y1:y2, x1:x2]
-                output_path = os.path.join(output_dir, f"cropped_person_{idx}.jpg")
-                cv2.imwrite(output_path, cropped_image)
-                cropped_images.append(output_path)
-        
-        return cropped_images
+                crops.append(PersonCrop(image=pixels[y1:y2, x1:x2], bbox=(x1, y1, x2, y2), score=float(confidence), index=idx))
+        return crops
+
+    def detect_crops(self, image: ImageInput, output_dir: Optional[str] = None) -> List[PersonCrop]:
+        """
+        Detect persons in an image and return the crops in memory.
+
+        Args:
+            image (Union[str, PIL.Image.Image, numpy.ndarray]): Image path, PIL image or RGB array.
+            output_dir (Optional[str]): If given, crops are also written there as JPEGs (optional sink).
+
+        Returns:
+            List[PersonCrop]: One crop per detected person, with bbox and detection score.
+        """
+        return self.detect_crops_batch([image], [output_dir])[0]
+
+    def detect_crops_batch(
+        self, images: Sequence[ImageInput], output_dirs: Optional[Sequence[Optional[str]]] = None
+    ) -> List[List[PersonCrop]]:
+        """
+        Detect persons in many images. Paths are decoded on `decode_workers` threads while
+        the detector runs; images of the same detector size go through its ONNX session
+        `batch_size` at a time.
+
+        Args:
+            images (Sequence[Union[str, PIL.Image.Image, numpy.ndarray]]): Image paths, PIL images or RGB arrays.
+            output_dirs (Optional[Sequence[Optional[str]]]): Per-image crop directory (None keeps that image's crops in memory only).
+
+        Returns:
+            List[List[PersonCrop]]: The crops of every image, in input order.
+        """
+        if len(images) == 1:
+            decoded = [self.decode(images[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.decode_workers, len(images)))) as pool:
+                decoded = list(pool.map(self.decode, images))
+
+        by_level: Dict[str, List[int]] = {}
+        for i, image in enumerate(decoded):
+            by_level.setdefault(self.detector_level(image.width, image.height), []).append(i)
+
+        results: List[List[PersonCrop]] = [[] for _ in decoded]
+        for level, indices in by_level.items():
+            for start in range(0, len(indices), self.batch_size):
+                chunk = indices[start:start + self.batch_size]
+                with metrics.span("detect", level=level):
+                    detections = self._detect([decoded[i] for i in chunk], level)
+                for i, image_detections in zip(chunk, detections):
+                    results[i] = self._crops(decoded[i], image_detections)
+
+        metrics.count("images_detected", len(decoded))
+        metrics.count("detections", sum(len(crops) for crops in results))
+        for crops, output_dir in zip(results, output_dirs or []):
+            if output_dir is not None:
+                self.save_crops(crops, output_dir)
+        return results
+
+    def settings(self) -> dict:
+        """Settings that change detections: results cached per image must be keyed by them."""
+        settings = {"level": self.level, "version": self.version, "conf_threshold": self.conf_threshold, "iou_threshold": self.iou_threshold}
+        if self.level == "auto":
+            settings["level_by_resolution"] = self.level_by_resolution
+        return settings
+
+    def warm_up(self):
+        """Loads the detector of every size this cropper can pick and runs it once."""
+        for level in self.levels():
+            self._detect([Image.new("RGB", (640, 640), (255, 255, 255))], level)
+
+    def save_crops(self, crops: List[PersonCrop], output_dir: str) -> List[str]:
+        """Writes crops to `output_dir` as cropped_person_{idx}.jpg and returns the paths."""
+        with metrics.span("crop_io"):
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            return [crop.save(os.path.join(output_dir, f"cropped_person_{crop.index}.jpg")) for crop in crops]
+
+    def crop_persons(self, image_path, output_dir):
+        """Detect and crop persons from an image, saving them to an output directory."""
+        crops = self.detect_crops(image_path)
+        return self.save_crops(crops, output_dir)
 
 # Example Usage
 if __name__ == "__main__":
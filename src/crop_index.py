@@ -0,0 +1,414 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.image_utils import to_pil_image
+from src.instrumentation import metrics
+
+# (64-bit perceptual hash, width / height of the crop, colour thumbnail)
+Fingerprint = Tuple[int, float, np.ndarray]
+
+COLOUR_SIZE = 16
+
+
+@functools.lru_cache()
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II basis: `D @ x` is the DCT of the column vector x."""
+    n = np.arange(size)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    basis[0] *= 1 / np.sqrt(2)
+    return basis * np.sqrt(2 / size)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def phash(image) -> int:
+    """
+    64-bit DCT perceptual hash: the 8x8 lowest frequencies of the 32x32 grayscale image,
+    each compared with their median. Robust to resizing, re-encoding and small edits.
+    """
+    gray = to_pil_image(image).convert("L").resize((32, 32), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.float64)
+    dct = _dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:8, :8]
+    return _bits_to_int(low > np.median(low))
+
+
+def dhash(image) -> int:
+    """64-bit difference hash: whether each pixel of the 9x8 grayscale image is darker than its right neighbour."""
+    gray = to_pil_image(image).convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = np.asarray(gray, dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def colour_thumbnail(image) -> np.ndarray:
+    """16x16 CIELAB thumbnail (uint8, OpenCV scaling): the colours the grayscale hashes ignore."""
+    pixels = np.asarray(to_pil_image(image).convert("RGB"))
+    small = cv2.resize(pixels, (COLOUR_SIZE, COLOUR_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_RGB2LAB)
+
+
+def colour_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest colour difference between corresponding thumbnail cells (Lab units of OpenCV's 8-bit scale)."""
+    return float(np.linalg.norm(a.astype(np.float32) - b.astype(np.float32), axis=-1).max())
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _band_layout(max_distance: int) -> List[Tuple[int, int]]:
+    """
+    (shift, mask) of `max_distance + 1` bands covering the 64 bits. Two hashes within
+    `max_distance` bits differ in at most `max_distance` bands, so at least one band is
+    equal: looking up every band exactly finds all candidates (multi-index hashing).
+    """
+    count = max_distance + 1
+    widths = [64 // count + (1 if i < 64 % count else 0) for i in range(count)]
+    layout, shift = [], 0
+    for width in widths:
+        layout.append((shift, (1 << width) - 1))
+        shift += width
+    return layout
+
+
+def _colour_from_blob(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.uint8).reshape(COLOUR_SIZE, COLOUR_SIZE, 3)
+
+
+def _signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class CropIndex:
+    # Hits refresh their disk LRU position in memory; the timestamps are written with the
+    # next add, or once this many have piled up (a hit then costs no write transaction)
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_distance: int = 6,
+        hash_kind: str = "phash",
+        max_aspect_change: float = 0.15,
+        max_colour_change: float = 24.0,
+        max_entries: int = 50_000,
+        max_disk_entries: int = 1_000_000,
+        evict_to: float = 0.9,
+    ):
+        """
+        Near-duplicate index of processed crops: re-posts, resized copies and variant
+        frames of the same character reuse the result stored for the first one instead
+        of going through the tagger and VLM again.
+
+        Crops are fingerprinted with a 64-bit perceptual hash. A lookup returns the
+        result of the closest stored crop within `max_distance` differing bits, of
+        similar aspect ratio and with the same colours. The hashes only see grayscale, so
+        the same line art with another hair or eye colour matches them; comparing small
+        colour thumbnails cell by cell keeps it from inheriting the other crop's answers.
+
+        Each hash is split into `max_distance + 1` bands, and candidates are found by exact band matches rather than a scan. The most
+        recently used `max_entries` hashes are kept in memory. With `path`, every entry
+        is also stored in a SQLite file, up to `max_disk_entries`. That file can be
+        shared by several processes (WAL mode), and memory misses are looked up there.
+
+        Args:
+            path (Optional[str]): SQLite file of the on-disk index (None: memory only).
+            max_distance (int): Largest Hamming distance counted as a duplicate (0-16).
+                Around 6 catches resized / re-encoded copies; keep it low for pHash on tiny crops.
+            hash_kind (str): "phash" (DCT, default) or "dhash" (gradient, cheaper).
+            max_aspect_change (float): Largest relative change of width / height between duplicates.
+            max_colour_change (float): Largest colour difference of any 16x16 thumbnail cell
+                between duplicates. Re-encoded / resized copies stay under ~10; a changed
+                hair colour is far above, a changed eye colour around 40.
+            max_entries (int): Hashes kept in memory (least recently used are dropped first).
+            max_disk_entries (int): Entries kept on disk (least recently used are deleted first).
+            evict_to (float): After eviction the on-disk index is shrunk to this fraction of its budget.
+        """
+        if not 0 <= max_distance <= 16:
+            raise ValueError(f"max_distance must be between 0 and 16, got {max_distance}")
+        if hash_kind not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown hash kind {hash_kind!r} (expected one of {', '.join(HASH_FUNCTIONS)})")
+
+        self.path = path
+        self.max_distance = max_distance
+        self.hash_kind = hash_kind
+        self.max_aspect_change = max_aspect_change
+        self.max_colour_change = max_colour_change
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.evict_to = evict_to
+        self.hits = 0
+        self.misses = 0
+        self._layout = _band_layout(max_distance)
+        self._lock = threading.Lock()
+        self._accessed = {}
+
+        # Memory: entry id -> (namespace, hash, aspect, colour, result or None when it lives on disk), in LRU order
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._buckets: Dict[tuple, Set[int]] = {}
+        self._next_id = 0
+
+        self._conn = None
+        if path is not None:
+            self._open(path)
+
+    # Fingerprints
+
+    def fingerprint(self, image) -> Fingerprint:
+        """Perceptual hash, aspect ratio and colour thumbnail of a crop (path, PIL image, array or `PersonCrop`)."""
+        pil_image = to_pil_image(image)
+        return HASH_FUNCTIONS[self.hash_kind](pil_image), pil_image.width / max(pil_image.height, 1), colour_thumbnail(pil_image)
+
+    def _bands(self, value: int) -> List[Tuple[int, int]]:
+        return [(band, (value >> shift) & mask) for band, (shift, mask) in enumerate(self._layout)]
+
+    def _matches(self, fingerprint: Fingerprint, value: int, aspect: float, colour: np.ndarray) -> Optional[int]:
+        distance = hamming(fingerprint[0], value)
+        if distance > self.max_distance:
+            return None
+        if abs(aspect - fingerprint[1]) > self.max_aspect_change * max(aspect, fingerprint[1]):
+            return None
+        if colour_distance(fingerprint[2], colour) > self.max_colour_change:
+            return None
+        return distance
+
+    # On-disk index
+
+    def _open(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(crops)")]
+        if columns and "colour" not in columns:
+            # Entries without a colour thumbnail cannot be checked for a colour change
+            print(f"Warning: {path} has no colour fingerprints; clearing it.")
+            self._conn.execute("DROP TABLE crops")
+            self._conn.execute("DROP TABLE IF EXISTS bands")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS crops ("
+            " id INTEGER PRIMARY KEY, namespace TEXT NOT NULL, hash INTEGER NOT NULL,"
+            " aspect REAL NOT NULL, colour BLOB NOT NULL, result TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS crops_last_access ON crops (last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, value INTEGER NOT NULL, id INTEGER NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_lookup ON bands (band, value)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_id ON bands (id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        # The band split depends on max_distance and the hashes on hash_kind: re-index on change
+        layout = f"{self.hash_kind}:{len(self._layout)}"
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        if row is None or row[0] != layout:
+            if row is not None and row[0].split(":")[0] != self.hash_kind:
+                print(f"Warning: {path} was built with {row[0].split(':')[0]} hashes; clearing it for {self.hash_kind}.")
+                self._conn.execute("DELETE FROM crops")
+            self._conn.execute("DELETE FROM bands")
+            rows = self._conn.execute("SELECT id, hash FROM crops").fetchall()
+            self._conn.executemany(
+                "INSERT INTO bands (band, value, id) VALUES (?, ?, ?)",
+                [(band, _signed(value), entry_id) for entry_id, hash_value in rows for band, value in self._bands(hash_value % (1 << 64))],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('layout', ?)", (layout,))
+        self._conn.commit()
+
+        # Warm the memory index with the most recently used entries
+        rows = self._conn.execute(
+            "SELECT id, namespace, hash, aspect, colour FROM crops ORDER BY last_access DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        for entry_id, namespace, hash_value, aspect, colour in reversed(rows):
+            self._remember(entry_id, namespace, hash_value % (1 << 64), aspect, _colour_from_blob(colour), None)
+        self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM crops").fetchone()[0]
+
+    def _disk_lookup(self, fingerprint: Fingerprint, namespace: str) -> Optional[tuple]:
+        bands = self._bands(fingerprint[0])
+        condition = " OR ".join(["(b.band = ? AND b.value = ?)"] * len(bands))
+        params = [namespace] + [item for band, value in bands for item in (band, _signed(value))]
+        rows = self._conn.execute(
+            f"SELECT DISTINCT c.id, c.hash, c.aspect, c.colour FROM bands b JOIN crops c ON c.id = b.id"
+            f" WHERE c.namespace = ? AND ({condition})",
+            params,
+        ).fetchall()
+        best = None
+        for entry_id, hash_value, aspect, colour in rows:
+            colour = _colour_from_blob(colour)
+            distance = self._matches(fingerprint, hash_value % (1 << 64), aspect, colour)
+            if distance is not None and (best is None or distance < best[0]):
+                best = (distance, entry_id, hash_value % (1 << 64), aspect, colour)
+        return best
+
+    def _flush_access(self):
+        # Writes buffered hit timestamps (the caller commits)
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE crops SET last_access = ? WHERE id = ?",
+                [(accessed, entry_id) for entry_id, accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def _evict_disk(self):
+        # Other processes may have written too: start from the real total
+        self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM crops").fetchone()[0]
+        excess = self._disk_entries - int(self.max_disk_entries * self.evict_to)
+        if excess <= 0:
+            return
+        evicted = [row[0] for row in self._conn.execute("SELECT id FROM crops ORDER BY last_access LIMIT ?", (excess,))]
+        self._conn.executemany("DELETE FROM crops WHERE id = ?", [(entry_id,) for entry_id in evicted])
+        self._conn.executemany("DELETE FROM bands WHERE id = ?", [(entry_id,) for entry_id in evicted])
+        for entry_id in evicted:
+            self._forget(entry_id)
+        self._disk_entries -= len(evicted)
+
+    # Memory index
+
+    def _remember(self, entry_id: int, namespace: str, value: int, aspect: float, colour: np.ndarray, result):
+        if entry_id in self._entries:
+            self._entries.move_to_end(entry_id)
+            return
+        self._entries[entry_id] = (namespace, value, aspect, colour, result)
+        for band in self._bands(value):
+            self._buckets.setdefault((namespace,) + band, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        namespace, value = entry[0], entry[1]
+        for band in self._bands(value):
+            bucket = self._buckets.get((namespace,) + band)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[(namespace,) + band]
+
+    def _memory_lookup(self, fingerprint: Fingerprint, namespace: str) -> Optional[Tuple[int, int]]:
+        candidates = set()
+        for band in self._bands(fingerprint[0]):
+            candidates.update(self._buckets.get((namespace,) + band, ()))
+        best = None
+        for entry_id in candidates:
+            _, value, aspect, colour, _ = self._entries[entry_id]
+            distance = self._matches(fingerprint, value, aspect, colour)
+            if distance is not None and (best is None or distance < best[0]):
+                best = (distance, entry_id)
+        return best
+
+    # Lookup / insert
+
+    def lookup(self, fingerprint: Fingerprint, namespace: str = ""):
+        """
+        Result stored for the closest near-duplicate of this fingerprint, or None.
+
+        Args:
+            fingerprint (Fingerprint): From `fingerprint(crop)`.
+            namespace (str): Results are only reused within the same namespace (pipeline and model settings).
+        """
+        with self._lock:
+            result = None
+            found = self._memory_lookup(fingerprint, namespace)
+            if found is not None:
+                entry_id = found[1]
+                self._entries.move_to_end(entry_id)
+                result = self._entries[entry_id][4]
+            elif self._conn is not None:
+                best = self._disk_lookup(fingerprint, namespace)
+                if best is not None:
+                    _, entry_id, value, aspect, colour = best
+                    self._remember(entry_id, namespace, value, aspect, colour, None)
+                    found = best
+
+            if found is None:
+                self.misses += 1
+                metrics.count("dedup_lookups", result="miss")
+                return None
+
+            if self._conn is not None:
+                row = self._conn.execute("SELECT result FROM crops WHERE id = ?", (entry_id,)).fetchone()
+                if row is None:
+                    # Evicted by another process since it was loaded
+                    self._forget(entry_id)
+                    self.misses += 1
+                    metrics.count("dedup_lookups", result="miss")
+                    return None
+                self._accessed[entry_id] = time.time()
+                if len(self._accessed) >= self.ACCESS_FLUSH_SIZE:
+                    self._flush_access()
+                    self._conn.commit()
+                result = json.loads(row[0])
+            self.hits += 1
+            metrics.count("dedup_lookups", result="hit")
+            return result
+
+    def add(self, fingerprint: Fingerprint, result, namespace: str = ""):
+        """Stores the (JSON-serializable) result of a processed crop under its fingerprint."""
+        value, aspect, colour = fingerprint
+        with self._lock:
+            if self._conn is None:
+                entry_id = self._next_id
+                self._next_id += 1
+                self._remember(entry_id, namespace, value, aspect, colour, result)
+                return
+
+            self._flush_access()
+            cursor = self._conn.execute(
+                "INSERT INTO crops (namespace, hash, aspect, colour, result, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, _signed(value), aspect, colour.tobytes(), json.dumps(result), time.time()),
+            )
+            entry_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO bands (band, value, id) VALUES (?, ?, ?)",
+                [(band, _signed(band_value), entry_id) for band, band_value in self._bands(value)],
+            )
+            self._disk_entries += 1
+            if self._disk_entries > self.max_disk_entries:
+                self._evict_disk()
+            self._conn.commit()
+            self._remember(entry_id, namespace, value, aspect, colour, None)
+
+    # Stats
+
+    def stats(self) -> dict:
+        """Hit/miss counters (this process), entries in memory and on disk."""
+        lookups = self.hits + self.misses
+        with self._lock:
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM crops").fetchone()[0] if self._conn else None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._entries),
+            "disk_entries": disk_entries,
+            "max_distance": self.max_distance,
+            "hash": self.hash_kind,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._flush_access()
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
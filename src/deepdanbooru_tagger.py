@@ -2,37 +2,42 @@
 
 import json
 import os
-import pathlib
 import numpy as np
 import PIL.Image
-import tensorflow as tf
-import deepdanbooru as dd
-import huggingface_hub
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, List 
 
+from src.image_utils import content_hash, to_pil_image
+from src.instrumentation import metrics
+from src.tagger_backends import TaggerBackend, create_backend
+
 class DanbooruTagger:
-    def __init__(self, model_repo="public-data/DeepDanbooru", json_path="danbooru_bucket.json"):
+    def __init__(self, model_repo="public-data/DeepDanbooru", json_path="danbooru_bucket.json", backend="keras", result_cache=None, **backend_kwargs):
         """
         Initializes the Danbooru tagger model and loads tag buckets.
 
         Args:
             model_repo (str): Hugging Face repo where the model is stored.
             json_path (str): Path to the JSON file containing tag buckets.
+            backend (Union[str, TaggerBackend]): "keras" (DeepDanbooru on TensorFlow), "onnx"
+                (exported DeepDanbooru on ONNX Runtime), "wd-onnx" (SmilingWolf wd-tagger on
+                ONNX Runtime) or a ready `TaggerBackend` instance.
+            result_cache (Optional[ResultCache]): Persistent cache of probability vectors, keyed by crop hash.
+            **backend_kwargs: Extra arguments for the backend (e.g. model_path, num_threads).
         """
-        self.model = self._load_model(model_repo)
-        self.labels = self._load_labels(model_repo)
+        if isinstance(backend, str):
+            if backend in ("keras", "onnx"):
+                backend_kwargs.setdefault("model_repo", model_repo)
+            backend = create_backend(backend, **backend_kwargs)
+        self.backend: TaggerBackend = backend
+        self.labels = self.backend.labels
         self.tag_buckets = self._load_tag_buckets(json_path)
+        self._compile_buckets()
+        self.result_cache = result_cache
 
-    def _load_model(self, repo: str) -> tf.keras.Model:
-        """Loads the DeepDanbooru model from Hugging Face Hub."""
-        path = huggingface_hub.hf_hub_download(repo, "model-resnet_custom_v3.h5")
-        return tf.keras.models.load_model(path)
-
-    def _load_labels(self, repo: str) -> list[str]:
-        """Loads the tag labels from Hugging Face Hub."""
-        path = huggingface_hub.hf_hub_download(repo, "tags.txt")
-        with pathlib.Path(path).open() as f:
-            return [line.strip() for line in f]
+    def cache_namespace(self) -> str:
+        """Identifies the model behind cached probability vectors: backend, weights (repo / path and revision) and label set."""
+        return f"{type(self.backend).__name__}:{self.backend.model_id}:{len(self.labels)}"
 
     def _load_tag_buckets(self, json_path: str) -> dict:
         """Loads tag buckets from a JSON file safely."""
@@ -43,6 +48,135 @@ class DanbooruTagger:
         with open(json_path, 'r') as f:
             return json.load(f)
 
+    def _compile_buckets(self):
+        """
+        Compiles the bucket definitions against the label set once, at load time:
+          - `_bucket_indices`: bucket -> array of label indices (in bucket order)
+          - `_tag_to_buckets`: tag -> buckets containing it (in bucket file order)
+        """
+        # Later duplicates win, as with dict(zip(labels, probs))
+        label_index = {label: i for i, label in enumerate(self.labels)}
+
+        self._bucket_indices = {}
+        self._tag_to_buckets = {}
+        for bucket_name, bucket_tags in self.tag_buckets.items():
+            unique_tags = list(dict.fromkeys(bucket_tags))
+            indices = [label_index[t] for t in unique_tags if t in label_index]
+            if indices:
+                self._bucket_indices[bucket_name] = np.array(indices, dtype=np.int64)
+            for t in unique_tags:
+                self._tag_to_buckets.setdefault(t, []).append(bucket_name)
+
+    def _preprocess(self, image: Union[str, PIL.Image.Image]) -> np.ndarray:
+        """Loads an image (path, PIL image or crop) and applies the backend's preprocessing."""
+        return self.backend.preprocess(to_pil_image(image))
+
+    def _threshold_tags(self, probs: np.ndarray, threshold: float) -> dict:
+        """Returns {tag: score} for every tag at or above threshold, highest score first."""
+        # Mask first, then sort only the (few) surviving indices
+        indices = np.flatnonzero(probs >= threshold)
+        indices = indices[np.argsort(probs[indices])[::-1]]
+        return {self.labels[i]: probs[i] for i in indices}
+
+    def _postprocess(self, probs: np.ndarray, threshold: float) -> dict:
+        """Builds the `predict_all` result structure from one probability vector."""
+        # 1) thresholded tags
+        thresholded_tags = self._threshold_tags(probs, threshold)
+
+        # 2) categorize thresholded tags
+        cat_tags = self.find_tags_in_buckets(thresholded_tags)
+
+        # 3) best candidate ignoring threshold
+        best_cands = self.find_best_candidates(probs)
+
+        return {
+            "categorized_tags": cat_tags,
+            "best_candidates": best_cands
+        }
+
+    def predict_probs_batch(self, images: List[Union[str, PIL.Image.Image]], batch_size: int = 16, num_workers: int = 4) -> np.ndarray:
+        """
+        Runs the model over many images and returns the raw probabilities.
+
+        Images are preprocessed in a thread pool (the next batch is prepared while the
+        current one runs), stacked into batches of `batch_size` and sent through one
+        forward pass per batch. When the input spans several batches, the last one is
+        zero-padded to `batch_size` so the model always sees the same input shape.
+        With a `result_cache`, crops whose pixels were tagged before skip the model.
+
+        Args:
+            images (List[Union[str, PIL.Image.Image, PersonCrop]]): Images, image paths or in-memory crops.
+            batch_size (int): Number of images per forward pass.
+            num_workers (int): Threads used for loading and preprocessing.
+
+        Returns:
+            numpy.ndarray: Probabilities of shape (len(images), num_labels).
+        """
+        if not images:
+            return np.zeros((0, len(self.labels)))
+        if self.result_cache is None:
+            return self._predict_probs_uncached(images, batch_size, num_workers)
+
+        # Serve crops seen before from the cache, run the model on the rest only
+        images = [to_pil_image(image) for image in images]
+        namespace = self.cache_namespace()
+        keys = [self.result_cache.make_key(namespace, content_hash(image)) for image in images]
+        probs = [self.result_cache.get_array("tagger", key) for key in keys]
+
+        missing = [idx for idx, image_probs in enumerate(probs) if image_probs is None]
+        metrics.count("tagger_cache_hits", len(images) - len(missing))
+        if missing:
+            computed = self._predict_probs_uncached([images[idx] for idx in missing], batch_size, num_workers)
+            for idx, image_probs in zip(missing, computed):
+                probs[idx] = image_probs
+                self.result_cache.put_array("tagger", keys[idx], image_probs)
+
+        return np.stack(probs)
+
+    def _predict_probs_uncached(self, images: List[Union[str, PIL.Image.Image]], batch_size: int, num_workers: int) -> np.ndarray:
+        """Batched, prefetching forward passes behind `predict_probs_batch`."""
+        metrics.count("tagger_images", len(images))
+        chunks = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+        pad_to = batch_size if len(chunks) > 1 else len(images)
+
+        all_probs = []
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            pending = [pool.submit(self._preprocess, image) for image in chunks[0]]
+            for chunk_idx in range(len(chunks)):
+                batch = np.stack([future.result() for future in pending])
+                # Start preprocessing the next batch while this one runs
+                if chunk_idx + 1 < len(chunks):
+                    pending = [pool.submit(self._preprocess, image) for image in chunks[chunk_idx + 1]]
+
+                num_real = len(batch)
+                if num_real < pad_to:
+                    padding = np.zeros((pad_to - num_real,) + batch.shape[1:], dtype=batch.dtype)
+                    batch = np.concatenate([batch, padding])
+                with metrics.span("tag_forward", backend=type(self.backend).__name__):
+                    probs = self.backend.predict(batch)[:num_real]
+                all_probs.append(probs.astype(float))
+
+        return np.concatenate(all_probs)
+
+    def predict_batch(
+        self, images: List[Union[str, PIL.Image.Image]], threshold: float = 0.5, batch_size: int = 16, num_workers: int = 4
+    ) -> List[dict]:
+        """
+        Batched version of `predict_all`.
+
+        Args:
+            images (List[Union[str, PIL.Image.Image, PersonCrop]]): Images, image paths or in-memory crops.
+            threshold (float): Minimum score threshold for returned tags.
+            batch_size (int): Number of images per forward pass.
+            num_workers (int): Threads used for loading and preprocessing.
+
+        Returns:
+            List[dict]: One `predict_all` result per input image, in input order.
+        """
+        with metrics.span("tag"):
+            probs = self.predict_probs_batch(images, batch_size=batch_size, num_workers=num_workers)
+            return [self._postprocess(image_probs, threshold) for image_probs in probs]
+
     def predict_tags(self, image: PIL.Image.Image, score_threshold: float = 0.5) -> dict:
         """
         Predicts tags for an input image using DeepDanbooru.
@@ -54,28 +188,12 @@ class DanbooruTagger:
         Returns:
             dict: Dictionary of predicted tags -> confidence scores.
         """
-        _, height, width, _ = self.model.input_shape
-
-        # Convert image to a NumPy array
-        image = np.asarray(image)
-        image = tf.image.resize(image, size=(height, width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
-        image = image.numpy()
-        # Transform and pad for model input
-        image = dd.image.transform_and_pad_image(image, width, height)
-        image = image / 255.0  # Normalize
-
         # Predict
-        probs = self.model.predict(image[None, ...])[0].astype(float)
-        indices = np.argsort(probs)[::-1]
+        probs = self.predict_probs_batch([image])[0]
 
         # Filter out tags below threshold
-        filtered_tags = {}
-        for i in indices:
-            tag = self.labels[i]
-            score = probs[i]
-            if score >= score_threshold:
-                filtered_tags[tag] = score
-        
+        filtered_tags = self._threshold_tags(probs, score_threshold)
+
         return filtered_tags, probs
 
     def find_tags_in_buckets(self, tags: dict) -> dict:
@@ -97,11 +215,8 @@ class DanbooruTagger:
         categorized_tags = {}
 
         for tag, score in tags.items():
-            for bucket_name, bucket_tags in self.tag_buckets.items():
-                if tag in bucket_tags:
-                    if bucket_name not in categorized_tags:
-                        categorized_tags[bucket_name] = []
-                    categorized_tags[bucket_name].append({"tag": tag, "score": score})
+            for bucket_name in self._tag_to_buckets.get(tag, ()):
+                categorized_tags.setdefault(bucket_name, []).append({"tag": tag, "score": score})
 
         return categorized_tags
 
@@ -122,23 +237,12 @@ class DanbooruTagger:
             If no tags from that bucket are in the model's label set, that bucket is omitted.
         """
         best_candidates = {}
-        # We need to check each bucket, find which tag in that bucket has the highest score.
 
-        # Convert prob array -> label->prob
-        label_probs = dict(zip(self.labels, probs))
-
-        for bucket_name, bucket_tags in self.tag_buckets.items():
-            # Among bucket_tags, find the one with highest label_probs
-            candidate = None
-            candidate_score = -1.0
-
-            for t in bucket_tags:
-                if t in label_probs and label_probs[t] > candidate_score:
-                    candidate = t
-                    candidate_score = label_probs[t]
-
-            if candidate is not None and candidate_score >= 0.0:
-                best_candidates[bucket_name] = {"tag": candidate, "score": float(candidate_score)}
+        # Gather each bucket's scores and take the argmax (first highest, in bucket order)
+        for bucket_name, indices in self._bucket_indices.items():
+            bucket_probs = probs[indices]
+            best = int(np.argmax(bucket_probs))
+            best_candidates[bucket_name] = {"tag": self.labels[indices[best]], "score": float(bucket_probs[best])}
 
         return best_candidates
 
@@ -152,7 +256,7 @@ class DanbooruTagger:
           3) Also pick best candidate for each bucket ignoring threshold
 
         Args:
-            image (Union[str, PIL.Image.Image]): Input image or image path.
+            image (Union[str, PIL.Image.Image, PersonCrop]): Input image, image path or in-memory crop.
             threshold (float): Minimum score threshold for returned tags.
 
         Returns:
@@ -161,67 +265,7 @@ class DanbooruTagger:
             "best_candidates": { <bucket>: {"tag": <str>, "score": <float>}, ... }
           }
         """
-        _, height, width, _ = self.model.input_shape
-
-        # Load the image if a path is provided
-        if isinstance(image, str):
-            image = PIL.Image.open(image)
-
-        # Convert image to a NumPy array
-        image = np.asarray(image)
-        image = tf.image.resize(image, size=(height, width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
-        image = image.numpy()
-        # Transform and pad for model input
-        image = dd.image.transform_and_pad_image(image, width, height)
-        image = image / 255.0  # Normalize
-
-        # Run inference
-        probs = self.model.predict(image[None, ...])[0].astype(float)
-        # 1) thresholded tags
-        thresholded_tags = {}
-        indices = np.argsort(probs)[::-1]
-        for i in indices:
-            if probs[i] < threshold:
-                break
-            thresholded_tags[self.labels[i]] = probs[i]
-
-        # 2) categorize thresholded tags
-        cat_tags = self.find_tags_in_buckets(thresholded_tags)
-
-        # 3) best candidate ignoring threshold
-        best_cands = self.find_best_candidates(probs)
-
-        return {
-            "categorized_tags": cat_tags,
-            "best_candidates": best_cands
-        }
-        image = np.asarray(image)
-        image = tf.image.resize(image, size=(height, width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
-        image = image.numpy()
-        # Transform and pad for model input
-        image = dd.image.transform_and_pad_image(image, width, height)
-        image = image / 255.0  # Normalize
-
-        # Run inference
-        probs = self.model.predict(image[None, ...])[0].astype(float)
-        # 1) thresholded tags
-        thresholded_tags = {}
-        indices = np.argsort(probs)[::-1]
-        for i in indices:
-            if probs[i] < threshold:
-                break
-            thresholded_tags[self.labels[i]] = probs[i]
-
-        # 2) categorize thresholded tags
-        cat_tags = self.find_tags_in_buckets(thresholded_tags)
-
-        # 3) best candidate ignoring threshold
-        best_cands = self.find_best_candidates(probs)
-
-        return {
-            "categorized_tags": cat_tags,
-            "best_candidates": best_cands
-        }
+        return self.predict_batch([image], threshold=threshold)[0]
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,34 @@
+import hashlib
+import numpy as np
+from PIL import Image
+
+
+def to_pil_image(image) -> Image.Image:
+    """
+    Converts any supported image input to a PIL image.
+
+    Accepts an image path, a PIL image, an RGB NumPy array or an in-memory crop
+    (anything with a `to_pil()` method, e.g. `PersonCrop`).
+    """
+    if isinstance(image, str):
+        return Image.open(image)
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image)
+    if hasattr(image, "to_pil"):
+        return image.to_pil()
+    raise TypeError(f"Unsupported image input: {type(image).__name__}")
+
+
+def content_hash(image: Image.Image) -> str:
+    """
+    Hashes the decoded pixel content of an image.
+
+    Two crops with identical pixels (same mode and size) get the same key, no matter
+    which file or upload they came from.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from PIL import Image, UnidentifiedImageError
+
+from src.instrumentation import metrics
+
+
+class InferenceService:
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        request_timeout: float = 120.0,
+        queue_timeout: float = 5.0,
+        max_image_mb: float = 20,
+        max_image_megapixels: float = 40,
+        model_name: str = "blip2_t5",
+        model_type: str = "pretrain_flant5xl",
+        warm_up: bool = True,
+    ):
+        """
+        Model side of the HTTP service: shared models, bounded concurrency and timeouts.
+
+        At most `max_concurrency` requests run model code at a time; further requests wait
+        up to `queue_timeout` seconds for a slot and are then rejected with 503. A request
+        that runs longer than `request_timeout` seconds is answered with 504. Crops of
+        concurrent requests are merged into shared tagger / VLM batches.
+
+        Args:
+            max_concurrency (int): Requests processed at the same time.
+            request_timeout (float): Seconds before a running request is answered with 504.
+            queue_timeout (float): Seconds a request may wait for a free slot.
+            max_image_mb (float): Largest accepted upload.
+            max_image_megapixels (float): Largest accepted image size once decoded. Checked
+                from the header, before any pixel is decoded (a small upload can decode huge).
+            model_name (str): LAVIS model name of the attribute extractor.
+            model_type (str): LAVIS model type of the attribute extractor.
+            warm_up (bool): Run one dummy inference per model before reporting ready.
+        """
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.queue_timeout = queue_timeout
+        self.max_image_bytes = int(max_image_mb * 1024 * 1024)
+        self.max_image_pixels = int(max_image_megapixels * 1_000_000)
+        self.model_name = model_name
+        self.model_type = model_type
+        self.warm_up = warm_up
+
+        self.cropper = None
+        self.tagger = None
+        self.extractor = None
+        self.ready = threading.Event()
+        self.load_error: Optional[str] = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="inference")
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def load_models(self):
+        """Loads (and warms up) the shared models; readiness flips once this is done."""
+        from src.model_registry import get_batched_extractor, get_batched_tagger, get_cropper, registry
+
+        try:
+            self.cropper = get_cropper()
+            self.tagger = get_batched_tagger()
+            self.extractor = get_batched_extractor(self.model_name, self.model_type)
+            if self.warm_up:
+                registry.warm_up()
+            self.ready.set()
+        except Exception as e:
+            self.load_error = repr(e)
+            print(f"Error: model loading failed: {self.load_error}")
+
+    def decode(self, data: bytes) -> Image.Image:
+        """Decodes an uploaded image in memory (400 if it is not an image, 413 if it decodes too large)."""
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.width * image.height > self.max_image_pixels:
+                    raise HTTPException(status_code=413, detail=f"Image too large: {image.width}x{image.height} pixels.")
+                return image.convert("RGB")
+        except Image.DecompressionBombError as e:
+            # Not an OSError: PIL raises it from `open` for images far above MAX_IMAGE_PIXELS
+            raise HTTPException(status_code=413, detail=f"Image too large: {e}")
+        except (UnidentifiedImageError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+
+    async def run(self, fn: Callable, *args):
+        """Runs blocking model code on the worker pool, within the concurrency and time limits."""
+        if not self.ready.is_set():
+            raise HTTPException(status_code=503, detail="Models are still loading.", headers={"Retry-After": "10"})
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Server busy, try again later.", headers={"Retry-After": "1"})
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(self._timed, fn, *args)
+        # The slot is freed when the work really ends, not when the client stops waiting,
+        # so timed-out requests cannot pile up more work than `max_concurrency`
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._slots.release))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"Request exceeded {self.request_timeout} seconds.")
+
+    @staticmethod
+    def _timed(fn: Callable, *args):
+        with metrics.span("request", handler=fn.__name__):
+            return fn(*args)
+
+    # Blocking handlers (run on the worker pool)
+
+    def detect(self, data: bytes) -> dict:
+        crops = self.cropper.detect_crops(self.decode(data))
+        return {"characters": [_crop_info(crop) for crop in crops]}
+
+    def tag(self, data: bytes, threshold: float) -> dict:
+        return self.tagger.predict_all(self.decode(data), threshold=threshold)
+
+    def attributes(self, data: bytes, topics: Optional[List[str]], context: Optional[str]) -> dict:
+        return {"attributes": self.extractor.extract_attributes(self.decode(data), topics=topics, context=context)}
+
+    def pipeline(self, data: bytes, pipeline: str, threshold: float) -> dict:
+        crops = self.cropper.detect_crops(self.decode(data))
+        if not crops:
+            return {"characters": []}
+
+        if pipeline == "1":
+            attributes = self.extractor.extract_attributes_batch(crops)
+        else:
+            from src.pipeline2 import process_characters_batch
+
+            attributes = process_characters_batch(crops, self.tagger, self.extractor, threshold=threshold)
+        return {"characters": [dict(_crop_info(crop), attributes=attrs) for crop, attrs in zip(crops, attributes)]}
+
+
+def _crop_info(crop) -> dict:
+    return {"key": crop.key, "bbox": list(crop.bbox), "score": crop.score}
+
+
+def create_app(service: Optional[InferenceService] = None) -> FastAPI:
+    """
+    Builds the FastAPI app. Every inference endpoint takes the raw image bytes as the
+    request body (any Content-Type) and returns JSON; nothing is written to disk.
+    """
+    service = service or InferenceService()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Load in the background so /health answers immediately and /ready tracks progress
+        threading.Thread(target=service.load_models, name="model-loader", daemon=True).start()
+        yield
+        service._executor.shutdown(wait=False, cancel_futures=True)
+
+    app = FastAPI(title="Who's That Character?", lifespan=lifespan)
+    app.state.service = service
+
+    async def read_image(request: Request) -> bytes:
+        declared = request.headers.get("content-length")
+        # The size is checked before reading: without a length the body would be buffered unbounded
+        if declared is None:
+            raise HTTPException(status_code=411, detail="Content-Length header required.")
+        if not declared.strip().isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Content-Length header.")
+        if int(declared) > service.max_image_bytes:
+            raise HTTPException(status_code=413, detail="Image too large.")
+        data = await request.body()
+        if not data:
+            raise HTTPException(status_code=400, detail="Empty request body, send the raw image bytes.")
+        if len(data) > service.max_image_bytes:
+            raise HTTPException(status_code=413, detail="Image too large.")
+        return data
+
+    @app.get("/health")
+    async def health():
+        """Liveness: the process is up and serving HTTP."""
+        return {"status": "ok"}
+
+    @app.get("/ready")
+    async def ready():
+        """Readiness: models are loaded and warmed up."""
+        from src.model_registry import registry
+
+        if service.ready.is_set():
+            return {"status": "ready", "models": registry.status()}
+        status = "failed" if service.load_error else "loading"
+        raise HTTPException(status_code=503, detail={"status": status, "error": service.load_error, "models": registry.status()})
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        """Counters and latency histograms in the Prometheus text format."""
+        return PlainTextResponse(metrics.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/trace")
+    async def trace():
+        """Recent spans as a Chrome-trace timeline (empty unless started with --trace)."""
+        return metrics.chrome_trace()
+
+    @app.post("/detect")
+    async def detect(request: Request):
+        """Person boxes and scores."""
+        start_time = time.time()
+        result = await service.run(service.detect, await read_image(request))
+        return dict(result, seconds=round(time.time() - start_time, 3))
+
+    @app.post("/tag")
+    async def tag(request: Request, threshold: float = 0.4):
+        """Danbooru tags by attribute bucket, for an image that is already a character crop."""
+        start_time = time.time()
+        result = await service.run(service.tag, await read_image(request), threshold)
+        return dict(result, seconds=round(time.time() - start_time, 3))
+
+    @app.post("/attributes")
+    async def attributes(request: Request, topics: Optional[List[str]] = Query(None), context: Optional[str] = None):
+        """VLM attributes for an image that is already a character crop."""
+        start_time = time.time()
+        result = await service.run(service.attributes, await read_image(request), topics, context)
+        return dict(result, seconds=round(time.time() - start_time, 3))
+
+    @app.post("/pipeline")
+    async def pipeline(request: Request, pipeline: str = Query("2", pattern="^[12]$"), threshold: float = 0.4):
+        """Full Pipeline 1 (detect -> VLM) or 2 (detect -> tag -> VLM), one entry per character."""
+        start_time = time.time()
+        result = await service.run(service.pipeline, await read_image(request), pipeline, threshold)
+        return dict(result, seconds=round(time.time() - start_time, 3))
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="HTTP inference service for the character pipelines.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-concurrency", type=int, default=4, help="Requests processed at the same time")
+    parser.add_argument("--request-timeout", type=float, default=120.0, help="Seconds before a request gets 504")
+    parser.add_argument("--queue-timeout", type=float, default=5.0, help="Seconds a request may wait for a slot before 503")
+    parser.add_argument("--max-image-mb", type=float, default=20, help="Largest accepted upload")
+    parser.add_argument("--max-image-megapixels", type=float, default=40, help="Largest accepted decoded image size")
+    parser.add_argument("--model-name", default="blip2_t5")
+    parser.add_argument("--model-type", default="pretrain_flant5xl")
+    parser.add_argument("--no-warm-up", action="store_true", help="Report ready without a warm-up inference")
+    parser.add_argument("--no-metrics", action="store_true", help="Do not record metrics (/metrics stays empty)")
+    parser.add_argument("--trace", action="store_true", help="Keep a timeline of recent spans, served at /trace")
+    args = parser.parse_args(argv)
+
+    if not args.no_metrics:
+        metrics.enable(tracing=args.trace)
+
+    service = InferenceService(
+        max_concurrency=args.max_concurrency,
+        request_timeout=args.request_timeout,
+        queue_timeout=args.queue_timeout,
+        max_image_mb=args.max_image_mb,
+        max_image_megapixels=args.max_image_megapixels,
+        model_name=args.model_name,
+        model_type=args.model_type,
+        warm_up=not args.no_warm_up,
+    )
+    # One process: the models are shared by all requests, parallelism comes from the batchers
+    uvicorn.run(create_app(service), host=args.host, port=args.port, workers=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NullSpan:
+    """What `span` returns while instrumentation is off: entering and leaving it does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, metrics: "Instrumentation", name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.metrics.observe(f"{self.name}_seconds", end - self.start, **self.labels)
+        if self.metrics.tracing:
+            self.metrics._trace_event(self.name, self.start, end, self.labels)
+        return False
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one: above every bound (+Inf)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class Instrumentation:
+    def __init__(self, enabled: bool = False, tracing: bool = False, prefix: str = "character_pipeline", max_trace_events: int = 100_000):
+        """
+        Process-wide counters, latency histograms and (optionally) a Chrome-trace timeline.
+
+        Off by default. While off, `span` returns a shared no-op context manager and
+        `count` / `observe` return after one attribute check, so instrumented code pays
+        next to nothing. Spans record their duration in the `<name>_seconds` histogram,
+        and with tracing on also as a complete event of the timeline (chrome://tracing,
+        Perfetto).
+
+        Args:
+            enabled (bool): Record counters and histograms.
+            tracing (bool): Also keep timeline events (implies `enabled`).
+            prefix (str): Prefix of every exported metric name.
+            max_trace_events (int): Newest timeline events kept (bounded memory).
+        """
+        self.enabled = enabled or tracing
+        self.tracing = tracing
+        self.prefix = prefix
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, _Histogram]] = {}
+        self._events = deque(maxlen=max_trace_events)
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self, tracing: bool = False):
+        self.enabled = True
+        self.tracing = self.tracing or tracing
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._events.clear()
+
+    # Recording
+
+    def span(self, name: str, **labels):
+        """Times a block: `with metrics.span("detect"): ...` (a no-op while disabled)."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Adds `value` to the counter `<name>_total`."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        """Adds one observation to the histogram `name`."""
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(buckets)
+            series[key].observe(value)
+
+    def _trace_event(self, name: str, start: float, end: float, labels: dict):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - self._origin) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {key: str(value) for key, value in labels.items()},
+        }
+        with self._lock:
+            self._events.append(event)
+
+    # Export
+
+    def prometheus_text(self) -> str:
+        """All counters and histograms in the Prometheus text exposition format (0.0.4)."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+
+            for name, series in sorted(self._histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{metric}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def chrome_trace(self) -> dict:
+        """The timeline in the Chrome trace-event format (load in chrome://tracing or ui.perfetto.dev)."""
+        with self._lock:
+            return {"traceEvents": list(self._events), "displayTimeUnit": "ms"}
+
+    def save_prometheus(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+
+    def save_trace(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+# Shared by every instrumented module; switched on with PIPELINE_METRICS=1 / PIPELINE_TRACE=1 or `metrics.enable()`
+metrics = Instrumentation(enabled=_env_flag("PIPELINE_METRICS"), tracing=_env_flag("PIPELINE_TRACE"))
@@ -0,0 +1,183 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Union
+
+import numpy as np
+
+from src.attributes import ATTRIBUTE_QUESTIONS
+
+_STOP = object()
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn: Callable[[list], list], max_batch_size: int = 16, max_wait_ms: float = 20.0, name: str = "micro-batcher"):
+        """
+        Dynamic batching of single-item requests coming from concurrent callers.
+
+        A background thread takes the first pending item, then keeps collecting until
+        `max_batch_size` items are pending or `max_wait_ms` has passed since that first
+        item, runs `batch_fn` once on the whole batch and hands every caller its own
+        result. A lone request therefore waits at most `max_wait_ms` extra, while bursts
+        are served with full batches. Only this thread calls the model, so the model
+        never runs concurrently with itself.
+
+        Args:
+            batch_fn (Callable[[list], list]): Maps a list of items to a list of results (same order).
+            max_batch_size (int): Largest batch handed to `batch_fn`.
+            max_wait_ms (float): Longest time the first item of a batch waits for company.
+            name (str): Name of the worker thread.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        """Queues one item; the returned future resolves to its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items: list, timeout: Optional[float] = None) -> list:
+        """Queues several items at once (they can share a batch) and waits for all results."""
+        futures = [self.submit(item) for item in items]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def _collect(self, first) -> tuple:
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Items already queued are taken without waiting, even past the deadline
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch, stopping = self._collect(entry)
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            self.busy_seconds += time.perf_counter() - start_time
+            self.batches += 1
+            self.items += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "pending": self._queue.qsize(),
+        }
+
+    def close(self):
+        """Stops the worker thread once the items queued so far are processed."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+class BatchedTagger:
+    def __init__(self, tagger, max_batch_size: int = 16, max_wait_ms: float = 20.0):
+        """
+        `DanbooruTagger` front-end that merges crops from concurrent requests into shared
+        forward passes. Thresholding stays per caller, so requests with different
+        thresholds can still share a batch.
+
+        Args:
+            tagger (DanbooruTagger): The shared tagger.
+            max_batch_size (int): Largest number of crops per forward pass.
+            max_wait_ms (float): Longest time a crop waits for others to join its batch.
+        """
+        self.tagger = tagger
+        self.batcher = MicroBatcher(
+            lambda images: list(tagger.predict_probs_batch(images, batch_size=max_batch_size)),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            name="tagger-batcher",
+        )
+
+    def predict_probs_batch(self, images: list, **kwargs) -> np.ndarray:
+        if not images:
+            return np.zeros((0, len(self.tagger.labels)))
+        return np.stack(self.batcher.map(images))
+
+    def predict_batch(self, images: list, threshold: float = 0.5, **kwargs) -> List[dict]:
+        """Same contract as `DanbooruTagger.predict_batch`."""
+        return [self.tagger._postprocess(probs, threshold) for probs in self.predict_probs_batch(images)]
+
+    def predict_all(self, image, threshold: float = 0.5) -> dict:
+        """Same contract as `DanbooruTagger.predict_all`."""
+        return self.predict_batch([image], threshold=threshold)[0]
+
+
+class BatchedExtractor:
+    def __init__(self, extractor, max_batch_size: int = 8, max_wait_ms: float = 20.0):
+        """
+        `CharacterAttributeExtractor` front-end that merges crops (with their own topics
+        and context) from concurrent requests into one `extract_attributes_batch` call.
+
+        Args:
+            extractor (CharacterAttributeExtractor): The shared extractor.
+            max_batch_size (int): Largest number of crops per batch (each crop adds up to
+                one prompt per attribute question).
+            max_wait_ms (float): Longest time a crop waits for others to join its batch.
+        """
+        self.extractor = extractor
+        self.batcher = MicroBatcher(
+            self._run, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name="vlm-batcher"
+        )
+
+    def _run(self, items: list) -> List[dict]:
+        images, topics, contexts = zip(*items)
+        # Spell out "all topics" so every crop carries its own topic list
+        topics = [list(image_topics) if image_topics else list(ATTRIBUTE_QUESTIONS) for image_topics in topics]
+        return self.extractor.extract_attributes_batch(list(images), topics=topics, context=list(contexts))
+
+    def extract_attributes(self, image, topics: Optional[List[str]] = None, context: Optional[str] = None) -> dict:
+        """Same contract as `CharacterAttributeExtractor.extract_attributes`."""
+        return self.batcher.submit((image, topics, context)).result()
+
+    def extract_attributes_batch(
+        self,
+        images: list,
+        topics: Optional[Union[List[str], List[List[str]]]] = None,
+        context: Optional[Union[str, List[Optional[str]]]] = None,
+    ) -> List[dict]:
+        """Same contract as `CharacterAttributeExtractor.extract_attributes_batch`."""
+        if topics and isinstance(topics[0], (list, tuple)):
+            per_image_topics = list(topics)
+        else:
+            per_image_topics = [topics] * len(images)
+        if isinstance(context, (list, tuple)):
+            per_image_context = list(context)
+        else:
+            per_image_context = [context] * len(images)
+        return self.batcher.map(list(zip(images, per_image_topics, per_image_context)))
@@ -0,0 +1,263 @@
+import copy
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Process-wide store of model instances, so every app and pipeline module shares
+        one copy of each model instead of loading its own.
+
+        Models are registered as factories and built lazily on first `get`, or eagerly
+        with `warm_up`, which also runs one dummy inference so the first real request
+        does not pay for lazy initialisation (graph building, allocator growth, ...).
+        """
+        self._factories: Dict[str, Callable] = {}
+        self._warmups: Dict[str, Optional[Callable]] = {}
+        self._models: Dict[str, object] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._warmed_up = set()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._factories
+
+    def register(self, name: str, factory: Callable, warmup: Optional[Callable] = None):
+        """
+        Registers how to build a model.
+
+        Args:
+            name (str): Registry key.
+            factory (Callable): Builds the model, called once on first use.
+            warmup (Optional[Callable]): Runs a dummy inference on the built model.
+        """
+        with self._lock:
+            if name in self._models:
+                raise ValueError(f"Model '{name}' is already loaded and cannot be re-registered.")
+            self._factories[name] = factory
+            self._warmups[name] = warmup
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str):
+        """Returns the model, building it on first use (concurrent callers wait for one load)."""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        if name not in self._factories:
+            raise KeyError(f"Unknown model '{name}'. Registered: {', '.join(self._factories) or 'none'}.")
+
+        with self._load_locks[name]:
+            if name not in self._models:
+                start_time = time.time()
+                self._models[name] = self._factories[name]()
+                self._load_seconds[name] = time.time() - start_time
+                print(f"Loaded {name} in {self._load_seconds[name]:.1f} seconds.")
+        return self._models[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def warm_up(self, names: Optional[List[str]] = None):
+        """Loads the given models (default: all registered) and runs their warm-up inference."""
+        for name in names if names is not None else list(self._factories):
+            model = self.get(name)
+            warmup = self._warmups.get(name)
+            if warmup is not None and name not in self._warmed_up:
+                start_time = time.time()
+                warmup(model)
+                self._warmed_up.add(name)
+                print(f"Warmed up {name} in {time.time() - start_time:.1f} seconds.")
+
+    def unload(self, name: str):
+        """Drops the shared instance; the next `get` builds a new one."""
+        with self._load_locks[name]:
+            self._models.pop(name, None)
+            self._warmed_up.discard(name)
+
+    def status(self) -> Dict[str, dict]:
+        """Load state of every registered model."""
+        return {
+            name: {
+                "loaded": name in self._models,
+                "warmed_up": name in self._warmed_up,
+                "load_seconds": round(self._load_seconds[name], 2) if name in self._load_seconds else None,
+            }
+            for name in self._factories
+        }
+
+
+registry = ModelRegistry()
+
+
+def _blank_image(size: int = 256):
+    from PIL import Image
+    return Image.new("RGB", (size, size), (255, 255, 255))
+
+
+def _warm_up_cropper(cropper):
+    cropper.warm_up()
+
+
+def _warm_up_tagger(tagger):
+    # Bypasses the result cache so the dummy image does not end up in it
+    tagger._predict_probs_uncached([_blank_image()], batch_size=1, num_workers=1)
+
+
+def _warm_up_extractor(extractor):
+    from src.attributes import ATTRIBUTE_QUESTIONS
+
+    prompt = extractor._build_prompt(ATTRIBUTE_QUESTIONS["Hair Color"], None)
+    extractor._generate(extractor.encode_images([_blank_image()]), [prompt])
+
+
+def _registry_name(kind: str, *args, **kwargs) -> str:
+    parts = [str(arg) for arg in args] + [f"{key}={value}" for key, value in sorted(kwargs.items())]
+    return f"{kind}:{'/'.join(parts)}" if parts else kind
+
+
+def _cache_suffix(result_cache) -> str:
+    # The registry keeps the cache alive, so its id is not reused while the entry exists
+    return "" if result_cache is None else f"+cache={id(result_cache)}"
+
+
+def _with_result_cache(name: str, result_cache):
+    """
+    The shared model `name`, or (once per cache) a shallow copy of it that uses `result_cache`.
+    The copy shares the loaded weights; only the cache and the call counters are its own,
+    so callers with different caches, or none, never see each other's entries.
+    """
+    if result_cache is None:
+        return registry.get(name)
+    cached_name = name + _cache_suffix(result_cache)
+
+    def build():
+        model = copy.copy(registry.get(name))
+        model.result_cache = result_cache
+        return model
+
+    if cached_name not in registry:
+        registry.register(cached_name, build)
+    return registry.get(cached_name)
+
+
+def get_result_cache(path: str = "cache/results.sqlite", **kwargs):
+    """
+    Shared `ResultCache` for a file, so apps in one process reuse one connection (and the
+    models attached to it, see `_with_result_cache`). Cached results survive restarts.
+
+    Args:
+        path (str): SQLite file.
+        **kwargs: Forwarded to `ResultCache` (e.g. `max_mb`).
+    """
+    name = _registry_name("result-cache", path, **kwargs)
+
+    def build():
+        from src.result_cache import ResultCache
+        return ResultCache(path, **kwargs)
+
+    if name not in registry:
+        registry.register(name, build)
+    return registry.get(name)
+
+
+def get_cropper(**kwargs):
+    """
+    Shared `PersonCropper` for its settings (one instance per combination).
+
+    Args:
+        **kwargs: Forwarded to `PersonCropper` (e.g. `level="auto"`).
+    """
+    name = _registry_name("cropper", **kwargs)
+
+    def build():
+        from src.char_detection import PersonCropper
+        return PersonCropper(**kwargs)
+
+    if name not in registry:
+        registry.register(name, build, _warm_up_cropper)
+    return registry.get(name)
+
+
+def get_tagger(backend: str = "keras", result_cache=None, **kwargs):
+    """
+    Shared `DanbooruTagger` for a backend and its settings (one instance per combination).
+
+    Args:
+        backend (str): Tagger backend name (see `src.tagger_backends`).
+        result_cache (Optional[ResultCache]): Cache of probability vectors; the model is shared,
+            the cache is not (see `_with_result_cache`).
+        **kwargs: Forwarded to `DanbooruTagger`.
+    """
+    name = _registry_name("tagger", backend, **kwargs)
+
+    def build():
+        from src.deepdanbooru_tagger import DanbooruTagger
+        return DanbooruTagger(backend=backend, **kwargs)
+
+    if name not in registry:
+        registry.register(name, build, _warm_up_tagger)
+    return _with_result_cache(name, result_cache)
+
+
+def get_extractor(model_name: str = "blip2_t5", model_type: str = "pretrain_flant5xl", result_cache=None, **kwargs):
+    """
+    Shared `CharacterAttributeExtractor` for a BLIP-2 variant and its settings.
+
+    Args:
+        model_name (str): LAVIS model name, e.g. "blip2_t5" or "blip2_opt".
+        model_type (str): LAVIS model type, e.g. "pretrain_flant5xl" or "pretrain_opt2.7b".
+        result_cache (Optional[ResultCache]): Cache of VLM answers; the model is shared,
+            the cache is not (see `_with_result_cache`).
+        **kwargs: Forwarded to `CharacterAttributeExtractor`.
+    """
+    name = _registry_name("extractor", model_name, model_type, **kwargs)
+
+    def build():
+        from src.vlm_blip3 import CharacterAttributeExtractor
+        return CharacterAttributeExtractor(model_name=model_name, model_type=model_type, **kwargs)
+
+    if name not in registry:
+        registry.register(name, build, _warm_up_extractor)
+    return _with_result_cache(name, result_cache)
+
+
+def get_batched_tagger(backend: str = "keras", max_batch_size: int = 16, max_wait_ms: float = 20.0, result_cache=None, **kwargs):
+    """Shared `BatchedTagger` (dynamic micro-batching across concurrent callers) over `get_tagger(...)`."""
+    name = _registry_name("batched-tagger", backend, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, **kwargs)
+    name += _cache_suffix(result_cache)
+
+    def build():
+        from src.micro_batching import BatchedTagger
+        tagger = get_tagger(backend, result_cache=result_cache, **kwargs)
+        return BatchedTagger(tagger, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    if name not in registry:
+        registry.register(name, build)
+    return registry.get(name)
+
+
+def get_batched_extractor(
+    model_name: str = "blip2_t5",
+    model_type: str = "pretrain_flant5xl",
+    max_batch_size: int = 8,
+    max_wait_ms: float = 20.0,
+    result_cache=None,
+    **kwargs,
+):
+    """Shared `BatchedExtractor` (dynamic micro-batching across concurrent callers) over `get_extractor(...)`."""
+    name = _registry_name(
+        "batched-extractor", model_name, model_type, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, **kwargs
+    )
+    name += _cache_suffix(result_cache)
+
+    def build():
+        from src.micro_batching import BatchedExtractor
+        extractor = get_extractor(model_name, model_type, result_cache=result_cache, **kwargs)
+        return BatchedExtractor(extractor, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    if name not in registry:
+        registry.register(name, build)
+    return registry.get(name)
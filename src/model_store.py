@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+
+class ModelNotAvailableError(FileNotFoundError):
+    """A model file is missing from the store and the store may not download it."""
+
+
+def _file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class ModelStore:
+    def __init__(self, root: Optional[str] = None, offline: Optional[bool] = None):
+        """
+        Local, versioned store of model files, filled ahead of time with
+        `python -m utils.fetch_models` and read without network at serving time.
+
+        Layout:
+            <root>/<name>/<version>/<files>         one directory per version
+            <root>/<name>/<version>/manifest.json   size and sha256 of every file, source
+            <root>/<name>/CURRENT                   version used when none is asked for
+            <root>/huggingface, <root>/torch        HF_HOME / TORCH_HOME of the libraries
+                                                    that download by themselves (LAVIS,
+                                                    transformers, imgutils)
+
+        The store is opt-in: without an explicit `root` or $MODEL_STORE_DIR it is disabled,
+        creates no directory and leaves HF_HOME / TORCH_HOME alone, so models are read from
+        (and downloaded to) the usual Hugging Face and torch caches.
+
+        In offline mode nothing is ever downloaded: a missing file raises
+        `ModelNotAvailableError`, and the Hugging Face libraries are put in offline mode
+        too, so a node without network fails fast instead of hanging on retries.
+
+        Args:
+            root (Optional[str]): Store directory (default: $MODEL_STORE_DIR; disabled if neither is set).
+            offline (Optional[bool]): Strict offline mode (default: $MODEL_STORE_OFFLINE).
+        """
+        root = root or os.environ.get("MODEL_STORE_DIR")
+        self.enabled = bool(root)
+        self.root = os.path.abspath(root) if root else None
+        self.offline = _env_flag("MODEL_STORE_OFFLINE") if offline is None else offline
+        if self.enabled:
+            os.makedirs(self.root, exist_ok=True)
+        self.configure_environment()
+
+    def configure_environment(self):
+        """
+        Points the Hugging Face and torch.hub caches into the store, if it is enabled (and
+        switches them offline in offline mode). Must run before transformers /
+        huggingface_hub are imported, which read these variables once at import.
+        """
+        if self.enabled:
+            os.environ.setdefault("HF_HOME", os.path.join(self.root, "huggingface"))
+            os.environ.setdefault("TORCH_HOME", os.path.join(self.root, "torch"))
+        if self.offline:
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    # Versions
+
+    def _name_dir(self, name: str) -> str:
+        if not self.enabled:
+            raise ModelNotAvailableError("The model store is disabled: set $MODEL_STORE_DIR to use one.")
+        return os.path.join(self.root, name.replace("/", "--"))
+
+    def versions(self, name: str) -> List[str]:
+        """Installed versions of a model, oldest first."""
+        if not self.enabled:
+            return []
+        name_dir = self._name_dir(name)
+        if not os.path.isdir(name_dir):
+            return []
+        versions = [v for v in os.listdir(name_dir) if os.path.isfile(os.path.join(name_dir, v, "manifest.json"))]
+        return sorted(versions, key=lambda v: self.manifest(name, v).get("installed_at", 0))
+
+    def current_version(self, name: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            with open(os.path.join(self._name_dir(name), "CURRENT"), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def activate(self, name: str, version: str):
+        """Makes `version` the one used when no version is asked for (atomic switch)."""
+        if version not in self.versions(name):
+            raise ModelNotAvailableError(f"{name}@{version} is not installed in {self.root}.")
+        current = os.path.join(self._name_dir(name), "CURRENT")
+        with open(current + ".tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(current + ".tmp", current)
+
+    def manifest(self, name: str, version: str) -> dict:
+        if not self.enabled:
+            return {}
+        try:
+            with open(os.path.join(self._name_dir(name), version, "manifest.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # Files
+
+    def find(self, name: str, filename: str, version: Optional[str] = None) -> Optional[str]:
+        """Local path of a stored file, or None (never downloads)."""
+        version = version or self.current_version(name)
+        if version is None or not self.enabled:
+            return None
+        path = os.path.join(self._name_dir(name), version, filename)
+        return path if os.path.isfile(path) else None
+
+    def path(self, name: str, filename: str, version: Optional[str] = None) -> str:
+        """Local path of a stored file; raises `ModelNotAvailableError` if it is missing."""
+        path = self.find(name, filename, version)
+        if path is None:
+            raise ModelNotAvailableError(
+                f"{name}/{filename} ({version or 'current version'}) is not in the model store {self.root}. "
+                "Fill it with `python -m utils.fetch_models` on a machine with network."
+            )
+        return path
+
+    def install(self, name: str, version: str, files: Dict[str, str], source: Optional[str] = None, activate: bool = True) -> str:
+        """
+        Copies files into `<name>/<version>` and records them in its manifest. Files are
+        copied to a temporary name first, so readers never see a half-written file.
+
+        Args:
+            name (str): Model name (e.g. a Hugging Face repo id).
+            version (str): Version label (e.g. a commit hash or a date).
+            files (Dict[str, str]): Stored file name -> local source path.
+            source (Optional[str]): Where the files came from, kept in the manifest.
+            activate (bool): Make this the current version.
+
+        Returns:
+            str: The version directory.
+        """
+        version_dir = os.path.join(self._name_dir(name), version)
+        os.makedirs(version_dir, exist_ok=True)
+        manifest = self.manifest(name, version) or {"name": name, "version": version, "files": {}}
+        for filename, source_path in files.items():
+            target = os.path.join(version_dir, filename)
+            fd, tmp_path = tempfile.mkstemp(dir=version_dir, prefix=".tmp-")
+            os.close(fd)
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, target)
+            manifest["files"][filename] = {"size": os.path.getsize(target), "sha256": _file_sha256(target)}
+        if source:
+            manifest["source"] = source
+        manifest["installed_at"] = time.time()
+
+        with open(os.path.join(version_dir, "manifest.json.tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(os.path.join(version_dir, "manifest.json.tmp"), os.path.join(version_dir, "manifest.json"))
+        if activate or self.current_version(name) is None:
+            self.activate(name, version)
+        return version_dir
+
+    def verify(self, name: str, version: Optional[str] = None) -> List[str]:
+        """Files of a version that are missing or do not match their manifest checksum."""
+        version = version or self.current_version(name)
+        files = self.manifest(name, version).get("files", {}) if version else {}
+        bad = []
+        for filename, entry in files.items():
+            path = os.path.join(self._name_dir(name), version, filename)
+            if not os.path.isfile(path) or os.path.getsize(path) != entry["size"] or _file_sha256(path) != entry["sha256"]:
+                bad.append(filename)
+        return bad
+
+    def hf_file(self, repo_id: str, filename: str, revision: Optional[str] = None) -> str:
+        """
+        Drop-in for `huggingface_hub.hf_hub_download`: served from the store, downloaded
+        into it on a miss (versioned by the repo commit), unless the store is offline.
+        A disabled store passes the call through to the Hugging Face cache.
+        """
+        path = self.find(repo_id, filename, revision)
+        if path is not None:
+            return path
+        if self.offline and self.enabled:
+            return self.path(repo_id, filename, revision)
+
+        import huggingface_hub
+
+        if not self.enabled:
+            return huggingface_hub.hf_hub_download(repo_id, filename, revision=revision)
+        downloaded = huggingface_hub.hf_hub_download(repo_id, filename, revision=revision)
+        # Cached downloads live in .../snapshots/<commit>/<filename>
+        commit = os.path.basename(os.path.dirname(downloaded))
+        version_dir = self.install(repo_id, revision or commit, {filename: downloaded}, source=f"hf://{repo_id}@{commit}")
+        return os.path.join(version_dir, filename)
+
+    def status(self) -> Dict[str, dict]:
+        """Per stored model: current version and installed versions."""
+        status = {}
+        if not self.enabled:
+            return status
+        for entry in sorted(os.listdir(self.root)):
+            if os.path.isfile(os.path.join(self.root, entry, "CURRENT")):
+                name = self.manifest(entry, self.current_version(entry)).get("name", entry)
+                status[name] = {"current": self.current_version(name), "versions": self.versions(name)}
+        return status
+
+
+# Weights
+
+def load_state_dict(path: str, device: str = "cpu") -> dict:
+    """
+    Loads a torch state dict memory-mapped: safetensors files (and zip-format torch
+    checkpoints) are paged in on access instead of being deserialized up front. The
+    tensors stay memory-mapped only if the caller keeps them, e.g. with
+    `model.load_state_dict(state_dict, assign=True)`; a plain `load_state_dict` copies them.
+    """
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device=device)
+
+    import torch
+
+    try:
+        checkpoint = torch.load(path, map_location=device, mmap=True, weights_only=True)
+    except Exception:
+        # Legacy (non-zip) checkpoints cannot be memory-mapped, and some pickle more than tensors
+        checkpoint = torch.load(path, map_location=device, weights_only=False)
+    return checkpoint.get("model", checkpoint) if isinstance(checkpoint, dict) else checkpoint
+
+
+def save_safetensors(state_dict: dict, target_path: str) -> str:
+    """Writes a state dict as safetensors (with the "pt" format tag transformers checks for)."""
+    from safetensors.torch import save_file
+
+    # safetensors refuses tensors sharing storage: store each one on its own
+    save_file({key: tensor.contiguous().clone() for key, tensor in state_dict.items()}, target_path, metadata={"format": "pt"})
+    return target_path
+
+
+def convert_to_safetensors(source_path: str, target_path: str) -> str:
+    """Converts a torch checkpoint (optionally wrapped in {"model": ...}) to safetensors."""
+    return save_safetensors(load_state_dict(source_path), target_path)
+
+
+store: Optional[ModelStore] = None
+
+
+def get_store() -> ModelStore:
+    """Process-wide store, created on first use from $MODEL_STORE_DIR / $MODEL_STORE_OFFLINE (disabled without $MODEL_STORE_DIR)."""
+    global store
+    if store is None:
+        store = ModelStore()
+    return store
+
+
+def set_store(model_store: ModelStore) -> ModelStore:
+    """Replaces the process-wide store (call before any model is built)."""
+    global store
+    store = model_store
+    return store
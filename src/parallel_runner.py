@@ -0,0 +1,202 @@
+import itertools
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Set in each worker process by `_init_worker`
+_PIPELINE_FN = None
+_BATCH_FN = None
+_VLM_COUNTER = None
+
+
+def _init_worker(
+    pipeline: str,
+    num_threads: int,
+    cache_path: Optional[str] = None,
+    cache_mb: float = 2048,
+    config: Optional[dict] = None,
+    dedup_path: Optional[str] = None,
+    dedup_distance: int = 6,
+):
+    """Pins the thread pools of this worker, then loads its own copy of the models."""
+    global _PIPELINE_FN, _BATCH_FN, _VLM_COUNTER
+
+    # Must be set before torch / TensorFlow / ONNX Runtime are imported in this process
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[var] = str(num_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    import torch
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    from src.batch_runner import pipeline_module, load_pipeline
+    # Workers share one cache file and one crop index (SQLite WAL), each through its own connection
+    _PIPELINE_FN = load_pipeline(
+        pipeline, cache_path=cache_path, cache_mb=cache_mb, config=config, dedup_path=dedup_path, dedup_distance=dedup_distance
+    )
+    _BATCH_FN = pipeline_module(pipeline).extract_character_attributes_batch
+    _VLM_COUNTER = pipeline_module(pipeline).vlm_calls
+
+
+def _process_shard(shard: List[Tuple[int, str]], crops_root: Optional[str]) -> List[Tuple[int, dict]]:
+    """Runs one shard of (sequence number, path) pairs inside a worker, as one detector / tagger batch."""
+    from src.batch_runner import process_images
+    records = process_images(
+        _BATCH_FN, [path for _, path in shard], crops_root, vlm_counter=_VLM_COUNTER, pipeline_fn=_PIPELINE_FN
+    )
+    return [(seq, record) for (seq, _), record in zip(shard, records)]
+
+
+class ParallelRunner:
+    def __init__(
+        self,
+        pipeline: str = "2",
+        num_workers: int = 4,
+        threads_per_worker: Optional[int] = None,
+        shard_size: int = 8,
+        max_retries: int = 2,
+        max_tasks_per_worker: Optional[int] = None,
+        crops_root: Optional[str] = None,
+        cache_path: Optional[str] = None,
+        cache_mb: float = 2048,
+        config: Optional[dict] = None,
+        dedup_path: Optional[str] = None,
+        dedup_distance: int = 6,
+    ):
+        """
+        Data-parallel execution of a pipeline over a process pool, for CPU-only nodes.
+
+        Each worker loads its own tagger / VLM instances and uses `threads_per_worker`
+        intra-op threads. Inputs are sharded lazily, results are merged back in input
+        order. If a worker dies (OOM kill, segfault), the pool is restarted and the
+        unfinished shards are rerun one at a time, so that a crash can be attributed to a
+        single shard; a shard that keeps crashing on its own is split into single images,
+        and an image that still crashes gets an error record instead of taking the batch
+        down. Shards that were only in flight next to the culprit are never failed.
+
+        Args:
+            pipeline (str): "1" or "2".
+            num_workers (int): Worker processes.
+            threads_per_worker (Optional[int]): Intra-op threads per worker (default: cores / workers).
+            shard_size (int): Images sent to a worker per task.
+            max_retries (int): Crashes tolerated per shard before it is split / failed.
+            max_tasks_per_worker (Optional[int]): Recycle a worker after this many shards.
+            crops_root (Optional[str]): If given, crops are also saved under one directory per image.
+            cache_path (Optional[str]): SQLite result cache shared by all workers.
+            cache_mb (float): Result cache size budget.
+            config (Optional[dict]): Pipeline settings for every worker (see the pipeline's `configure`).
+            dedup_path (Optional[str]): Near-duplicate crop index shared by all workers.
+            dedup_distance (int): Largest Hamming distance counted as a duplicate.
+        """
+        self.pipeline = pipeline
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self.shard_size = shard_size
+        self.max_retries = max_retries
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.crops_root = crops_root
+        self.cache_path = cache_path
+        self.cache_mb = cache_mb
+        self.config = config
+        self.dedup_path = dedup_path
+        self.dedup_distance = dedup_distance
+        self.max_in_flight = num_workers * 2
+        self.restarts = 0
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                self.pipeline, self.threads_per_worker, self.cache_path, self.cache_mb, self.config,
+                self.dedup_path, self.dedup_distance,
+            ),
+            max_tasks_per_child=self.max_tasks_per_worker,
+        )
+
+    def _iter_shards(self, paths: Iterable[str]) -> Iterator[List[Tuple[int, str]]]:
+        numbered = enumerate(paths)
+        while True:
+            shard = list(itertools.islice(numbered, self.shard_size))
+            if not shard:
+                return
+            yield shard
+
+    def process_records(self, paths: Iterable[str]) -> Iterator[dict]:
+        """Turns paths into batch-runner records, in input order (see `run_batch(process_records=...)`)."""
+        shards = self._iter_shards(paths)
+        # Shards in flight when a worker died: any of them may be the culprit, so they are rerun
+        # one at a time, and a crash only counts against a shard that was running alone
+        isolated = deque()
+        attempts: Dict[Tuple[int, int], int] = {}  # (first sequence number, size) of a shard -> crashes seen alone
+        results: Dict[int, dict] = {}
+        pending = {}
+        next_seq = 0
+        exhausted = False
+
+        pool = self._new_pool()
+        try:
+            while True:
+                if isolated:
+                    if not pending:
+                        shard = isolated.popleft()
+                        pending[pool.submit(_process_shard, shard, self.crops_root)] = shard
+                else:
+                    # Keep every worker busy, without reading the whole input list up front
+                    while not exhausted and len(pending) < self.max_in_flight:
+                        shard = next(shards, None)
+                        if shard is None:
+                            exhausted = True
+                            break
+                        pending[pool.submit(_process_shard, shard, self.crops_root)] = shard
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                crashed = []
+                for future in done:
+                    shard = pending.pop(future)
+                    try:
+                        for seq, record in future.result():
+                            results[seq] = record
+                    except BrokenProcessPool:
+                        crashed.append(shard)
+                    except Exception as e:
+                        for seq, path in shard:
+                            results[seq] = {"input": path, "error": repr(e)}
+
+                if crashed:
+                    # A dead worker breaks the whole pool: every in-flight shard has to be redone
+                    crashed.extend(pending.values())
+                    pending.clear()
+                    pool.shutdown(wait=True, cancel_futures=True)
+                    pool = self._new_pool()
+                    self.restarts += 1
+                    print(f"Warning: worker crashed, restarted the pool ({self.restarts} restarts so far).")
+
+                    if len(crashed) > 1:
+                        isolated.extend(crashed)
+                    else:
+                        shard = crashed[0]
+                        key = (shard[0][0], len(shard))
+                        attempts[key] = attempts.get(key, 0) + 1
+                        if attempts[key] <= self.max_retries:
+                            isolated.appendleft(shard)
+                        elif len(shard) > 1:
+                            # Isolate the culprit: retry every image of the shard on its own
+                            isolated.extendleft([item] for item in reversed(shard))
+                        else:
+                            seq, path = shard[0]
+                            results[seq] = {"input": path, "error": "worker process crashed"}
+
+                while next_seq in results:
+                    yield results.pop(next_seq)
+                    next_seq += 1
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -1,41 +1,156 @@
-from src.char_detection import PersonCropper
-from src.vlm_blip3 import CharacterAttributeExtractor
-
-cropper = PersonCropper()
-extractor = CharacterAttributeExtractor(
-        model_name="blip2_t5",
-        model_type="pretrain_flant5xl"
-    )
+import json
+
+from src.model_registry import get_cropper, get_extractor
+
+result_cache = None
+crop_index = None
+# `PersonCropper` / `CharacterAttributeExtractor` settings (see `configure`)
+cropper_config = {}
+extractor_config = {"model_name": "blip2_t5", "model_type": "pretrain_flant5xl"}
+
+
+def _cropper():
+    return get_cropper(**cropper_config)
+
+
+def _extractor():
+    return get_extractor(result_cache=result_cache, **extractor_config)
+
+
+def __getattr__(name):
+    # `pipeline.cropper` / `pipeline.extractor` are built on first access, not at import,
+    # and are shared with every other user of the same models in this process
+    if name == "cropper":
+        return _cropper()
+    if name == "extractor":
+        return _extractor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def enable_result_cache(cache):
+    """
+    Attaches a `ResultCache` to this pipeline: whole-image results are cached here,
+    VLM answers by the extractor (attached whenever the extractor is fetched).
+    """
+    global result_cache
+    result_cache = cache
+
+
+def enable_crop_dedup(index):
+    """
+    Attaches a `CropIndex`: crops that are near-duplicates of crops processed before
+    (re-posts, resized copies, variant frames) reuse their attributes instead of
+    going through the models again.
+    """
+    global crop_index
+    crop_index = index
+
+
+def _settings_key() -> str:
+    # Cached and reused results must come from the same pipeline and effective model
+    # settings (defaults included, not only what `configure` overrode)
+    return json.dumps(["pipeline1", _extractor().settings()], sort_keys=True, default=str)
+
+
+def configure(extractor=None, cropper=None):
+    """
+    Overrides the extractor settings of this pipeline, e.g. `{"answer_mode": "score"}`
+    or `{"model_name": "blip2_opt", "model_type": "pretrain_opt2.7b"}`, and the
+    `PersonCropper` settings, e.g. `{"level": "auto"}`. Takes effect for the next image
+    (the registry builds one model per distinct setting).
+    """
+    if extractor:
+        extractor_config.update(extractor)
+    if cropper:
+        cropper_config.update(cropper)
+
+
+def vlm_calls() -> int:
+    """Questions the extractor of this pipeline has run through the VLM in this process."""
+    return _extractor().vlm_calls
+
+
+def attributes_for_crops(crops):
+    """
+    Attributes of character crops (from any source, e.g. video tracks). Near-duplicates of
+    crops processed before reuse their attributes; the others share batched VLM passes.
+
+    Args:
+        crops (List[PersonCrop]): Character crops
+
+    Returns:
+        List[dict]: Attributes of every crop, in order
+    """
+    extractor = _extractor()
+    attributes, fingerprints = [None] * len(crops), [None] * len(crops)
+    if crop_index is not None:
+        namespace = _settings_key()
+        for j, crop in enumerate(crops):
+            fingerprints[j] = crop_index.fingerprint(crop)
+            attributes[j] = crop_index.lookup(fingerprints[j], namespace)
+    todo = [j for j, attrs in enumerate(attributes) if attrs is None]
+
+    new_attributes = extractor.extract_attributes_batch([crops[j] for j in todo]) if todo else []
+    for j, attrs in zip(todo, new_attributes):
+        attributes[j] = attrs
+        if crop_index is not None:
+            crop_index.add(fingerprints[j], attrs, namespace)
+    return attributes
+
+
 def extract_character_attributes_pipeline(image_path, output_dir="cropped_persons"):
     """
     Pipeline that extracts characters from an image and then extracts their attributes.
     
     Args:
-        image_path (str): Path to the input image
-        output_dir (str): Directory to save cropped character images
+        image_path (Union[str, PIL.Image.Image]): Path to the input image, or the decoded image
+        output_dir (Optional[str]): Directory to save cropped character images (None keeps them in memory only)
         
     Returns:
-        dict: Dictionary mapping cropped character paths to their attributes
+        dict: Dictionary mapping cropped character keys (paths when saved) to their attributes
     """
-    # Step 1: Extract characters from the image
-    cropped_characters = cropper.crop_persons(image_path, output_dir)
-    
-    if not cropped_characters:
-        return {}
-    
-    # Step 2: Extract attributes for each character
-    results = {}
-    for char_path in cropped_characters:
-        attributes = extractor.extract_attributes(char_path)
-        results[char_path] = attributes
-    
+    return extract_character_attributes_batch([image_path], [output_dir])[0]
+
+
+def extract_character_attributes_batch(image_paths, output_dirs=None):
+    """
+    Batched form of `extract_character_attributes_pipeline`: persons are detected in all
+    images together, then the characters of all images share the batched VLM passes.
+
+    Args:
+        image_paths (List[Union[str, PIL.Image.Image]]): Input image paths or decoded images
+        output_dirs (Optional[List[Optional[str]]]): Per-image crop directory (default: keep crops in memory)
+
+    Returns:
+        List[dict]: Per image, the mapping of cropped character keys to their attributes
+    """
+    output_dirs = list(output_dirs) if output_dirs is not None else [None] * len(image_paths)
+    results = [None] * len(image_paths)
+
+    # Images seen before are answered from the cache (only when no crops have to be written)
+    cache_keys = [None] * len(image_paths)
+    if result_cache is not None:
+        settings_key = result_cache.make_key(_settings_key(), json.dumps(_cropper().settings(), sort_keys=True))
+        for i, (image_path, output_dir) in enumerate(zip(image_paths, output_dirs)):
+            if output_dir is None:
+                cache_keys[i] = result_cache.make_key(settings_key, result_cache.image_key(image_path))
+                results[i] = result_cache.get_json("pipeline", cache_keys[i])
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    # Step 1: Extract characters from the images (crops stay in memory, disk is an optional sink)
+    crops_per_image = _cropper().detect_crops_batch([image_paths[i] for i in pending], [output_dirs[i] for i in pending])
+
+    # Step 2: Extract attributes for the characters of all images together
+    attributes = iter(attributes_for_crops([crop for crops in crops_per_image for crop in crops]))
+    for i, crops in zip(pending, crops_per_image):
+        results[i] = {crop.key: next(attributes) for crop in crops}
+        if cache_keys[i] is not None:
+            result_cache.put_json("pipeline", cache_keys[i], results[i])
     return results
 
 if __name__ == "__main__":
-    import json
-    import os
-    import time
-
     input_image_path = "data/continued/sensitive/danbooru_1370513_e8f30add09fdad6eb332b284f4a408bd.jpg"
     output_directory = "cropped_persons"
     
@@ -50,33 +165,9 @@ if __name__ == "__main__":
         print("No valid characters detected.")
 
 # -------------------------------------------------------------
-    input_dir = "test_images"  # Folder containing test images
-    output_file = "pipeline_test_results.txt"
-
-    with open(output_file, "w") as f:
-        for filename in sorted(os.listdir(input_dir)):  # Process files in order
-            image_path = os.path.join(input_dir, filename)
-
-            # Skip non-image files
-            if not filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-                continue
-
-            # Start timer
-            start_time = time.time()
-
-            # Run the pipeline
-            results = extract_character_attributes_pipeline(image_path, output_dir="cropped_persons")
-
-            # Measure time taken
-            elapsed_time = round(time.time() - start_time, 2)
-
-            # Write results to file
-            f.write(f"input - {filename}\n")
-            f.write("output - \n")
-            f.write(json.dumps(results, indent=4))
-            f.write(f"\ntime - {elapsed_time} seconds\n\n")
-
-            print(f"Processed {filename} in {elapsed_time} seconds")
+    # Batch run over a folder: streamed JSONL output, resumable if interrupted.
+    # For large runs use the CLI: python -m src.batch_runner --pipeline 1 <inputs>
+    from src.batch_runner import iter_inputs, run_batch
 
-    print(f"Processing completed. Results saved to {output_file}.")
+    run_batch(extract_character_attributes_pipeline, iter_inputs(["test_images"]), "pipeline_test_results.jsonl")
 
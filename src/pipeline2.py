@@ -1,77 +1,266 @@
-from src.char_detection import PersonCropper
-from src.vlm_blip3 import CharacterAttributeExtractor
-from deepdanbooru_tagger import DanbooruTagger
-
-cropper = PersonCropper()
-tagger = DanbooruTagger()
-extractor = CharacterAttributeExtractor(
-        model_name="blip2_t5",
-        model_type="pretrain_flant5xl"
+import json
+import os
+
+from src.model_registry import get_cropper, get_extractor, get_tagger
+from src.routing_policy import RoutingPolicy
+
+result_cache = None
+crop_index = None
+# `PersonCropper` / `DanbooruTagger` / `CharacterAttributeExtractor` settings (see `configure`)
+cropper_config = {}
+tagger_config = {"backend": "keras"}
+extractor_config = {"model_name": "blip2_t5", "model_type": "pretrain_flant5xl"}
+# extractor_config = {"model_name": "blip2_opt", "model_type": "pretrain_opt2.7b"}
+
+
+def _cropper():
+    return get_cropper(**cropper_config)
+
+
+def _tagger():
+    return get_tagger(result_cache=result_cache, **tagger_config)
+
+
+def _extractor():
+    return get_extractor(result_cache=result_cache, **extractor_config)
+
+
+def __getattr__(name):
+    # `pipeline2.cropper` / `.tagger` / `.extractor` are built on first access, not at
+    # import, and are shared with every other user of the same models in this process
+    if name == "cropper":
+        return _cropper()
+    if name == "tagger":
+        return _tagger()
+    if name == "extractor":
+        return _extractor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Per-attribute thresholds deciding tagger-only vs VLM (see utils/calibrate_routing_policy.py)
+ROUTING_POLICY_PATH = "routing_policy.json"
+if os.path.exists(ROUTING_POLICY_PATH):
+    routing_policy = RoutingPolicy.load(ROUTING_POLICY_PATH)
+else:
+    routing_policy = RoutingPolicy()
+
+
+def enable_result_cache(cache):
+    """
+    Attaches a `ResultCache` to this pipeline: whole-image results are cached here,
+    tagger probabilities and VLM answers by the tagger and the extractor (attached
+    whenever they are fetched).
+    """
+    global result_cache
+    result_cache = cache
+
+
+def enable_crop_dedup(index):
+    """
+    Attaches a `CropIndex`: crops that are near-duplicates of crops processed before
+    (re-posts, resized copies, variant frames) reuse their attributes instead of
+    going through the models again.
+    """
+    global crop_index
+    crop_index = index
+
+
+def _settings_key() -> str:
+    # Cached and reused results must come from the same pipeline, effective model settings
+    # (defaults included, not only what `configure` overrode) and routing policy
+    return json.dumps(
+        [
+            "pipeline2",
+            _tagger().cache_namespace(),
+            _extractor().settings(),
+            routing_policy.thresholds,
+            routing_policy.default_threshold,
+            routing_policy.vlm_only,
+        ],
+        sort_keys=True,
+        default=str,
     )
-# extractor = CharacterAttributeExtractor(
-#         model_name="blip2_opt",
-#         model_type="pretrain_opt2.7b"
-#     )
 
 
-def process_character_attributes(char_path, tagger, extractor, threshold=0.4):
+def configure(tagger=None, extractor=None, routing_policy_path=None, cropper=None):
+    """
+    Overrides the model settings and routing policy of this pipeline, e.g.
+    `configure(tagger={"backend": "onnx"}, extractor={"answer_mode": "score"})`.
+    Takes effect for the next image.
+
+    Args:
+        tagger (Optional[dict]): `DanbooruTagger` arguments.
+        extractor (Optional[dict]): `CharacterAttributeExtractor` arguments.
+        routing_policy_path (Optional[str]): Routing policy JSON replacing `routing_policy`.
+        cropper (Optional[dict]): `PersonCropper` arguments, e.g. `{"level": "auto"}`.
+    """
+    global routing_policy
+    if tagger:
+        tagger_config.update(tagger)
+    if extractor:
+        extractor_config.update(extractor)
+    if routing_policy_path:
+        routing_policy = RoutingPolicy.load(routing_policy_path)
+    if cropper:
+        cropper_config.update(cropper)
+
+
+def vlm_calls() -> int:
+    """Questions the extractor of this pipeline has run through the VLM in this process."""
+    return _extractor().vlm_calls
+
+
+def process_character_attributes(char_path, tagger, extractor, threshold=0.4, danbooru_output=None, policy=None):
     """
     Process character attributes using DanbooruTagger and CharacterAttributeExtractor.
     
     Args:
-        char_path (str): Path to the cropped character image.
+        char_path (Union[str, PersonCrop]): Path to the cropped character image, or the in-memory crop.
         tagger (DanbooruTagger): Instance of DanbooruTagger for predicting tags.
         extractor (CharacterAttributeExtractor): Instance of CharacterAttributeExtractor.
         threshold (float): Score threshold for filtering tags.
+        danbooru_output (Optional[dict]): Precomputed `tagger.predict_all` output (e.g. from `predict_batch`).
+        policy (Optional[RoutingPolicy]): Decides which attributes the VLM is asked about
+            (default: the module's `routing_policy`).
         
     Returns:
         dict: Extracted character attributes.
     """
-    danbooru_output = tagger.predict_all(char_path, threshold=threshold)
-    formatted_string = ", ".join(
-        [f"{category}: {', '.join(tag['tag'] for tag in tags)}" 
-         for category, tags in danbooru_output["categorized_tags"].items()]
-    )
-    low_score_keys = [
-        key for key, value in danbooru_output["best_candidates"].items() 
-        if value["score"] < threshold
-    ]
-    low_score_keys.append("Ethnicity") # As this is not being estimated by DanbooruTagger
-    danbooru_attributes = {key: ", ".join(item["tag"] for item in value) for key, value in danbooru_output["categorized_tags"].items()}
-    character_attributes = extractor.extract_attributes(char_path, topics=low_score_keys, context=formatted_string)
-    character_attributes.update(danbooru_attributes)
-    return character_attributes
+    danbooru_outputs = None if danbooru_output is None else [danbooru_output]
+    return process_characters_batch([char_path], tagger, extractor, threshold, danbooru_outputs, policy)[0]
+
+
+def process_characters_batch(crops, tagger, extractor, threshold=0.4, danbooru_outputs=None, policy=None):
+    """
+    Batched form of `process_character_attributes` over several crops (e.g. all crops of an
+    image): the crops are tagged together, and the VLM prompts of every crop, each with its
+    own routed topics and tag context, go through one `extract_attributes_batch` call.
+
+    Args:
+        crops (List[Union[str, PersonCrop]]): Cropped character images or in-memory crops.
+        tagger (DanbooruTagger): Instance of DanbooruTagger for predicting tags.
+        extractor (CharacterAttributeExtractor): Instance of CharacterAttributeExtractor.
+        threshold (float): Score threshold for filtering tags.
+        danbooru_outputs (Optional[List[dict]]): Precomputed `tagger.predict_batch` outputs.
+        policy (Optional[RoutingPolicy]): Decides which attributes the VLM is asked about
+            (default: the module's `routing_policy`).
+
+    Returns:
+        List[dict]: Extracted character attributes, one dict per crop.
+    """
+    if not crops:
+        return []
+    if danbooru_outputs is None:
+        danbooru_outputs = tagger.predict_batch(crops, threshold=threshold)
+
+    all_attributes, decisions, contexts = [], [], []
+    for danbooru_output in danbooru_outputs:
+        contexts.append(", ".join(
+            [f"{category}: {', '.join(tag['tag'] for tag in tags)}"
+             for category, tags in danbooru_output["categorized_tags"].items()]
+        ))
+        # Only the attributes the tagger is not confident about go to the VLM
+        decisions.append((policy or routing_policy).route(danbooru_output))
+        all_attributes.append({key: ", ".join(item["tag"] for item in value) for key, value in danbooru_output["categorized_tags"].items()})
+
+    routed = [idx for idx, decision in enumerate(decisions) if decision.vlm_attributes]
+    if routed:
+        vlm_outputs = extractor.extract_attributes_batch(
+            [crops[idx] for idx in routed],
+            topics=[list(decisions[idx].vlm_attributes) for idx in routed],
+            context=[contexts[idx] for idx in routed],
+        )
+        for idx, vlm_attributes in zip(routed, vlm_outputs):
+            # The VLM was asked because the tagger was not trusted: its answer replaces the bucket
+            # of the same name, and stays next to a differently named one ("Eyes" / "Eye Color")
+            all_attributes[idx].update(vlm_attributes)
+    return all_attributes
+
+
+def attributes_for_crops(crops):
+    """
+    Attributes of character crops (from any source, e.g. video tracks). Near-duplicates of
+    crops processed before reuse their attributes; the others are tagged in one batched
+    forward pass, and their routed questions share one batched VLM call.
+
+    Args:
+        crops (List[PersonCrop]): Character crops
+
+    Returns:
+        List[dict]: Attributes of every crop, in order
+    """
+    tagger, extractor = _tagger(), _extractor()
+    attributes, fingerprints = [None] * len(crops), [None] * len(crops)
+    if crop_index is not None:
+        namespace = _settings_key()
+        for j, crop in enumerate(crops):
+            fingerprints[j] = crop_index.fingerprint(crop)
+            attributes[j] = crop_index.lookup(fingerprints[j], namespace)
+    todo = [j for j, attrs in enumerate(attributes) if attrs is None]
+
+    new_attributes = process_characters_batch([crops[j] for j in todo], tagger, extractor)
+    for j, attrs in zip(todo, new_attributes):
+        attributes[j] = attrs
+        if crop_index is not None:
+            crop_index.add(fingerprints[j], attributes[j], namespace)
+    return attributes
+
 
 def extract_character_attributes_pipeline(image_path, output_dir="cropped_persons"):
     """
     Pipeline that extracts characters from an image and then extracts their attributes.
     
     Args:
-        image_path (str): Path to the input image
-        output_dir (str): Directory to save cropped character images
+        image_path (Union[str, PIL.Image.Image]): Path to the input image, or the decoded image
+        output_dir (Optional[str]): Directory to save cropped character images (None keeps them in memory only)
         
     Returns:
-        dict: Dictionary mapping cropped character paths to their attributes
+        dict: Dictionary mapping cropped character keys (paths when saved) to their attributes
     """
-    # Step 1: Extract characters from the image
-    cropped_characters = cropper.crop_persons(image_path, output_dir)
-    
-    if not cropped_characters:
-        return {}
-    
-    # Step 2: Extract attributes for each character  
-    character_attributes = {}
-    for cropped_character_path in cropped_characters:
-        character_attributes[cropped_character_path] = process_character_attributes(
-            cropped_character_path, tagger, extractor
-        )
+    return extract_character_attributes_batch([image_path], [output_dir])[0]
+
+
+def extract_character_attributes_batch(image_paths, output_dirs=None):
+    """
+    Batched form of `extract_character_attributes_pipeline`: persons are detected in all
+    images together and the characters of all images are tagged in one forward pass.
+
+    Args:
+        image_paths (List[Union[str, PIL.Image.Image]]): Input image paths or decoded images
+        output_dirs (Optional[List[Optional[str]]]): Per-image crop directory (default: keep crops in memory)
+
+    Returns:
+        List[dict]: Per image, the mapping of cropped character keys to their attributes
+    """
+    output_dirs = list(output_dirs) if output_dirs is not None else [None] * len(image_paths)
+    results = [None] * len(image_paths)
 
-    return character_attributes
+    # Images seen before are answered from the cache (only when no crops have to be written)
+    cache_keys = [None] * len(image_paths)
+    if result_cache is not None:
+        settings_key = result_cache.make_key(_settings_key(), json.dumps(_cropper().settings(), sort_keys=True))
+        for i, (image_path, output_dir) in enumerate(zip(image_paths, output_dirs)):
+            if output_dir is None:
+                cache_keys[i] = result_cache.make_key(settings_key, result_cache.image_key(image_path))
+                results[i] = result_cache.get_json("pipeline", cache_keys[i])
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    # Step 1: Extract characters from the images (crops stay in memory, disk is an optional sink)
+    crops_per_image = _cropper().detect_crops_batch([image_paths[i] for i in pending], [output_dirs[i] for i in pending])
+    for _ in pending:
+        routing_policy.record_image()
+
+    # Step 2: Tag and route the characters of all images together
+    attributes = iter(attributes_for_crops([crop for crops in crops_per_image for crop in crops]))
+    for i, crops in zip(pending, crops_per_image):
+        results[i] = {crop.key: next(attributes) for crop in crops}
+        if cache_keys[i] is not None:
+            result_cache.put_json("pipeline", cache_keys[i], results[i])
+    return results
 
 if __name__ == "__main__":
-    import json
-    import time
-    import os
     input_image_path = "cropped_characters/cropped_character_0.jpg"
     output_directory = "cropped_persons"
     
@@ -84,33 +273,9 @@ if __name__ == "__main__":
             print(json.dumps(attributes, indent=4))
     else:
         print("No valid characters detected.")
-    # ---------------
-    input_dir = "test_images"
-    output_file = "testing_results.txt"
-
-    with open(output_file, "w") as f:
-        for filename in sorted(os.listdir(input_dir)):  # Process in sorted order
-            image_path = os.path.join(input_dir, filename)
-
-            # Skip non-image files
-            if not filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-                continue
-
-            # Start timer
-            start_time = time.time()
-
-            # Extract attributes
-            results = extract_character_attributes_pipeline(image_path)
-
-            # Measure time taken
-            elapsed_time = round(time.time() - start_time, 2)
-
-            # Write to file
-            f.write(f"input - {filename}\n")
-            f.write("output - \n")
-            f.write(json.dumps(results, indent=4))
-            f.write(f"\ntime - {elapsed_time} seconds\n\n")
-
-            print(f"Processed {filename} in {elapsed_time} seconds")
+    # -------------------------------------------------------------
+    # Batch run over a folder: streamed JSONL output, resumable if interrupted.
+    # For large runs use the CLI: python -m src.batch_runner --pipeline 2 <inputs>
+    from src.batch_runner import iter_inputs, run_batch
 
-    print(f"Processing completed. Results saved to {output_file}.")
+    run_batch(extract_character_attributes_pipeline, iter_inputs(["test_images"]), "testing_results.jsonl")
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from src.image_utils import content_hash
+
+
+class ResultCache:
+    LEVELS = ("pipeline", "tagger", "vlm")
+    # Hits refresh their LRU position in memory; the timestamps are written with the next
+    # put/eviction, or once this many have piled up (a hit then costs no write transaction)
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(self, path: str = "cache/results.sqlite", max_mb: float = 2048, evict_to: float = 0.9):
+        """
+        Persistent, content-addressed cache with three levels, stored in one SQLite file:
+          - "pipeline": full pipeline results, keyed by image hash
+          - "tagger":   tagger probability vectors, keyed by crop hash
+          - "vlm":      individual VLM answers, keyed by (crop hash, question, context, model_type)
+
+        Entries are evicted least-recently-used first once the total size exceeds `max_mb`.
+        The file can be shared by several processes (WAL mode).
+
+        Args:
+            path (str): SQLite file (created if missing).
+            max_mb (float): Size budget for all levels together.
+            evict_to (float): After eviction the cache is shrunk to this fraction of the budget.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.evict_to = evict_to
+        self.hits = {level: 0 for level in self.LEVELS}
+        self.misses = {level: 0 for level in self.LEVELS}
+        self._lock = threading.Lock()
+        self._accessed = {}
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " level TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (level, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._conn.commit()
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    # Keys
+
+    @staticmethod
+    def image_key(image) -> str:
+        """Hash of an input image: raw file bytes for paths (catches re-uploads), pixels otherwise."""
+        if isinstance(image, str):
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(image, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(block)
+            return hasher.hexdigest()
+        if isinstance(image, bytes):
+            return hashlib.blake2b(image, digest_size=16).hexdigest()
+        return content_hash(image if isinstance(image, Image.Image) else image.to_pil())
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Combines several key parts (hashes, prompts, model names) into one fixed-size key."""
+        return hashlib.blake2b("\x1f".join(str(part) for part in parts).encode(), digest_size=16).hexdigest()
+
+    # Raw access
+
+    def get(self, level: str, key: str) -> Optional[bytes]:
+        """Returns the stored bytes (refreshing their LRU position) or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE level = ? AND key = ?", (level, key)).fetchone()
+            if row is None:
+                self.misses[level] += 1
+                return None
+            self.hits[level] += 1
+            self._accessed[(level, key)] = time.time()
+            if len(self._accessed) >= self.ACCESS_FLUSH_SIZE:
+                self._flush_access()
+                self._conn.commit()
+            return row[0]
+
+    def put(self, level: str, key: str, value: bytes):
+        """Stores bytes under (level, key) and evicts old entries when over budget."""
+        size = len(value)
+        with self._lock:
+            self._flush_access()
+            old = self._conn.execute("SELECT size FROM entries WHERE level = ? AND key = ?", (level, key)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (level, key, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (level, key, sqlite3.Binary(value), size, time.time()),
+            )
+            self._size_bytes += size - (old[0] if old else 0)
+            if self._size_bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _flush_access(self):
+        # Writes buffered hit timestamps (the caller commits)
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE level = ? AND key = ?",
+                [(accessed, level, key) for (level, key), accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def _evict(self):
+        # Other processes may have written too: start from the real total
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = int(self.max_bytes * self.evict_to)
+        rows = self._conn.execute("SELECT level, key, size FROM entries ORDER BY last_access").fetchall()
+        evicted = []
+        for level, key, size in rows:
+            if self._size_bytes <= target:
+                break
+            evicted.append((level, key))
+            self._size_bytes -= size
+        self._conn.executemany("DELETE FROM entries WHERE level = ? AND key = ?", evicted)
+
+    # Typed helpers
+
+    def get_json(self, level: str, key: str):
+        value = self.get(level, key)
+        return None if value is None else json.loads(value)
+
+    def put_json(self, level: str, key: str, obj):
+        self.put(level, key, json.dumps(obj).encode())
+
+    def get_array(self, level: str, key: str) -> Optional[np.ndarray]:
+        value = self.get(level, key)
+        return None if value is None else np.frombuffer(value, dtype=np.float32).astype(float)
+
+    def put_array(self, level: str, key: str, array: np.ndarray):
+        # float32 halves the footprint of ~10k-label probability vectors
+        self.put(level, key, np.asarray(array, dtype=np.float32).tobytes())
+
+    # Stats
+
+    def stats(self) -> dict:
+        """Hit/miss counters per level (this process) and current size (whole file)."""
+        with self._lock:
+            entries = dict(self._conn.execute("SELECT level, COUNT(*) FROM entries GROUP BY level").fetchall())
+        levels = {}
+        for level in self.LEVELS:
+            lookups = self.hits[level] + self.misses[level]
+            levels[level] = {
+                "hits": self.hits[level],
+                "misses": self.misses[level],
+                "hit_rate": self.hits[level] / lookups if lookups else 0.0,
+                "entries": entries.get(level, 0),
+            }
+        return {
+            "levels": levels,
+            "size_mb": self._size_bytes / (1024 * 1024),
+            "max_mb": self.max_bytes / (1024 * 1024),
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_access()
+            self._conn.commit()
+            self._conn.close()
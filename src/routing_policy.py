@@ -0,0 +1,174 @@
+import json
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.attributes import ATTRIBUTE_QUESTIONS
+
+# Attributes whose tagger bucket has a different name than the VLM question
+ATTRIBUTE_BUCKETS = {"Eye Color": "Eyes"}
+
+
+def bucket_for(attribute: str) -> str:
+    """Tagger bucket (danbooru_bucket.json) that answers a VLM attribute question."""
+    return ATTRIBUTE_BUCKETS.get(attribute, attribute)
+
+
+@dataclass
+class RoutingDecision:
+    """Which attributes of one crop the tagger answers alone and which go to the VLM."""
+    tagger_attributes: List[str] = field(default_factory=list)
+    vlm_attributes: List[str] = field(default_factory=list)
+    skipped_attributes: List[str] = field(default_factory=list)  # answered by neither
+
+    @property
+    def vlm_calls_saved(self) -> int:
+        """Questions not asked, compared to asking the VLM every attribute question."""
+        return len(self.tagger_attributes) + len(self.skipped_attributes)
+
+
+class RoutingPolicy:
+    def __init__(
+        self,
+        thresholds: Optional[Dict[str, float]] = None,
+        default_threshold: float = 0.4,
+        vlm_only: Iterable[str] = ("Ethnicity",),
+    ):
+        """
+        Decides, per crop and per attribute, whether the tagger's best candidate is trusted
+        or the VLM is asked.
+
+        An attribute with a tagger bucket goes to the VLM only when the bucket's best
+        candidate scores below its threshold. Attributes without a bucket are asked only
+        if listed in `vlm_only`, and skipped otherwise. A threshold above 1 sends the
+        attribute to the VLM always, a threshold of 0 never.
+
+        Args:
+            thresholds (Optional[Dict[str, float]]): Per-attribute confidence thresholds,
+                keyed by attribute question name (e.g. "Hair Color", "Eye Color").
+            default_threshold (float): Threshold of attributes missing from `thresholds`.
+            vlm_only (Iterable[str]): Attributes without a tagger bucket that the VLM should answer.
+        """
+        self.thresholds = dict(thresholds or {})
+        self.default_threshold = default_threshold
+        self.vlm_only = list(vlm_only)
+        self.images = 0
+        self.crops = 0
+        self.vlm_calls = 0
+        self.vlm_calls_saved = 0
+        self._lock = threading.Lock()
+
+    def threshold_for(self, attribute: str) -> float:
+        return self.thresholds.get(attribute, self.default_threshold)
+
+    def route(self, danbooru_output: dict, attributes: Optional[Iterable[str]] = None) -> RoutingDecision:
+        """
+        Routes the attributes of one crop.
+
+        Args:
+            danbooru_output (dict): `DanbooruTagger.predict_all` output of the crop.
+            attributes (Optional[Iterable[str]]): Attributes to answer (default: every VLM question).
+
+        Returns:
+            RoutingDecision: The split, also added to the policy's counters.
+        """
+        if attributes is None:
+            attributes = ATTRIBUTE_QUESTIONS
+
+        decision = RoutingDecision()
+        best_candidates = danbooru_output["best_candidates"]
+        for attribute in attributes:
+            best = best_candidates.get(bucket_for(attribute))
+            if best is None:
+                target = decision.vlm_attributes if attribute in self.vlm_only else decision.skipped_attributes
+            elif best["score"] >= self.threshold_for(attribute):
+                target = decision.tagger_attributes
+            else:
+                target = decision.vlm_attributes
+            target.append(attribute)
+
+        with self._lock:
+            self.crops += 1
+            self.vlm_calls += len(decision.vlm_attributes)
+            self.vlm_calls_saved += decision.vlm_calls_saved
+        return decision
+
+    def record_image(self):
+        """Counts one processed image (for the per-image averages in `stats`)."""
+        with self._lock:
+            self.images += 1
+
+    def stats(self) -> dict:
+        images = max(self.images, 1)
+        return {
+            "images": self.images,
+            "crops": self.crops,
+            "vlm_calls": self.vlm_calls,
+            "vlm_calls_saved": self.vlm_calls_saved,
+            "vlm_calls_per_image": round(self.vlm_calls / images, 2),
+            "vlm_calls_saved_per_image": round(self.vlm_calls_saved / images, 2),
+        }
+
+    # Persistence
+
+    def to_dict(self) -> dict:
+        return {"thresholds": self.thresholds, "default_threshold": self.default_threshold, "vlm_only": self.vlm_only}
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, path: str) -> "RoutingPolicy":
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls(**config)
+
+    # Calibration
+
+    @classmethod
+    def calibrate(
+        cls,
+        samples: Dict[str, List[Tuple[float, bool]]],
+        target_precision: float = 0.9,
+        min_support: int = 20,
+        vlm_only: Iterable[str] = ("Ethnicity",),
+    ) -> Tuple["RoutingPolicy", Dict[str, dict]]:
+        """
+        Picks, per attribute, the lowest threshold at which the tagger's best candidate is
+        right at least `target_precision` of the time on an annotated dataset.
+
+        Args:
+            samples (Dict[str, List[Tuple[float, bool]]]): Per attribute, (best candidate
+                score, whether that candidate is among the annotated tags) for every
+                annotated image that has a label for the attribute.
+            target_precision (float): Required accuracy of tagger-only answers.
+            min_support (int): Fewest samples above a threshold for it to be trusted.
+            vlm_only (Iterable[str]): See `__init__`.
+
+        Returns:
+            (RoutingPolicy, Dict[str, dict]): The policy and, per attribute, the chosen
+            threshold with its precision and coverage (share of crops answered by the tagger).
+        """
+        thresholds = {}
+        report = {}
+        for attribute, attribute_samples in samples.items():
+            ranked = sorted(attribute_samples, key=lambda sample: sample[0], reverse=True)
+            threshold = 1.01  # nothing reaches the target: always ask the VLM
+            precision = coverage = 0.0
+
+            # Walk down the scores; keep the lowest cut-off that still meets the target
+            correct = 0
+            for count, (score, is_correct) in enumerate(ranked, start=1):
+                correct += int(is_correct)
+                if count >= min_support and correct / count >= target_precision:
+                    threshold, precision, coverage = score, correct / count, count / len(ranked)
+
+            thresholds[attribute] = round(threshold, 4)
+            report[attribute] = {
+                "threshold": thresholds[attribute],
+                "precision": round(precision, 4),
+                "coverage": round(coverage, 4),
+                "samples": len(ranked),
+            }
+        return cls(thresholds=thresholds, vlm_only=vlm_only), report
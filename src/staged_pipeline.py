@@ -0,0 +1,243 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from PIL import Image
+
+_DONE = object()
+
+
+class _Failed:
+    """Marks an item whose processing raised; later stages pass it through untouched."""
+    def __init__(self, stage: str, error: Exception):
+        self.stage = stage
+        self.error = error
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable, num_workers: int = 1):
+        """
+        One step of a staged pipeline.
+
+        Args:
+            name (str): Stage name used in the stats.
+            fn (Callable): Maps the item produced by the previous stage to the next one.
+            num_workers (int): Worker threads for this stage. Keep 1 for stages that hold
+                a model which is not thread-safe.
+        """
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0  # waiting for input
+        self.blocked_seconds = 0.0  # waiting for room downstream (backpressure)
+        self._lock = threading.Lock()
+
+    def _record(self, busy: float, starved: float, blocked: float):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += busy
+            self.starved_seconds += starved
+            self.blocked_seconds += blocked
+
+    def stats(self, wall_seconds: float) -> dict:
+        capacity = max(wall_seconds * self.num_workers, 1e-9)
+        return {
+            "workers": self.num_workers,
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "starved_seconds": round(self.starved_seconds, 3),
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "utilisation": round(self.busy_seconds / capacity, 3),
+        }
+
+
+class StagedPipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 4, max_in_flight: Optional[int] = None):
+        """
+        Producer/consumer execution of a list of stages, each on its own worker thread(s).
+
+        Stages are connected by bounded queues, so a slow stage pushes back on the ones
+        before it instead of letting work pile up in memory. Results are yielded in input
+        order regardless of which worker finished first.
+
+        Args:
+            stages (List[Stage]): Stages in execution order.
+            queue_size (int): Capacity of each inter-stage queue.
+            max_in_flight (Optional[int]): Items admitted but not yet yielded (bounds the
+                reorder buffer). Defaults to enough to keep every queue and worker busy.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        if max_in_flight is None:
+            max_in_flight = queue_size * (len(stages) + 1) + sum(stage.num_workers for stage in stages)
+        self.max_in_flight = max_in_flight
+        self.wall_seconds = 0.0
+
+    def _feed(self, inputs: Iterable, out_queue: queue.Queue, slots: threading.Semaphore, stop: threading.Event, error: list):
+        try:
+            for seq, item in enumerate(inputs):
+                slots.acquire()
+                if stop.is_set():
+                    break
+                out_queue.put((seq, item, item))
+        except Exception as e:
+            # Re-raised by `run` once the items fed before the failure are yielded
+            error.append(e)
+        finally:
+            # Always sent, or the stages and the consumer would wait forever
+            out_queue.put(_DONE)
+
+    def _work(self, stage: Stage, in_queue: queue.Queue, out_queue: queue.Queue, finished: List[int]):
+        while True:
+            wait_start = time.perf_counter()
+            entry = in_queue.get()
+            starved = time.perf_counter() - wait_start
+
+            if entry is _DONE:
+                # Pass the sentinel on once every worker of this stage is done
+                in_queue.put(_DONE)
+                with stage._lock:
+                    finished[0] += 1
+                    last = finished[0] == stage.num_workers
+                if last:
+                    out_queue.put(_DONE)
+                return
+
+            seq, original, payload = entry
+            busy_start = time.perf_counter()
+            if not isinstance(payload, _Failed):
+                try:
+                    payload = stage.fn(payload)
+                except Exception as e:
+                    payload = _Failed(stage.name, e)
+            busy = time.perf_counter() - busy_start
+
+            put_start = time.perf_counter()
+            out_queue.put((seq, original, payload))
+            stage._record(busy, starved, time.perf_counter() - put_start)
+
+    def run(self, inputs: Iterable) -> Iterator[tuple]:
+        """
+        Runs inputs through every stage.
+
+        Yields:
+            (input, result, error): `error` is None on success, otherwise the exception
+            (with `result` None) raised by the first failing stage.
+
+        Raises:
+            Exception: Whatever iterating `inputs` raised, after the items read before it.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        slots = threading.Semaphore(self.max_in_flight)
+        stop = threading.Event()
+        feed_error = []
+
+        threads = [threading.Thread(target=self._feed, args=(inputs, queues[0], slots, stop, feed_error), daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            finished = [0]
+            for _ in range(stage.num_workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(stage, queues[idx], queues[idx + 1], finished), daemon=True
+                ))
+
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        # Reorder: hold results until every earlier sequence number has been yielded
+        pending: Dict[int, tuple] = {}
+        next_seq = 0
+        try:
+            while True:
+                entry = queues[-1].get()
+                if entry is _DONE:
+                    break
+                seq, original, payload = entry
+                pending[seq] = (original, payload)
+                while next_seq in pending:
+                    original, payload = pending.pop(next_seq)
+                    next_seq += 1
+                    slots.release()
+                    if isinstance(payload, _Failed):
+                        yield original, None, payload.error
+                    else:
+                        yield original, payload, None
+            if feed_error:
+                raise feed_error[0]
+        finally:
+            stop.set()
+            slots.release()
+            self.wall_seconds = time.perf_counter() - start_time
+
+    def stats(self) -> dict:
+        """Per-stage counters and utilisation (busy time / (wall time x workers))."""
+        return {stage.name: stage.stats(self.wall_seconds) for stage in self.stages}
+
+    def bottleneck(self) -> Optional[str]:
+        """Name of the stage with the highest utilisation."""
+        stats = self.stats()
+        return max(stats, key=lambda name: stats[name]["utilisation"]) if stats else None
+
+
+def build_stages(pipeline: str = "2", decode_workers: int = 2, crops_root: Optional[str] = None) -> List[Stage]:
+    """
+    Splits Pipeline 1 (decode -> detect -> VLM) or Pipeline 2 (decode -> detect -> tag -> VLM)
+    into stages, using the models of the corresponding pipeline module.
+    """
+    from src.batch_runner import crops_dir_for
+
+    if pipeline == "1":
+        from src import pipeline as module
+    else:
+        from src import pipeline2 as module
+
+    def decode(path):
+        with Image.open(path) as image:
+            return {"path": path, "image": image.convert("RGB"), "start": time.time()}
+
+    def detect(state):
+        output_dir = crops_dir_for(state["path"], crops_root) if crops_root else None
+        state["crops"] = module.cropper.detect_crops(state.pop("image"), output_dir)
+        if pipeline != "1":
+            module.routing_policy.record_image()
+        return state
+
+    def tag(state):
+        state["danbooru"] = module.tagger.predict_batch(state["crops"], threshold=0.4) if state["crops"] else []
+        return state
+
+    def vlm(state):
+        crops = state["crops"]
+        if pipeline == "1":
+            attributes = module.extractor.extract_attributes_batch(crops) if crops else []
+        else:
+            attributes = module.process_characters_batch(
+                crops, module.tagger, module.extractor, danbooru_outputs=state["danbooru"]
+            )
+        state["characters"] = {crop.key: attrs for crop, attrs in zip(crops, attributes)}
+        return state
+
+    stages = [Stage("decode", decode, num_workers=decode_workers), Stage("detect", detect)]
+    if pipeline != "1":
+        stages.append(Stage("tag", tag))
+    stages.append(Stage("vlm", vlm))
+    return stages
+
+
+def staged_records(staged: StagedPipeline) -> Callable[[Iterable[str]], Iterator[dict]]:
+    """Adapts a staged pipeline to the batch runner's record format."""
+    def process_records(paths: Iterable[str]) -> Iterator[dict]:
+        for path, state, error in staged.run(paths):
+            if error is not None:
+                yield {"input": path, "error": repr(error)}
+                continue
+            yield {
+                "input": path,
+                "num_characters": len(state["characters"]),
+                "characters": state["characters"],
+                "seconds": round(time.time() - state["start"], 3),
+            }
+    return process_records
@@ -0,0 +1,202 @@
+import csv
+import os
+import pathlib
+import numpy as np
+import PIL.Image
+from typing import List, Optional
+
+
+def _hf_download(repo: str, filename: str) -> str:
+    """A Hugging Face model file, served from the local model store (see `src.model_store`)."""
+    from src.model_store import get_store
+    return get_store().hf_file(repo, filename)
+
+
+class TaggerBackend:
+    """
+    Interface between `DanbooruTagger` and a concrete tagging model.
+
+    A backend owns the model-specific preprocessing and returns one probability per
+    entry of `labels`. Bucket lookup, thresholding and the `predict_all` result
+    structure stay in `DanbooruTagger`, so every backend serves the same contract.
+    """
+    labels: List[str]
+    # Which weights: repo, file and revision (cached probabilities are only valid for these)
+    model_id: str = ""
+
+    def preprocess(self, image: PIL.Image.Image) -> np.ndarray:
+        """Turns one image into a model input of shape (H, W, C)."""
+        raise NotImplementedError
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """Runs one forward pass over a stacked batch, returning (batch, num_labels) probabilities."""
+        raise NotImplementedError
+
+
+def _model_id(repo: str, path: str) -> str:
+    """Identity of a downloaded model file: repo, file name and revision (the commit / store version directory)."""
+    return f"{repo}/{os.path.basename(path)}@{os.path.basename(os.path.dirname(path))}"
+
+
+def _load_tags_txt(path: str) -> List[str]:
+    """Reads a DeepDanbooru tags.txt (one label per line)."""
+    with pathlib.Path(path).open() as f:
+        return [line.strip() for line in f]
+
+
+def _create_onnx_session(path: str, num_threads: Optional[int] = None):
+    """Opens an ONNX Runtime CPU session with full graph optimizations."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def _fit_and_edge_pad(image: PIL.Image.Image, width: int, height: int) -> np.ndarray:
+    """
+    Resizes an image to fit (width, height) keeping its aspect ratio, then centers it
+    and pads the borders by repeating edge pixels.
+
+    NumPy/PIL equivalent of `tf.image.resize(..., method=AREA, preserve_aspect_ratio=True)`
+    followed by `deepdanbooru.image.transform_and_pad_image`, without TensorFlow.
+    """
+    image = image.convert("RGB")
+    scale = min(width / image.width, height / image.height)
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    image = image.resize(new_size, resample=PIL.Image.BOX)
+
+    pixels = np.asarray(image, dtype=np.float32)
+    pad_x = width - pixels.shape[1]
+    pad_y = height - pixels.shape[0]
+    return np.pad(
+        pixels,
+        ((pad_y // 2, pad_y - pad_y // 2), (pad_x // 2, pad_x - pad_x // 2), (0, 0)),
+        mode="edge",
+    )
+
+
+class KerasDeepDanbooruBackend(TaggerBackend):
+    def __init__(self, model_repo: str = "public-data/DeepDanbooru", model_filename: str = "model-resnet_custom_v3.h5"):
+        """
+        The original DeepDanbooru Keras model (requires TensorFlow and deepdanbooru).
+
+        Args:
+            model_repo (str): Hugging Face repo where the model is stored.
+            model_filename (str): Keras model file in the repo.
+        """
+        import tensorflow as tf
+        import deepdanbooru as dd
+
+        self._tf = tf
+        self._dd = dd
+        model_path = _hf_download(model_repo, model_filename)
+        self.model = tf.keras.models.load_model(model_path)
+        self.model_id = _model_id(model_repo, model_path)
+        self.labels = _load_tags_txt(_hf_download(model_repo, "tags.txt"))
+        _, self.height, self.width, _ = self.model.input_shape
+
+    def preprocess(self, image: PIL.Image.Image) -> np.ndarray:
+        tf, dd = self._tf, self._dd
+        image = np.asarray(image)
+        image = tf.image.resize(image, size=(self.height, self.width), method=tf.image.ResizeMethod.AREA, preserve_aspect_ratio=True)
+        image = image.numpy()
+        # Transform and pad for model input
+        image = dd.image.transform_and_pad_image(image, self.width, self.height)
+        return image / 255.0  # Normalize
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return np.asarray(self.model.predict_on_batch(batch))
+
+
+class OnnxDeepDanbooruBackend(TaggerBackend):
+    def __init__(
+        self,
+        model_path: str = "model-resnet_custom_v3.onnx",
+        model_repo: str = "public-data/DeepDanbooru",
+        num_threads: Optional[int] = None,
+    ):
+        """
+        DeepDanbooru exported to ONNX (see utils/export_deepdanbooru_onnx.py), served with
+        ONNX Runtime on CPU. No TensorFlow needed at serving time.
+
+        Args:
+            model_path (str): Local path of the exported .onnx model (or its file name in the model store).
+            model_repo (str): Hugging Face repo providing tags.txt.
+            num_threads (Optional[int]): ONNX Runtime intra-op threads (None lets ORT decide).
+        """
+        if not os.path.exists(model_path):
+            from src.model_store import get_store
+
+            # Exported models can also be installed in the model store (utils/fetch_models.py --onnx)
+            model_path = get_store().find("deepdanbooru-onnx", os.path.basename(model_path)) or model_path
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"{model_path} not found. Export it with `python utils/export_deepdanbooru_onnx.py`."
+            )
+        self.session = _create_onnx_session(model_path, num_threads)
+        # A local export has no revision: its modification time tells re-exports apart
+        self.model_id = f"{os.path.abspath(model_path)}@{int(os.path.getmtime(model_path))}"
+        self.input_name = self.session.get_inputs()[0].name
+        _, self.height, self.width, _ = self.session.get_inputs()[0].shape
+        self.labels = _load_tags_txt(_hf_download(model_repo, "tags.txt"))
+
+    def preprocess(self, image: PIL.Image.Image) -> np.ndarray:
+        return _fit_and_edge_pad(image, self.width, self.height) / 255.0
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch.astype(np.float32)})[0]
+
+
+class OnnxWDTaggerBackend(TaggerBackend):
+    def __init__(self, model_repo: str = "SmilingWolf/wd-swinv2-tagger-v3", num_threads: Optional[int] = None):
+        """
+        SmilingWolf wd-tagger (the models behind the wd-tagger space in resources.md),
+        served with ONNX Runtime on CPU.
+
+        Args:
+            model_repo (str): Hugging Face repo with model.onnx and selected_tags.csv.
+            num_threads (Optional[int]): ONNX Runtime intra-op threads (None lets ORT decide).
+        """
+        model_path = _hf_download(model_repo, "model.onnx")
+        self.session = _create_onnx_session(model_path, num_threads)
+        self.model_id = _model_id(model_repo, model_path)
+        self.input_name = self.session.get_inputs()[0].name
+        _, self.height, self.width, _ = self.session.get_inputs()[0].shape
+
+        with open(_hf_download(model_repo, "selected_tags.csv"), newline="") as f:
+            self.labels = [row["name"] for row in csv.DictReader(f)]
+
+    def preprocess(self, image: PIL.Image.Image) -> np.ndarray:
+        # Flatten transparency onto white, pad to a white square, resize, RGB -> BGR (0-255 floats)
+        image = image.convert("RGBA")
+        canvas = PIL.Image.new("RGBA", image.size, (255, 255, 255, 255))
+        canvas.alpha_composite(image)
+        image = canvas.convert("RGB")
+
+        side = max(image.size)
+        square = PIL.Image.new("RGB", (side, side), (255, 255, 255))
+        square.paste(image, ((side - image.width) // 2, (side - image.height) // 2))
+        if side != self.height:
+            square = square.resize((self.width, self.height), resample=PIL.Image.BICUBIC)
+
+        return np.asarray(square, dtype=np.float32)[:, :, ::-1]
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+
+TAGGER_BACKENDS = {
+    "keras": KerasDeepDanbooruBackend,
+    "onnx": OnnxDeepDanbooruBackend,
+    "wd-onnx": OnnxWDTaggerBackend,
+}
+
+
+def create_backend(name: str, **kwargs) -> TaggerBackend:
+    """Builds a tagger backend by name ("keras", "onnx" or "wd-onnx")."""
+    if name not in TAGGER_BACKENDS:
+        raise ValueError(f"Unknown tagger backend '{name}'. Choose from: {', '.join(TAGGER_BACKENDS)}.")
+    return TAGGER_BACKENDS[name](**kwargs)
@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from src.char_detection import PersonCrop
+from src.instrumentation import metrics
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _natural_key(name: str):
+    # Numbers compare as numbers, so unpadded frame_2.png sorts before frame_10.png
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def iter_frames(
+    source: str, sample_fps: float = 2.0, source_fps: Optional[float] = None, max_frames: Optional[int] = None
+) -> Iterator[Tuple[int, float, np.ndarray]]:
+    """
+    Samples frames of a video file, or of a directory of frame images (in natural name order).
+
+    Frames between samples are skipped without being decoded (`grab` without `retrieve`).
+    Sampled frames that cannot be decoded are skipped with a warning.
+
+    Args:
+        source (str): Video file or frame directory.
+        sample_fps (float): Frames per second to keep.
+        source_fps (Optional[float]): Frame rate of the source (default: from the video, 24 for directories).
+        max_frames (Optional[int]): Stop after this many sampled frames.
+
+    Yields:
+        (frame index, seconds, RGB array) of every sampled frame.
+    """
+    if os.path.isdir(source):
+        names = sorted((name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS)), key=_natural_key)
+        source_fps = source_fps or 24.0
+        step = max(1, round(source_fps / sample_fps))
+        sampled = 0
+        for frame_index in range(0, len(names), step):
+            if max_frames is not None and sampled >= max_frames:
+                return
+            frame_path = os.path.join(source, names[frame_index])
+            frame = cv2.imread(frame_path)
+            if frame is None:
+                print(f"Warning: skipping unreadable frame {frame_path}.")
+                continue
+            sampled += 1
+            yield frame_index, frame_index / source_fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise FileNotFoundError(f"Cannot open video {source}")
+    try:
+        source_fps = source_fps or capture.get(cv2.CAP_PROP_FPS) or 24.0
+        step = max(1, round(source_fps / sample_fps))
+        frame_index = sampled = 0
+        while max_frames is None or sampled < max_frames:
+            if not capture.grab():
+                return
+            if frame_index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    print(f"Warning: skipping undecodable frame {frame_index} of {source}.")
+                    frame_index += 1
+                    continue
+                sampled += 1
+                yield frame_index, frame_index / source_fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            frame_index += 1
+    finally:
+        capture.release()
+
+
+def iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    """Intersection over union of two (x1, y1, x2, y2) boxes."""
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    inter = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def appearance(crop: np.ndarray) -> np.ndarray:
+    """Normalized hue / saturation histogram of an RGB crop (hair and outfit colours)."""
+    hsv = cv2.cvtColor(crop, cv2.COLOR_RGB2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256]).ravel()
+    return (hist / max(hist.sum(), 1e-9)).astype(np.float32)
+
+
+def appearance_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """1 for identical histograms, 0 for disjoint ones (1 - Bhattacharyya distance)."""
+    return 1.0 - float(cv2.compareHist(a, b, cv2.HISTCMP_BHATTACHARYYA))
+
+
+@dataclass
+class Track:
+    """One character followed across sampled frames."""
+    track_id: int
+    first_frame: int
+    last_frame: int
+    first_seconds: float
+    last_seconds: float
+    bbox: Tuple[int, int, int, int]
+    appearance: np.ndarray
+    detections: int = 1
+    missed: int = 0  # sampled frames since the last match
+    candidates: List[Tuple[float, int, PersonCrop]] = field(default_factory=list)  # (quality, frame, crop)
+
+    def to_dict(self) -> dict:
+        return {
+            "track_id": self.track_id,
+            "frames": [self.first_frame, self.last_frame],
+            "seconds": [round(self.first_seconds, 3), round(self.last_seconds, 3)],
+            "detections": self.detections,
+        }
+
+
+class CharacterTracker:
+    def __init__(
+        self,
+        iou_weight: float = 0.5,
+        match_threshold: float = 0.35,
+        min_appearance: float = 0.4,
+        max_missed: int = 4,
+        candidates_per_track: int = 8,
+        appearance_momentum: float = 0.8,
+    ):
+        """
+        Links person detections of consecutive sampled frames into tracks.
+
+        A detection and a track are scored by `iou_weight * IoU + (1 - iou_weight) *
+        appearance similarity` (colour histograms), because at a few frames per second
+        characters move far between samples. The assignment maximizing the total
+        score (Hungarian) is kept. A pair is only linked if it scores at least
+        `match_threshold` and its appearance similarity is at least `min_appearance`.
+        Unmatched detections start new tracks. Tracks unmatched for more than
+        `max_missed` sampled frames are closed, which also splits tracks at scene cuts.
+
+        Args:
+            iou_weight (float): Weight of box overlap against appearance.
+            match_threshold (float): Lowest combined score that links a detection to a track.
+            min_appearance (float): Lowest appearance similarity that links a detection to a track.
+            max_missed (int): Sampled frames a track survives without a detection (occlusion, missed detection).
+            candidates_per_track (int): Best crops kept per track to choose representatives from (bounded memory).
+            appearance_momentum (float): Weight of the track's appearance against a new detection's.
+        """
+        self.iou_weight = iou_weight
+        self.match_threshold = match_threshold
+        self.min_appearance = min_appearance
+        self.max_missed = max_missed
+        self.candidates_per_track = candidates_per_track
+        self.appearance_momentum = appearance_momentum
+        self.active: List[Track] = []
+        self.finished: List[Track] = []
+        self._next_id = 0
+
+    def _keep_candidate(self, track: Track, frame_index: int, crop: PersonCrop):
+        # Confident, large crops describe a character best
+        height, width = crop.image.shape[:2]
+        quality = crop.score * float(np.sqrt(width * height))
+        # Copy: the crop is a view that would keep the whole frame alive
+        kept = PersonCrop(image=crop.image.copy(), bbox=crop.bbox, score=crop.score, index=crop.index)
+        track.candidates.append((quality, frame_index, kept))
+        if len(track.candidates) > self.candidates_per_track:
+            worst = min(range(len(track.candidates)), key=lambda i: track.candidates[i][0])
+            del track.candidates[worst]
+
+    def _start(self, frame_index: int, seconds: float, crop: PersonCrop, hist: np.ndarray):
+        track = Track(self._next_id, frame_index, frame_index, seconds, seconds, crop.bbox, hist)
+        self._next_id += 1
+        self._keep_candidate(track, frame_index, crop)
+        self.active.append(track)
+
+    def update(self, frame_index: int, seconds: float, crops: List[PersonCrop]):
+        """Adds the detections of one sampled frame."""
+        from scipy.optimize import linear_sum_assignment
+
+        hists = [appearance(crop.image) for crop in crops]
+        matched_tracks, matched_crops = set(), set()
+        if self.active and crops:
+            scores = np.zeros((len(self.active), len(crops)))
+            allowed = np.zeros_like(scores, dtype=bool)
+            for t, track in enumerate(self.active):
+                for c, (crop, hist) in enumerate(zip(crops, hists)):
+                    similarity = appearance_similarity(track.appearance, hist)
+                    scores[t, c] = self.iou_weight * iou(track.bbox, crop.bbox) + (1 - self.iou_weight) * similarity
+                    allowed[t, c] = similarity >= self.min_appearance and scores[t, c] >= self.match_threshold
+            for t, c in zip(*linear_sum_assignment(-np.where(allowed, scores, -1.0))):
+                if not allowed[t, c]:
+                    continue
+                track, crop = self.active[t], crops[c]
+                track.last_frame, track.last_seconds, track.bbox = frame_index, seconds, crop.bbox
+                track.appearance = self.appearance_momentum * track.appearance + (1 - self.appearance_momentum) * hists[c]
+                track.detections += 1
+                track.missed = 0
+                self._keep_candidate(track, frame_index, crop)
+                matched_tracks.add(t)
+                matched_crops.add(c)
+
+        still_active = []
+        for t, track in enumerate(self.active):
+            if t not in matched_tracks:
+                track.missed += 1
+            (still_active if track.missed <= self.max_missed else self.finished).append(track)
+        self.active = still_active
+
+        for c, (crop, hist) in enumerate(zip(crops, hists)):
+            if c not in matched_crops:
+                self._start(frame_index, seconds, crop, hist)
+
+    def close(self) -> List[Track]:
+        """Ends every track; returns all of them in order of appearance."""
+        self.finished.extend(self.active)
+        self.active = []
+        return sorted(self.finished, key=lambda track: (track.first_frame, track.track_id))
+
+
+def representative_crops(track: Track, count: int = 3) -> List[Tuple[int, PersonCrop]]:
+    """
+    Up to `count` (frame, crop) pairs of a track: the best crops, spread over the track
+    (a crop is skipped while one within 1/count of the track's frame range was taken).
+    """
+    ranked = sorted(track.candidates, key=lambda candidate: candidate[0], reverse=True)
+    min_gap = (track.last_frame - track.first_frame) / max(count, 1)
+    chosen = []
+    for _, frame_index, crop in ranked:
+        if all(abs(frame_index - taken) >= min_gap for taken, _ in chosen):
+            chosen.append((frame_index, crop))
+        if len(chosen) == count:
+            break
+    for _, frame_index, crop in ranked:
+        if len(chosen) == count:
+            break
+        if all(crop is not taken for _, taken in chosen):
+            chosen.append((frame_index, crop))
+    return sorted(chosen, key=lambda pair: pair[0])
+
+
+def merge_attributes(samples: List[dict]) -> dict:
+    """Most frequent answer per attribute over a track's crops (ties go to the best-ranked crop)."""
+    merged = {}
+    keys = list(dict.fromkeys(key for sample in samples for key in sample))
+    for key in keys:
+        values = [sample[key] for sample in samples if key in sample]
+        counts = Counter(str(value).strip().lower() for value in values)
+        best = max(counts.values())
+        merged[key] = next(value for value in values if counts[str(value).strip().lower()] == best)
+    return merged
+
+
+def process_video(
+    source: str,
+    pipeline: str = "2",
+    sample_fps: float = 2.0,
+    source_fps: Optional[float] = None,
+    max_frames: Optional[int] = None,
+    crops_per_track: int = 3,
+    min_detections: int = 2,
+    batch_size: int = 8,
+    tracker: Optional[CharacterTracker] = None,
+) -> dict:
+    """
+    Character attributes of a clip, per track instead of per frame.
+
+    Sampled frames go through person detection in batches, detections are linked into
+    tracks, and only `crops_per_track` representative crops of each track go through
+    the tagger and the VLM. This means a few model calls per character rather than
+    per frame.
+
+    Args:
+        source (str): Video file or directory of frames.
+        pipeline (str): "1" (VLM) or "2" (tagger + VLM), with that module's settings.
+        sample_fps (float): Frames per second passed to detection.
+        source_fps (Optional[float]): Frame rate of the source (default: from the video, 24 for directories).
+        max_frames (Optional[int]): Stop after this many sampled frames.
+        crops_per_track (int): Crops per track sent to the models.
+        min_detections (int): Tracks with fewer detections are dropped as noise.
+        batch_size (int): Frames per detector batch.
+        tracker (Optional[CharacterTracker]): Tracker settings (default: `CharacterTracker()`).
+
+    Returns:
+        dict: {"source", "frames_sampled", "seconds", "tracks": [{"track_id", "frames": [first, last],
+            "seconds": [first, last], "detections", "sample_frames", "attributes"}]}
+    """
+    from src.batch_runner import pipeline_module
+
+    module = pipeline_module(pipeline)
+    cropper = module.cropper
+    tracker = tracker or CharacterTracker()
+    start_time = time.time()
+
+    frames_sampled = 0
+    batch: List[Tuple[int, float, np.ndarray]] = []
+
+    def flush():
+        crops_per_frame = cropper.detect_crops_batch([frame for _, _, frame in batch])
+        for (frame_index, seconds, _), crops in zip(batch, crops_per_frame):
+            with metrics.span("track"):
+                tracker.update(frame_index, seconds, crops)
+        batch.clear()
+
+    for sample in iter_frames(source, sample_fps=sample_fps, source_fps=source_fps, max_frames=max_frames):
+        frames_sampled += 1
+        metrics.count("video_frames")
+        batch.append(sample)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+
+    tracks = [track for track in tracker.close() if track.detections >= min_detections]
+    samples = [(track, representative_crops(track, crops_per_track)) for track in tracks]
+    crops = [crop for _, chosen in samples for _, crop in chosen]
+    attributes = iter(module.attributes_for_crops(crops) if crops else [])
+    metrics.count("video_tracks", len(tracks))
+
+    results = []
+    for track, chosen in samples:
+        track_attributes = [next(attributes) for _ in chosen]
+        results.append({
+            **track.to_dict(),
+            "sample_frames": [frame_index for frame_index, _ in chosen],
+            "attributes": merge_attributes(track_attributes),
+        })
+    return {
+        "source": source,
+        "frames_sampled": frames_sampled,
+        "seconds": round(time.time() - start_time, 3),
+        "tracks": results,
+    }
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Per-character attributes of video clips or frame sequences (one track per character).")
+    parser.add_argument("inputs", nargs="+", help="Video files or directories of frames")
+    parser.add_argument("--pipeline", choices=["1", "2"], default="2", help="Pipeline 1 (VLM) or 2 (tagger + VLM)")
+    parser.add_argument("--output", default="video_results.jsonl", help="JSONL output, one record per clip")
+    parser.add_argument("--sample-fps", type=float, default=2.0, help="Frames per second sent to detection")
+    parser.add_argument("--source-fps", type=float, default=None, help="Frame rate of frame directories (default 24)")
+    parser.add_argument("--max-frames", type=int, default=None, help="Sampled frames per clip at most")
+    parser.add_argument("--crops-per-track", type=int, default=3, help="Representative crops per track sent to the models")
+    parser.add_argument("--min-detections", type=int, default=2, help="Drop tracks with fewer detections")
+    parser.add_argument("--batch-size", type=int, default=8, help="Frames per detector batch")
+    parser.add_argument("--max-missed", type=int, default=4, help="Sampled frames a track survives without a detection")
+    parser.add_argument("--config", default=None, help='Pipeline settings as JSON, e.g. \'{"extractor": {"answer_mode": "score"}}\'')
+    parser.add_argument("--dedup", default=None, help="Near-duplicate crop index (SQLite) shared with image runs")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_arg_parser().parse_args(argv)
+    from src.batch_runner import load_pipeline
+
+    load_pipeline(args.pipeline, config=json.loads(args.config) if args.config else None, dedup_path=args.dedup)
+    with open(args.output, "a") as f:
+        for source in args.inputs:
+            try:
+                result = process_video(
+                    source,
+                    pipeline=args.pipeline,
+                    sample_fps=args.sample_fps,
+                    source_fps=args.source_fps,
+                    max_frames=args.max_frames,
+                    crops_per_track=args.crops_per_track,
+                    min_detections=args.min_detections,
+                    batch_size=args.batch_size,
+                    tracker=CharacterTracker(max_missed=args.max_missed),
+                )
+            except Exception as e:
+                result = {"source": source, "error": repr(e)}
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            if "error" in result:
+                print(f"{source}: {result['error']}")
+            else:
+                print(f"{source}: {len(result['tracks'])} characters in {result['frames_sampled']} sampled frames ({result['seconds']}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,252 @@
 import torch
 from PIL import Image
-from lavis.models import load_model_and_preprocess
 import re
 import json
-from typing import List, Dict, Optional
+import os
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple, Union
+
+from src.attributes import ATTRIBUTE_OPTIONS, ATTRIBUTE_QUESTIONS, parse_options
+from src.image_utils import content_hash, to_pil_image
+from src.instrumentation import metrics
+
+
+# Frozen parts of BLIP-2 that its pretrained checkpoint does not cover
+FROZEN_PREFIXES = ("visual_encoder.", "t5_model.", "opt_model.")
+
+
+def _stored_eva_vit_g(path: str):
+    """
+    Replacement for LAVIS's `create_eva_vit_g` that builds the ViT-g without initialising it
+    and assigns the weights memory-mapped from a safetensors file (see utils/fetch_models.py),
+    instead of unpickling eva_vit_g.pth.
+    """
+    from functools import partial
+
+    from lavis.models.eva_vit import VisionTransformer, convert_weights_to_fp16
+    from src.model_store import load_state_dict
+
+    def create_eva_vit_g(img_size=224, drop_path_rate=0.4, use_checkpoint=False, precision="fp16"):
+        # Same architecture as LAVIS's create_eva_vit_g; "meta" skips allocating random weights
+        with torch.device("meta"):
+            model = VisionTransformer(
+                img_size=img_size,
+                patch_size=14,
+                use_mean_pooling=False,
+                embed_dim=1408,
+                depth=39,
+                num_heads=1408 // 88,
+                mlp_ratio=4.3637,
+                qkv_bias=True,
+                drop_path_rate=drop_path_rate,
+                norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+                use_checkpoint=use_checkpoint,
+            )
+        # The file is the ViT's own state dict, so every tensor must be in it
+        model.load_state_dict(load_state_dict(path), strict=True, assign=True)
+        if precision == "fp16":
+            convert_weights_to_fp16(model)  # No copy: stored already converted
+        return model
+
+    return create_eva_vit_g
+
+
+class EmbeddingCache:
+    def __init__(self, max_mb: float = 256):
+        """
+        LRU cache of Q-Former query embeddings keyed by crop content hash.
+
+        Args:
+            max_mb (float): Eviction budget in megabytes. 0 disables the cache.
+        """
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries = OrderedDict()  # key -> tensor
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """Returns the cached embedding (marking it most recently used) or None."""
+        tensor = self._entries.get(key)
+        if tensor is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return tensor
+
+    def put(self, key: str, tensor: torch.Tensor):
+        """Stores an embedding and evicts least recently used entries above the budget."""
+        size = tensor.element_size() * tensor.nelement()
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= self._tensor_bytes(self._entries.pop(key))
+        self._entries[key] = tensor
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= self._tensor_bytes(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        """Drops all entries (counters are kept)."""
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and current occupancy."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_mb": self.size_bytes / (1024 * 1024),
+            "max_mb": self.max_bytes / (1024 * 1024),
+        }
+
+    @staticmethod
+    def _tensor_bytes(tensor: torch.Tensor) -> int:
+        return tensor.element_size() * tensor.nelement()
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class CharacterAttributeExtractor:
-    def __init__(self, model_name="blip2_opt", model_type="pretrain_opt2.7b", device=None):
+    def __init__(self, model_name="blip2_opt", model_type="pretrain_opt2.7b", device=None,
+                 batch_questions=True, max_batch_size=32, num_beams=5, max_new_tokens=30,
+                 embedding_cache_mb=256, result_cache=None, answer_mode="generate", prefix_kv_cache=True,
+                 token_cache_size=4096, quantize=None, quantize_vision=False):
         """
         Initializes a BLIP-2 model (OPT variant) for question-based attribute extraction.
         model_name (str): e.g. "blip2_opt" 
         model_type (str): e.g. "pretrain_opt2.7b"
+        batch_questions (bool): Encode each image once and decode all questions as one padded batch.
+            When False, every question goes through `_ask_vlm` (one full BLIP-2 pass per question).
+        max_batch_size (int): Maximum number of prompts decoded together in batched mode.
+        num_beams (int), max_new_tokens (int): Decoding settings, matching the LAVIS `generate()` defaults.
+        embedding_cache_mb (float): Budget of the crop -> Q-Former embedding LRU cache. 0 disables it.
+        result_cache (Optional[ResultCache]): Persistent cache of raw answers, keyed by
+            (crop hash, prompt, model_type, decoding settings).
+        answer_mode (str): "generate" decodes free text and parses it; "score" ranks the allowed
+            options of each question by likelihood in one teacher-forced pass (always a valid label,
+            with a probability, see `score_attributes_batch`).
+        prefix_kv_cache (bool): OPT only: run the visual tokens + context prefix once per crop and reuse
+            its attention keys/values for every question. Scoring always uses it; decoding only with
+            num_beams=1 (greedy), so with the default num_beams=5 "generate" mode keeps the full
+            `generate()` path. T5's encoder is bidirectional, so its prefix states depend on the
+            question and cannot be reused.
+        token_cache_size (int): Tokenized prompt pieces (contexts, options) kept in memory. Question
+            templates are tokenized once at init.
+        quantize (Optional[str]): "int8" applies dynamic int8 quantization to the Linear layers of the
+            language model (CPU only): weights are stored as int8, activations quantized on the fly.
+        quantize_vision (bool): With `quantize`, also quantize the ViT's Linear layers.
         """
+        if answer_mode not in ("generate", "score"):
+            raise ValueError(f"Unknown answer_mode '{answer_mode}'. Choose 'generate' or 'score'.")
         # Use GPU if available
         self.device = device if device else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_questions = batch_questions
+        self.max_batch_size = max_batch_size
+        self.num_beams = num_beams
+        self.max_new_tokens = max_new_tokens
+        self.embedding_cache = EmbeddingCache(embedding_cache_mb) if embedding_cache_mb else None
+        self.result_cache = result_cache
+        self.model_name = model_name
+        self.model_type = model_type
+        self.answer_mode = answer_mode
+        self.prefix_kv_cache = prefix_kv_cache
+        self.token_cache_size = token_cache_size
+        self._token_cache = OrderedDict()  # text piece -> token ids
+        self.quantize = quantize
+        self.quantize_vision = quantize_vision
+        self.vlm_calls = 0  # questions run through the model (answer cache hits excluded)
 
-        # Load the model and preprocess tools from LAVIS
-        self.model, self.vis_processors, self.txt_processors = load_model_and_preprocess(
-            name=model_name,
-            model_type=model_type,
-            is_eval=True,
-            device=self.device
-        )
+        self.model, self.vis_processors, self.txt_processors = self._load_model(model_name, model_type)
+
+        if quantize:
+            self._quantize(quantize, quantize_vision)
+
+        # Pre-tokenize the question part of every prompt: only the context varies per crop
+        self._is_t5 = hasattr(self.model, "t5_model")
+        self._tokenizer = self.model.t5_tokenizer if self._is_t5 else self.model.opt_tokenizer
+        self._template_ids = {}
+        for question in ATTRIBUTE_QUESTIONS.values():
+            suffix = self._split_prompt(self._build_prompt(question))[1]
+            self._template_ids[suffix] = self._tokenizer(suffix, add_special_tokens=False).input_ids
+
+    def _load_model(self, model_name: str, model_type: str):
+        """
+        Builds the LAVIS model and its preprocessors. When the model store holds the
+        variant as safetensors (utils/fetch_models.py), the architecture is built without
+        LAVIS's own downloads and every part is read from the store without unpickling:
+        the checkpoint (Q-Former, query tokens, LLM projection) and the frozen ViT are
+        assigned memory-mapped, and the language model's `from_pretrained` reads the
+        store's model.safetensors. Parts missing from older stores fall back to the
+        store's torch / Hugging Face caches.
+        """
+        from src.model_store import ModelNotAvailableError, get_store, load_state_dict
+
+        # Before LAVIS is imported: it pulls in transformers / huggingface_hub, which read the cache settings once
+        store = get_store()
+        checkpoint = store.find("blip2", f"{model_name}-{model_type}.safetensors")
+        if checkpoint is None:
+            if store.offline and store.enabled:
+                store.path("blip2", f"{model_name}-{model_type}.safetensors")  # raises ModelNotAvailableError
+            from lavis.models import load_model_and_preprocess
+            return load_model_and_preprocess(name=model_name, model_type=model_type, is_eval=True, device=self.device)
+
+        from lavis.models import load_preprocess, registry
+        from omegaconf import OmegaConf
+
+        import lavis.models.blip2_models.blip2 as lavis_blip2
+
+        model_cls = registry.get_model_class(model_name)
+        config = OmegaConf.load(model_cls.default_config_path(model_type))
+        config.model.load_pretrained = False
+        config.model.load_finetuned = False
+        # Language model saved by fetch_models: from_pretrained of its directory reads model.safetensors
+        llm_key = "t5_model" if "t5_model" in config.model else "opt_model"
+        llm_weights = store.find(config.model[llm_key], "model.safetensors")
+        if llm_weights is not None:
+            config.model[llm_key] = os.path.dirname(llm_weights)
+        vit_weights = None
+        if config.model.get("vit_model", "eva_clip_g") == "eva_clip_g":
+            vit_weights = store.find("blip2", f"eva_vit_g-{config.model.get('vit_precision', 'fp16')}.safetensors")
+
+        create_eva_vit_g = lavis_blip2.create_eva_vit_g
+        if vit_weights is not None:
+            lavis_blip2.create_eva_vit_g = _stored_eva_vit_g(vit_weights)
+        try:
+            model = model_cls.from_config(config.model)
+        except OSError as e:
+            # transformers / timm looked for a file the store's caches do not have
+            raise ModelNotAvailableError(f"{model_name}/{model_type}: {e}") from e
+        finally:
+            lavis_blip2.create_eva_vit_g = create_eva_vit_g
+
+        # Same as LAVIS's own pretrained loading: the checkpoint does not cover the frozen parts.
+        # assign=True keeps the memory-mapped tensors instead of copying them into the parameters
+        incompatible = model.load_state_dict(load_state_dict(checkpoint), strict=False, assign=True)
+        # A checkpoint of another variant (or a stale one) would otherwise leave the Q-Former random
+        missing = [key for key in incompatible.missing_keys if not key.startswith(FROZEN_PREFIXES)]
+        if incompatible.unexpected_keys or missing:
+            raise RuntimeError(
+                f"{checkpoint} does not match {model_name}/{model_type}: "
+                f"unexpected keys {incompatible.unexpected_keys[:5]}, missing keys {missing[:5]}. "
+                "Re-fetch it with `python -m utils.fetch_models`."
+            )
+        model.eval()
+
+        vis_processors, txt_processors = load_preprocess(config.preprocess)
+        if torch.device(self.device).type == "cpu":
+            model = model.float()
+        return model.to(self.device), vis_processors, txt_processors
 
     def _ask_vlm(self, image: Image.Image, question: str) -> str:
         """
@@ -44,6 +269,415 @@ class CharacterAttributeExtractor:
         # The returned `answer_list` is typically a list of strings
         return answer_list[0]
 
+    def _load_image(self, image) -> Image.Image:
+        """Converts an image path, PIL image, array or in-memory crop to an RGB PIL image."""
+        return to_pil_image(image).convert("RGB")
+
+    def _build_prompt(self, question: str, context: Optional[str] = None) -> str:
+        """Builds the full prompt text exactly as the per-question path sends it to `generate()`."""
+        if context:
+            prompt = f"{context} Question: {question}"
+        else:
+            prompt = f"Question: {question}"
+        return f"Question: {prompt} Answer:"
+
+    def _quantize(self, mode: str, include_vision: bool):
+        """Replaces Linear layers of the language model (and optionally the ViT) by dynamically quantized ones."""
+        if mode != "int8":
+            raise ValueError(f"Unknown quantize mode '{mode}'. Only 'int8' is supported.")
+        if torch.device(self.device).type != "cpu":
+            print(f"Warning: int8 dynamic quantization runs on CPU only, keeping full precision on {self.device}.")
+            self.quantize = None
+            return
+
+        model = self.model
+        language_model = "t5_model" if hasattr(model, "t5_model") else "opt_model"
+        targets = [language_model] + (["visual_encoder"] if include_vision else [])
+        for name in targets:
+            module = getattr(model, name).float()
+            setattr(model, name, torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8))
+
+    @staticmethod
+    def _split_prompt(prompt: str) -> Tuple[str, str]:
+        """Splits a `_build_prompt` prompt into its context prefix and its question suffix."""
+        cut = prompt.rfind(" Question: ")
+        return prompt[:cut], prompt[cut:]
+
+    def _token_ids(self, text: str) -> List[int]:
+        """Token ids of a prompt piece (no special tokens), from the template table or the LRU cache."""
+        ids = self._template_ids.get(text)
+        if ids is not None:
+            return ids
+        ids = self._token_cache.get(text)
+        if ids is None:
+            ids = self._tokenizer(text, add_special_tokens=False).input_ids
+            self._token_cache[text] = ids
+            if len(self._token_cache) > self.token_cache_size:
+                self._token_cache.popitem(last=False)
+        else:
+            self._token_cache.move_to_end(text)
+        return ids
+
+    def _prompt_ids(self, prompt: str) -> List[int]:
+        """Same ids as tokenizing the full prompt: pieces split on a space tokenize independently."""
+        prefix, suffix = self._split_prompt(prompt)
+        ids = self._token_ids(prefix) + self._token_ids(suffix)
+        if self._is_t5:
+            return ids + [self._tokenizer.eos_token_id]
+        return [self._tokenizer.bos_token_id] + ids
+
+    def _option_ids(self, option: str) -> List[int]:
+        """Target ids of an answer option, including the end-of-answer token."""
+        if self._is_t5:
+            return self._token_ids(option) + [self._tokenizer.eos_token_id]
+        return self._token_ids(" " + option) + [self.model.eos_token_id]
+
+    def _pad(self, sequences: List[List[int]], side: str = "right") -> Tuple[torch.Tensor, torch.Tensor]:
+        """Pads token id lists into (input_ids, attention_mask) tensors on the model's device."""
+        max_len = max(len(ids) for ids in sequences)
+        input_ids = torch.full((len(sequences), max_len), self._tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            span = slice(max_len - len(ids), max_len) if side == "left" else slice(0, len(ids))
+            input_ids[row, span] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, span] = 1
+        return input_ids.to(self.device), attention_mask.to(self.device)
+
+    def encode_images(self, images: List[Image.Image]) -> torch.Tensor:
+        """
+        Runs the vision encoder and Q-Former once over a batch of images.
+
+        Args:
+            images (List[PIL.Image.Image]): RGB images.
+
+        Returns:
+            torch.Tensor: Q-Former query output, shape (num_images, num_query_tokens, hidden_size).
+        """
+        model = self.model
+        processed = torch.stack([self.vis_processors["eval"](image) for image in images]).to(self.device)
+
+        with torch.no_grad():
+            with model.maybe_autocast():
+                image_embeds = model.ln_vision(model.visual_encoder(processed))
+            image_embeds = image_embeds.float()
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=self.device)
+
+            query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = model.Qformer.bert(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+        return query_output.last_hidden_state
+
+    def get_query_embeddings(self, images: List[Image.Image], keys: Optional[List[str]] = None) -> torch.Tensor:
+        """
+        Same as `encode_images`, but served from the embedding cache where possible.
+        Only the crops that miss the cache go through the vision encoder (as one batch).
+        `keys` are the crops' content hashes, if already computed.
+        """
+        if self.embedding_cache is None:
+            with metrics.span("vlm_encode"):
+                return self.encode_images(images)
+
+        if keys is None:
+            keys = [content_hash(image) for image in images]
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        metrics.count("vlm_embedding_cache_hits", len(images) - len(missing))
+        if missing:
+            with metrics.span("vlm_encode"):
+                encoded = self.encode_images([images[idx] for idx in missing])
+            for row, idx in enumerate(missing):
+                # Clone so the cached entry does not keep the whole batch tensor alive
+                embeddings[idx] = encoded[row].clone()
+                self.embedding_cache.put(keys[idx], embeddings[idx])
+
+        return torch.stack(embeddings)
+
+    def _generate(self, query_output: torch.Tensor, prompts: List[str]) -> List[str]:
+        """
+        Decodes one answer per (query_output row, prompt) pair as a single padded batch.
+        Follows LAVIS' BLIP-2 `generate()` for the T5 and OPT families, without the vision pass.
+        """
+        model = self.model
+
+        with torch.no_grad():
+            if hasattr(model, "t5_model"):
+                inputs_t5 = model.t5_proj(query_output)
+                atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long, device=self.device)
+
+                input_ids, input_mask = self._pad([self._prompt_ids(prompt) for prompt in prompts])
+                encoder_atts = torch.cat([atts_t5, input_mask], dim=1)
+
+                with model.maybe_autocast(dtype=torch.bfloat16):
+                    inputs_embeds = model.t5_model.encoder.embed_tokens(input_ids)
+                    inputs_embeds = torch.cat([inputs_t5, inputs_embeds], dim=1)
+                    outputs = model.t5_model.generate(
+                        inputs_embeds=inputs_embeds,
+                        attention_mask=encoder_atts,
+                        num_beams=self.num_beams,
+                        max_new_tokens=self.max_new_tokens,
+                        min_length=1,
+                    )
+                output_text = model.t5_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            else:
+                inputs_opt = model.opt_proj(query_output)
+                atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long, device=self.device)
+
+                # Decoder-only model: pad on the left so every prompt ends right before generation starts
+                input_ids, input_mask = self._pad([self._prompt_ids(prompt) for prompt in prompts], side="left")
+                attention_mask = torch.cat([atts_opt, input_mask], dim=1)
+
+                with model.maybe_autocast():
+                    outputs = model.opt_model.generate(
+                        input_ids=input_ids,
+                        query_embeds=inputs_opt.repeat_interleave(self.num_beams, dim=0),
+                        attention_mask=attention_mask,
+                        num_beams=self.num_beams,
+                        max_new_tokens=self.max_new_tokens,
+                        eos_token_id=model.eos_token_id,
+                    )
+                prompt_length = input_ids.shape[1]
+                output_text = model.opt_tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+
+        return [text.strip() for text in output_text]
+
+    @staticmethod
+    def _sequence_log_probs(logits: torch.Tensor, targets: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """Sums the log-probabilities of `targets` under `logits` over the positions in `mask`."""
+        log_probs = logits.float().log_softmax(dim=-1)
+        token_log_probs = log_probs.gather(-1, targets.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+        return (token_log_probs * mask).sum(dim=-1)
+
+    def _score_options(self, query_output: torch.Tensor, prompts: List[str], options: List[List[str]]) -> List[dict]:
+        """
+        Closed-vocabulary answering: scores every allowed option of every prompt as a forced
+        continuation, in one forward pass over all (prompt, option) rows.
+
+        Args:
+            query_output (torch.Tensor): Q-Former output, one row per prompt.
+            prompts (List[str]): Full prompts (see `_build_prompt`).
+            options (List[List[str]]): Allowed answers of each prompt.
+
+        Returns:
+            List[dict]: Per prompt, {"answer": best option, "probability": its probability,
+            "scores": {option: probability}}; probabilities are normalised over the options.
+        """
+        model = self.model
+        row_prompt = [p for p, prompt_options in enumerate(options) for _ in prompt_options]
+        flat_options = [option for prompt_options in options for option in prompt_options]
+        row_index = torch.tensor(row_prompt, device=self.device)
+
+        with torch.no_grad():
+            if hasattr(model, "t5_model"):
+                # Encoder once per prompt, decoder once per (prompt, option) row
+                inputs_t5 = model.t5_proj(query_output)
+                atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long, device=self.device)
+                input_ids, input_mask = self._pad([self._prompt_ids(prompt) for prompt in prompts])
+                encoder_atts = torch.cat([atts_t5, input_mask], dim=1)
+                target_ids, target_mask = self._pad([self._option_ids(option) for option in flat_options])
+                labels = target_ids.masked_fill(target_mask == 0, -100)
+
+                with model.maybe_autocast(dtype=torch.bfloat16):
+                    inputs_embeds = model.t5_model.encoder.embed_tokens(input_ids)
+                    inputs_embeds = torch.cat([inputs_t5, inputs_embeds], dim=1)
+                    encoder_hidden = model.t5_model.encoder(
+                        inputs_embeds=inputs_embeds, attention_mask=encoder_atts, return_dict=True
+                    ).last_hidden_state
+                    outputs = model.t5_model(
+                        encoder_outputs=(encoder_hidden[row_index],),
+                        attention_mask=encoder_atts[row_index],
+                        labels=labels,
+                        return_dict=True,
+                    )
+                scores = self._sequence_log_probs(outputs.logits, target_ids, target_mask)
+            else:
+                # Decoder-only: each row is [query tokens][prompt][option + end-of-answer], right padded
+                prompt_ids = [self._prompt_ids(prompt) for prompt in prompts]
+                rows = [prompt_ids[p] + self._option_ids(option) for p, option in zip(row_prompt, flat_options)]
+                input_ids, text_mask = self._pad(rows)
+                option_mask = self._target_mask([len(prompt_ids[p]) for p in row_prompt], [len(row) for row in rows])
+
+                inputs_opt = model.opt_proj(query_output)[row_index]
+                num_query = inputs_opt.shape[1]
+                attention_mask = torch.cat(
+                    [torch.ones((len(rows), num_query), dtype=torch.long, device=self.device), text_mask], dim=1
+                )
+                with model.maybe_autocast():
+                    inputs_embeds = model.opt_model.get_input_embeddings()(input_ids)
+                    inputs_embeds = torch.cat([inputs_opt, inputs_embeds], dim=1)
+                    logits = model.opt_model(
+                        inputs_embeds=inputs_embeds, attention_mask=attention_mask, return_dict=True
+                    ).logits
+                scores = self._sequence_log_probs(logits[:, num_query:-1], input_ids[:, 1:], option_mask)
+
+        return self._rank_options(scores, options)
+
+    @staticmethod
+    def _rank_options(scores: torch.Tensor, options: List[List[str]]) -> List[dict]:
+        """Turns per-(prompt, option) log-likelihoods into the best option and probabilities per prompt."""
+        results = []
+        start = 0
+        for prompt_options in options:
+            probs = scores[start:start + len(prompt_options)].softmax(dim=0).tolist()
+            start += len(prompt_options)
+            best = max(range(len(prompt_options)), key=lambda i: probs[i])
+            results.append({
+                "answer": prompt_options[best],
+                "probability": round(probs[best], 4),
+                "scores": {option: round(prob, 4) for option, prob in zip(prompt_options, probs)},
+            })
+        return results
+
+    def _target_mask(self, starts: List[int], ends: List[int]) -> torch.Tensor:
+        """
+        Mask over next-token predictions (position j predicts token j + 1) selecting, per row,
+        the predictions of tokens [start, end).
+        """
+        mask = torch.zeros((len(starts), max(ends) - 1), device=self.device)
+        for row, (start, end) in enumerate(zip(starts, ends)):
+            mask[row, start - 1:end - 1] = 1
+        return mask
+
+    # Shared-prefix KV cache (decoder-only models)
+
+    def _opt_prefix_states(self, query_output: torch.Tensor, rows: List[int], prompts: List[str]):
+        """
+        Runs [visual query tokens][context prefix] once per distinct (image, context) pair.
+
+        Returns:
+            (past_key_values, prefix attention mask, group index of every prompt, suffix ids of every prompt)
+        """
+        model = self.model
+        groups: Dict[Tuple[int, str], int] = {}
+        group_of, suffix_ids = [], []
+        for row, prompt in zip(rows, prompts):
+            prefix, suffix = self._split_prompt(prompt)
+            group_of.append(groups.setdefault((row, prefix), len(groups)))
+            suffix_ids.append(self._token_ids(suffix))
+
+        keys = list(groups)
+        prefix_ids, prefix_mask = self._pad(
+            [[self._tokenizer.bos_token_id] + self._token_ids(prefix) for _, prefix in keys], side="left"
+        )
+        inputs_opt = model.opt_proj(query_output[torch.tensor([row for row, _ in keys], device=query_output.device)])
+        attention_mask = torch.cat(
+            [torch.ones(inputs_opt.size()[:-1], dtype=torch.long, device=self.device), prefix_mask], dim=1
+        )
+        with model.maybe_autocast():
+            inputs_embeds = model.opt_model.get_input_embeddings()(prefix_ids)
+            inputs_embeds = torch.cat([inputs_opt, inputs_embeds], dim=1)
+            outputs = model.opt_model(
+                inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True, return_dict=True
+            )
+        return outputs.past_key_values, attention_mask, group_of, suffix_ids
+
+    @staticmethod
+    def _select_past(past_key_values, index: torch.Tensor):
+        """Gathers rows of a KV cache (one row per sequence continuing that prefix)."""
+        return tuple(tuple(state.index_select(0, index) for state in layer) for layer in past_key_values)
+
+    def _score_options_with_prefix(self, query_output: torch.Tensor, rows: List[int], prompts: List[str], options: List[List[str]]) -> List[dict]:
+        """`_score_options` for OPT, reusing the prefix KV cache: only question + option tokens are run per row."""
+        model = self.model
+        with torch.no_grad():
+            past, prefix_mask, group_of, suffix_ids = self._opt_prefix_states(query_output, rows, prompts)
+
+            row_prompt = [p for p, prompt_options in enumerate(options) for _ in prompt_options]
+            flat_options = [option for prompt_options in options for option in prompt_options]
+            scores = []
+            # The expanded cache is large (layers x prefix length per row): run in chunks
+            for start in range(0, len(row_prompt), self.max_batch_size):
+                chunk_prompts = row_prompt[start:start + self.max_batch_size]
+                chunk_options = flat_options[start:start + self.max_batch_size]
+                sequences = [suffix_ids[p] + self._option_ids(option) for p, option in zip(chunk_prompts, chunk_options)]
+                input_ids, text_mask = self._pad(sequences)
+                option_mask = self._target_mask([len(suffix_ids[p]) for p in chunk_prompts], [len(ids) for ids in sequences])
+
+                index = torch.tensor([group_of[p] for p in chunk_prompts], device=self.device)
+                with model.maybe_autocast():
+                    logits = model.opt_model(
+                        input_ids=input_ids,
+                        attention_mask=torch.cat([prefix_mask[index], text_mask], dim=1),
+                        past_key_values=self._select_past(past, index),
+                        return_dict=True,
+                    ).logits
+                scores.append(self._sequence_log_probs(logits[:, :-1], input_ids[:, 1:], option_mask))
+        return self._rank_options(torch.cat(scores), options)
+
+    def _generate_with_prefix(self, query_output: torch.Tensor, rows: List[int], prompts: List[str]) -> List[str]:
+        """
+        Greedy decoding for OPT (num_beams=1) on top of the prefix KV cache. Stops on the same
+        end token and cleans up the text the same way as `_generate`, so both paths give the
+        same answers.
+        """
+        model = self.model
+        eos_token_id = model.eos_token_id
+        with torch.no_grad():
+            past, prefix_mask, group_of, suffix_ids = self._opt_prefix_states(query_output, rows, prompts)
+
+            # Left-pad the question suffixes so that generation starts at the same position for every row
+            input_ids, suffix_mask = self._pad(suffix_ids, side="left")
+            index = torch.tensor(group_of, device=self.device)
+            attention_mask = torch.cat([prefix_mask[index], suffix_mask], dim=1)
+            past = self._select_past(past, index)
+
+            generated = []
+            finished = torch.zeros(len(prompts), dtype=torch.bool, device=self.device)
+            for _ in range(self.max_new_tokens):
+                with model.maybe_autocast():
+                    outputs = model.opt_model(
+                        input_ids=input_ids, attention_mask=attention_mask, past_key_values=past, use_cache=True, return_dict=True
+                    )
+                next_tokens = outputs.logits[:, -1].argmax(dim=-1)
+                next_tokens = next_tokens.masked_fill(finished, self._tokenizer.pad_token_id)
+                generated.append(next_tokens)
+                finished |= next_tokens == eos_token_id
+                if finished.all():
+                    break
+                past = outputs.past_key_values
+                input_ids = next_tokens.unsqueeze(1)
+                attention_mask = torch.cat([attention_mask, torch.ones_like(input_ids)], dim=1)
+
+        output_text = self._tokenizer.batch_decode(torch.stack(generated, dim=1), skip_special_tokens=True)
+        return [text.strip() for text in output_text]
+
+    def settings(self) -> dict:
+        """Effective settings that change answers (defaults included): results cached per image must be keyed by them."""
+        return {
+            "model": f"{self.model_name}/{self.model_type}",
+            "answer_mode": self.answer_mode,
+            "num_beams": self.num_beams,
+            "max_new_tokens": self.max_new_tokens,
+            "precision": [self.quantize, self.quantize_vision] if self.quantize else "full",
+        }
+
+    def _answer_cache_key(self, crop_key: str, prompt: str, mode: str) -> str:
+        """Result-cache key of one answer: the crop, the full prompt (question + context), the model and mode."""
+        settings = "score" if mode == "score" else (self.num_beams, self.max_new_tokens)
+        precision = (self.quantize, self.quantize_vision) if self.quantize else "full"
+        return self.result_cache.make_key(crop_key, prompt, self.model_name, self.model_type, settings, precision)
+
+    def _parse_answers(self, questions: Dict[str, str], answers: Dict[str, Union[str, dict]]) -> Dict[str, str]:
+        """Parse the raw answers into structured fields."""
+        parsed = {}
+        for attr, question in questions.items():
+            answer = answers[attr]
+            if isinstance(answer, dict):
+                # Scored answers are always one of the options
+                parsed[attr] = answer["answer"]
+                continue
+            # Ensure the answer is within the predefined choices (as a whole word)
+            options = ATTRIBUTE_OPTIONS.get(attr) or parse_options(question)
+            if not options or any(re.search(rf"\b{re.escape(option.lower())}\b", answer.lower()) for option in options):
+                parsed[attr] = answer
+            else:
+                parsed[attr] = "Unknown"
+        return parsed
+
     # def extract_attributes(self, image_path: str, topics: List[str] =None, context: str = None) -> dict:
     #     """
     #     Extract structured attributes from an image by asking five broad questions.
@@ -109,39 +743,26 @@ class CharacterAttributeExtractor:
     #     return parsed
 
 
-    def extract_attributes(self, image_path: str, topics: Optional[List[str]] = None, context: str = None) -> Dict[str, str]:
+    def extract_attributes(self, image_path: Union[str, Image.Image], topics: Optional[List[str]] = None, context: str = None) -> Dict[str, str]:
         """
         Extract structured attributes from an image by asking broad questions.
         Supports optional filtering via 'topics' and integrates previous 'context'.
+        `image_path` may also be a PIL image or an in-memory `PersonCrop`.
         Returns a dictionary of extracted attributes.
         """
+        if self.batch_questions:
+            return self.extract_attributes_batch([image_path], topics=topics, context=context)[0]
+
         # Load image
-        image = Image.open(image_path).convert("RGB")
-
-        # Define attribute-based questions
-        questions = {
-            "Art Style": "What is the art style? Choose one: anime, cartoon, semi-realistic, realistic, 3D-rendered.",
-            "Age": "What is the character’s age group? Choose from: child, teen, young adult, middle-aged, elderly.",
-            "Gender": "What is the character’s gender? Choose from: male or female.",
-            "Ethnicity": "What is the character’s ethnicity? Choose from: Asian, African, Caucasian, Hispanic, other.",
-            "Hair Color": "What is the character’s hair color? Choose from: black, blonde, red, blue, green, brown, white, gray.",
-            "Hair Style": "What is the character’s hair style? Choose from: ponytail, curly, straight, bun, braided, short bob.",
-            "Hair Length": "What is the character’s hair length? Choose from: short, medium, long.",
-            "Eye Color": "What is the character’s eye color? Choose from: black, brown, blue, green, gray, hazel, red.",
-            "Body Type": "What is the character’s body type? Choose from: slim, muscular, curvy, average.",
-            "Dress & Clothing": "What is the character’s outfit style? Choose from: casual, formal, traditional, futuristic, uniform.",
-            "Facial Expression": "What is the character’s facial expression? Choose from: neutral, smiling, serious, surprised, sad.",
-            "Accessories & Unique Traits": "Does the character have any unique traits? Choose from: scars, tattoos, glasses, hat, jewelry, none."
-        }
+        image = self._load_image(image_path)
 
         # Filter questions based on selected topics
+        questions = ATTRIBUTE_QUESTIONS
         if topics:
             questions = {k: v for k, v in questions.items() if k in topics}
 
-        # Store raw answers
-        answers = {}
-
         # Ask BLIP-2 model each question
+        answers = {}
         for key, question in questions.items():
             if context:
                 prompt = f"{context} Question: {question}"
@@ -149,18 +770,161 @@ class CharacterAttributeExtractor:
                 prompt = f"Question: {question}"
 
             # Call BLIP-2 or Vision-Language Model
-            answers[key] = self._ask_vlm(image, prompt)
+            with metrics.span("vlm_question", attribute=key, mode="generate"):
+                answers[key] = self._ask_vlm(image, prompt)
+            self.vlm_calls += 1
+            metrics.count("vlm_calls", attribute=key, mode="generate")
 
-        # Parse the final answers into structured fields
-        parsed = {}
-        for attr, question in questions.items():
-            # Ensure the answer is within the predefined choices
-            if any(option in answers[attr].lower() for option in question.lower()):
-                parsed[attr] = answers[attr]
-            else:
-                parsed[attr] = "Unknown"
+        return self._parse_answers(questions, answers)
 
-        return parsed
+    def extract_attributes_batch(
+        self,
+        images: List[Union[str, Image.Image]],
+        topics: Optional[Union[List[str], List[List[str]]]] = None,
+        context: Optional[Union[str, List[Optional[str]]]] = None,
+    ) -> List[Dict[str, str]]:
+        """
+        Batched variant of `extract_attributes` over several crops (e.g. all crops of one image).
+
+        Every image goes through preprocessing, the vision encoder and the Q-Former exactly once;
+        all (image, question) prompts are then decoded (or scored, see `answer_mode`) together in
+        padded batches of up to `max_batch_size`.
+
+        Args:
+            images (List[Union[str, PIL.Image.Image, PersonCrop]]): In-memory crops or crop paths.
+            topics: Topics shared by all images, or one topic list per image.
+            context: Context shared by all images, or one context string per image.
+
+        Returns:
+            List[Dict[str, str]]: Parsed attributes, one dict per input image.
+        """
+        with metrics.span("vlm", mode=self.answer_mode):
+            per_image_questions, answers = self._answer_questions(images, topics, context, self.answer_mode)
+        return [
+            self._parse_answers(questions, image_answers)
+            for questions, image_answers in zip(per_image_questions, answers)
+        ]
+
+    def score_attributes_batch(
+        self,
+        images: List[Union[str, Image.Image]],
+        topics: Optional[Union[List[str], List[List[str]]]] = None,
+        context: Optional[Union[str, List[Optional[str]]]] = None,
+    ) -> List[Dict[str, dict]]:
+        """
+        Closed-vocabulary variant of `extract_attributes_batch`: each attribute's allowed options are
+        ranked by likelihood instead of decoding free text.
+
+        Returns:
+            List[Dict[str, dict]]: Per image and attribute, {"answer": option, "probability": float,
+            "scores": {option: probability}}.
+        """
+        with metrics.span("vlm", mode="score"):
+            _, answers = self._answer_questions(images, topics, context, "score")
+        return answers
+
+    def _answer_questions(self, images, topics, context, mode: str):
+        """Shared body of the batched methods: returns (questions per image, raw answers per image)."""
+        if not images:
+            return [], []
+
+        if topics and isinstance(topics[0], (list, tuple)):
+            per_image_topics = list(topics)
+        else:
+            per_image_topics = [topics] * len(images)
+        if isinstance(context, (list, tuple)):
+            per_image_context = list(context)
+        else:
+            per_image_context = [context] * len(images)
+
+        # Build the questions and prompts for every image
+        per_image_questions = []
+        requests = []  # (image index, attribute, prompt)
+        for idx, (image_topics, image_context) in enumerate(zip(per_image_topics, per_image_context)):
+            questions = ATTRIBUTE_QUESTIONS
+            if image_topics:
+                questions = {k: v for k, v in questions.items() if k in image_topics}
+            per_image_questions.append(questions)
+            for key, question in questions.items():
+                requests.append((idx, key, self._build_prompt(question, image_context)))
+
+        pil_images = [self._load_image(image) for image in images]
+        crop_keys = [content_hash(image) for image in pil_images]
+        answers = [{} for _ in images]
+
+        # Answers already in the persistent cache skip the model entirely
+        if self.result_cache is not None:
+            remaining = []
+            for idx, key, prompt in requests:
+                cached = self.result_cache.get_json("vlm", self._answer_cache_key(crop_keys[idx], prompt, mode))
+                if cached is None:
+                    remaining.append((idx, key, prompt))
+                else:
+                    answers[idx][key] = cached
+            metrics.count("vlm_answer_cache_hits", len(requests) - len(remaining))
+            requests = remaining
+
+        if requests:
+            self.vlm_calls += len(requests)
+            # Encode every image that still has questions once (or reuse its cached embeddings)
+            needed = sorted({idx for idx, _, _ in requests})
+            row_of = {idx: row for row, idx in enumerate(needed)}
+            query_output = self.get_query_embeddings(
+                [pil_images[idx] for idx in needed], keys=[crop_keys[idx] for idx in needed]
+            )
+
+            # Decode (or score) all prompts in padded batches
+            for start in range(0, len(requests), self.max_batch_size):
+                chunk = requests[start:start + self.max_batch_size]
+                for (idx, key, prompt), answer in zip(chunk, self._answer_chunk(query_output, row_of, chunk, mode)):
+                    answers[idx][key] = answer
+                    if self.result_cache is not None:
+                        self.result_cache.put_json("vlm", self._answer_cache_key(crop_keys[idx], prompt, mode), answer)
+
+        return per_image_questions, answers
+
+    def _answer_chunk(self, query_output: torch.Tensor, row_of: Dict[int, int], chunk: list, mode: str) -> list:
+        """Answers one batch of (image index, attribute, prompt) requests, in order."""
+        results = [None] * len(chunk)
+        # Open questions (no options to score) are always decoded
+        scored = [i for i, (_, key, _) in enumerate(chunk) if mode == "score" and ATTRIBUTE_OPTIONS.get(key)]
+        generated = sorted(set(range(len(chunk))) - set(scored))
+
+        for positions, run in ((scored, "score"), (generated, "generate")):
+            if not positions:
+                continue
+            row_list = [row_of[chunk[i][0]] for i in positions]
+            rows = torch.tensor(row_list, device=query_output.device)
+            prompts = [chunk[i][2] for i in positions]
+            # Decoder-only models reuse the (visual tokens + context) prefix across questions
+            use_prefix = self.prefix_kv_cache and not self._is_t5
+            start_time = time.perf_counter()
+            with metrics.span(f"vlm_{run}"):
+                if run == "score":
+                    options = [ATTRIBUTE_OPTIONS[chunk[i][1]] for i in positions]
+                    if use_prefix:
+                        outputs = self._score_options_with_prefix(query_output, row_list, prompts, options)
+                    else:
+                        outputs = self._score_options(query_output[rows], prompts, options)
+                elif use_prefix and self.num_beams == 1:
+                    outputs = self._generate_with_prefix(query_output, row_list, prompts)
+                else:
+                    outputs = self._generate(query_output[rows], prompts)
+            for i, output in zip(positions, outputs):
+                results[i] = output
+
+            if metrics.enabled:
+                # Questions of a batch run together, so their own latency is not measurable:
+                # each gets an equal share of the batch time (only the unbatched
+                # `extract_attributes` path has a real per-question `vlm_question` span)
+                per_question = (time.perf_counter() - start_time) / len(positions)
+                for i, output in zip(positions, outputs):
+                    metrics.observe("vlm_question_seconds", per_question, attribute=chunk[i][1], mode=run)
+                    metrics.count("vlm_calls", attribute=chunk[i][1], mode=run)
+                    if run == "generate":
+                        # Tokenized directly: answers must not evict prompt pieces from the token cache
+                        metrics.count("generated_tokens", len(self._tokenizer(output, add_special_tokens=False).input_ids))
+        return results
 
 if __name__ == "__main__":
     # Replace with your image path
@@ -177,3 +941,7 @@ if __name__ == "__main__":
 
     # Print output in JSON
     print(json.dumps(attributes, indent=4))
+
+    # Closed-vocabulary scoring: always one of the listed options, with its probability
+    scored = extractor.score_attributes_batch([image_path])[0]
+    print(json.dumps({attr: [result["answer"], result["probability"]] for attr, result in scored.items()}, indent=4))
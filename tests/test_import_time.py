@@ -0,0 +1,12 @@
+import os
+
+from utils.check_import_time import LIGHT_MODULES, check
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_light_modules_import_fast(monkeypatch):
+    # Every module is imported in a fresh interpreter, which resolves `src.*` from the cwd
+    monkeypatch.chdir(REPO_ROOT)
+    _, failures = check(LIGHT_MODULES, budget=1.0)
+    assert not failures, "\n".join(failures)
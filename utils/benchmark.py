@@ -0,0 +1,259 @@
+"""
+Per-stage benchmark of Pipeline 1 and Pipeline 2 over testing/test_images:
+
+    python -m utils.benchmark --pipelines 1 2 --repeats 3 --output bench.json
+    python -m utils.benchmark --pipelines 1 2 --repeats 3 --baseline bench_baseline.json
+
+Models are loaded and warmed up first (reported as startup). Every image then goes through
+decode -> detect -> crop I/O -> tag (Pipeline 2) -> VLM one stage at a time, so each stage's
+wall and CPU time is its own. The embedding cache is cleared before every repeat and no
+result cache is used, so repeats measure the same work. The report (JSON) holds per-stage
+times per image, VLM calls and time per question, images/sec, and the peak RSS of the
+whole run (all pipelines share one process). Compared with a --baseline, every metric that
+got worse by more than --tolerance is listed. With --fail-on-regression the exit code is
+then 1.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Metrics where a higher value is better; all others are costs
+HIGHER_IS_BETTER = ("images_per_second",)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    def __init__(self):
+        """Accumulates wall and CPU (process, all threads) seconds per stage name."""
+        self.wall = {}
+        self.cpu = {}
+
+    def run(self, stage: str, fn, *args, **kwargs):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = fn(*args, **kwargs)
+        self.wall[stage] = self.wall.get(stage, 0.0) + time.perf_counter() - wall_start
+        self.cpu[stage] = self.cpu.get(stage, 0.0) + time.process_time() - cpu_start
+        return result
+
+
+def image_paths(folder: str, limit=None):
+    """Images of the folder in numeric order (1.jpg, 2.jpg, ..., 10.jpg), for a fixed run order."""
+    names = [name for name in os.listdir(folder) if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))]
+    names.sort(key=lambda name: (int(re.sub(r"\D", "", name) or 0), name))
+    paths = [os.path.join(folder, name) for name in names]
+    return paths[:limit] if limit else paths
+
+
+def load_models(pipelines, model_name, model_type):
+    """Builds the models the pipelines need and warms them up, timing each step."""
+    from src.model_registry import get_cropper, get_extractor, get_tagger, registry
+
+    timer = StageTimer()
+    models = {"cropper": timer.run("cropper", get_cropper)}
+    if "2" in pipelines:
+        models["tagger"] = timer.run("tagger", get_tagger)
+    models["extractor"] = timer.run("extractor", get_extractor, model_name, model_type)
+    timer.run("warm_up", registry.warm_up)
+
+    startup = {
+        stage: {"wall_seconds": round(timer.wall[stage], 3), "cpu_seconds": round(timer.cpu[stage], 3)}
+        for stage in timer.wall
+    }
+    startup["peak_rss_mb"] = peak_rss_mb()
+    return models, startup
+
+
+def run_once(pipeline, paths, models, crops_root):
+    """One pass over the images; returns (StageTimer, characters, VLM calls, wall seconds)."""
+    from PIL import Image
+    from src.batch_runner import crops_dir_for
+    from src.pipeline2 import process_characters_batch
+    from src.routing_policy import RoutingPolicy
+
+    cropper, extractor, tagger = models["cropper"], models["extractor"], models.get("tagger")
+    policy = RoutingPolicy.load("routing_policy.json") if os.path.exists("routing_policy.json") else RoutingPolicy()
+    if getattr(extractor, "embedding_cache", None) is not None:
+        extractor.embedding_cache.clear()
+
+    def decode(path):
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    timer = StageTimer()
+    characters = vlm_calls = 0
+    start_time = time.perf_counter()
+    for path in paths:
+        image = timer.run("decode", decode, path)
+        crops = timer.run("detect", cropper.detect_crops, image)
+        if crops_root:
+            timer.run("crop_io", cropper.save_crops, crops, crops_dir_for(path, crops_root))
+        characters += len(crops)
+        if not crops:
+            continue
+
+        # Counted by the extractor, so cached and skipped questions are not included
+        before = extractor.vlm_calls
+        if pipeline == "1":
+            timer.run("vlm", extractor.extract_attributes_batch, crops)
+        else:
+            outputs = timer.run("tag", tagger.predict_batch, crops, threshold=0.4)
+            timer.run("vlm", process_characters_batch, crops, tagger, extractor, danbooru_outputs=outputs, policy=policy)
+        vlm_calls += extractor.vlm_calls - before
+    return timer, characters, vlm_calls, time.perf_counter() - start_time
+
+
+def benchmark_pipeline(pipeline, paths, models, repeats, warm_up_images, crops_root):
+    """Warm-up pass, then `repeats` measured passes; per-image metrics are the median over repeats."""
+    if warm_up_images:
+        run_once(pipeline, paths[:warm_up_images], models, crops_root)
+
+    runs = [run_once(pipeline, paths, models, crops_root) for _ in range(repeats)]
+    images = len(paths)
+    stages = {}
+    stage_names = list(dict.fromkeys(stage for timer, *_ in runs for stage in timer.wall))
+    for stage in stage_names:
+        wall = [timer.wall.get(stage, 0.0) * 1000 / images for timer, *_ in runs]
+        cpu = [timer.cpu.get(stage, 0.0) * 1000 / images for timer, *_ in runs]
+        stages[stage] = {
+            "wall_ms_per_image": round(statistics.median(wall), 1),
+            "wall_ms_per_image_min": round(min(wall), 1),
+            "cpu_ms_per_image": round(statistics.median(cpu), 1),
+        }
+
+    _, characters, vlm_calls, _ = runs[0]
+    seconds = [elapsed for *_, elapsed in runs]
+    vlm_seconds = statistics.median(timer.wall.get("vlm", 0.0) for timer, *_ in runs)
+    return {
+        "images": images,
+        "characters": characters,
+        "repeats": repeats,
+        "stages": stages,
+        "vlm_calls": vlm_calls,
+        "vlm_calls_per_image": round(vlm_calls / images, 2),
+        "vlm_ms_per_question": round(vlm_seconds * 1000 / vlm_calls, 1) if vlm_calls else None,
+        "seconds_per_image": round(statistics.median(seconds) / images, 3),
+        "images_per_second": round(images / statistics.median(seconds), 3),
+    }
+
+
+def environment(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    info = {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": f"{args.model_name}/{args.model_type}",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        info.update(torch=torch.__version__, torch_threads=torch.get_num_threads(), cuda=torch.cuda.is_available())
+    return info
+
+
+def flatten(report, prefix="") -> dict:
+    """Numeric metrics of a report as {"pipelines.2.stages.vlm.wall_ms_per_image": value}."""
+    metrics = {}
+    for key, value in report.items():
+        if key == "environment":
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            metrics.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[name] = value
+    return metrics
+
+
+def compare(report, baseline, tolerance):
+    """Rows (metric, baseline, current, relative change, regression) for metrics present in both."""
+    current, previous = flatten(report), flatten(baseline)
+    rows = []
+    for metric in sorted(set(current) & set(previous)):
+        old, new = previous[metric], current[metric]
+        if old == 0:
+            continue
+        change = (new - old) / abs(old)
+        worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+        # Counts (images, repeats, ...) are not performance: report them, never flag them
+        is_cost = metric.endswith(("_ms_per_image", "_ms_per_image_min", "_seconds", "seconds_per_image",
+                                   "_per_question", "peak_rss_mb", "vlm_calls", "vlm_calls_per_image") + HIGHER_IS_BETTER)
+        rows.append((metric, old, new, change, is_cost and worse > tolerance))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pipelines", nargs="+", choices=["1", "2"], default=["1", "2"])
+    parser.add_argument("--images", default="testing/test_images")
+    parser.add_argument("--limit", type=int, default=None, help="Use only the first N images")
+    parser.add_argument("--repeats", type=int, default=3, help="Measured passes per pipeline")
+    parser.add_argument("--warm-up-images", type=int, default=2, help="Images of the unmeasured first pass")
+    parser.add_argument("--no-crop-io", action="store_true", help="Keep crops in memory (skip the crop I/O stage)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--model-name", default="blip2_t5")
+    parser.add_argument("--model-type", default="pretrain_flant5xl")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    parser.add_argument("--baseline", default=None, help="Report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative slowdown flagged as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    paths = image_paths(args.images, args.limit)
+    models, startup = load_models(args.pipelines, args.model_name, args.model_type)
+    report = {"environment": environment(args), "startup": startup, "pipelines": {}}
+
+    with tempfile.TemporaryDirectory() as crops_root:
+        for pipeline in args.pipelines:
+            print(f"Benchmarking pipeline {pipeline} on {len(paths)} images x {args.repeats} repeats...")
+            report["pipelines"][pipeline] = benchmark_pipeline(
+                pipeline, paths, models, args.repeats, args.warm_up_images, None if args.no_crop_io else crops_root
+            )
+    # Process-wide: a per-pipeline value would include the peak of the pipelines run before it
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    print(json.dumps(report, indent=4))
+    for pipeline, result in report["pipelines"].items():
+        print(f"\nPipeline {pipeline}: {result['images_per_second']} images/s, {result['vlm_calls_per_image']} VLM calls/image")
+        print("| Stage | Wall (ms/image) | CPU (ms/image) |")
+        print("|:------|----------------:|---------------:|")
+        for stage, stats in result["stages"].items():
+            print(f"| {stage} | {stats['wall_ms_per_image']} | {stats['cpu_ms_per_image']} |")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            rows = compare(report, json.load(f), args.tolerance)
+        regressions = [row for row in rows if row[4]]
+        print(f"\nCompared with {args.baseline}:")
+        for metric, old, new, change, regression in rows:
+            print(f"{'REGRESSION ' if regression else '           '}{metric}: {old} -> {new} ({change:+.1%})")
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}.")
+            if args.fail_on_regression:
+                sys.exit(1)
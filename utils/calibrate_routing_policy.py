@@ -0,0 +1,68 @@
+"""
+Calibrates the Pipeline 2 routing policy (per-attribute tagger confidence thresholds)
+on the annotated dataset written by utils/bucket_attribute_annotator.py:
+
+    python -m utils.calibrate_routing_policy --annotations tags/annotated_output.json --output routing_policy.json
+
+For every attribute, the tagger's best bucket candidate is compared with the annotated
+tags, and the lowest threshold whose tagger-only answers reach --target-precision is kept.
+src/pipeline2.py picks up routing_policy.json automatically.
+"""
+import argparse
+import json
+import os
+
+from src.attributes import ATTRIBUTE_QUESTIONS
+from src.deepdanbooru_tagger import DanbooruTagger
+from src.routing_policy import RoutingPolicy, bucket_for
+
+
+def _normalize(tag):
+    return tag.replace("_", " ").strip().lower()
+
+
+def collect_samples(annotations, tagger, batch_size=32, limit=None):
+    """Per attribute, (best candidate score, candidate is annotated) over the annotated images."""
+    paths = [path for path in annotations if os.path.exists(path)]
+    if len(paths) < len(annotations):
+        print(f"Warning: {len(annotations) - len(paths)} annotated images not found, skipping them.")
+    if limit:
+        paths = paths[:limit]
+
+    samples = {attribute: [] for attribute in ATTRIBUTE_QUESTIONS if bucket_for(attribute) in tagger.tag_buckets}
+    for start in range(0, len(paths), batch_size):
+        chunk = paths[start:start + batch_size]
+        for path, probs in zip(chunk, tagger.predict_probs_batch(chunk, batch_size=batch_size)):
+            best_candidates = tagger.find_best_candidates(probs)
+            labels = annotations[path]["attributes"]
+            for attribute in samples:
+                bucket = bucket_for(attribute)
+                if not labels.get(bucket) or bucket not in best_candidates:
+                    continue
+                best = best_candidates[bucket]
+                is_correct = _normalize(best["tag"]) in {_normalize(tag) for tag in labels[bucket]}
+                samples[attribute].append((best["score"], is_correct))
+        print(f"Tagged {min(start + batch_size, len(paths))}/{len(paths)} images")
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--annotations", default="tags/annotated_output.json", help="Output of bucket_attribute_annotator.py")
+    parser.add_argument("--output", default="routing_policy.json", help="Where to write the policy")
+    parser.add_argument("--target-precision", type=float, default=0.9, help="Required accuracy of tagger-only answers")
+    parser.add_argument("--min-support", type=int, default=20, help="Fewest images above a threshold for it to count")
+    parser.add_argument("--backend", default="keras", help="Tagger backend (calibrate with the one you serve)")
+    parser.add_argument("--limit", type=int, default=None, help="Use only the first N annotated images")
+    args = parser.parse_args()
+
+    with open(args.annotations, "r", encoding="utf-8") as f:
+        annotations = json.load(f)
+
+    tagger = DanbooruTagger(backend=args.backend)
+    samples = collect_samples(annotations, tagger, limit=args.limit)
+    policy, report = RoutingPolicy.calibrate(samples, target_precision=args.target_precision, min_support=args.min_support)
+    policy.save(args.output)
+
+    print(json.dumps(report, indent=4))
+    print(f"Saved routing policy to {args.output}")
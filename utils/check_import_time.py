@@ -0,0 +1,112 @@
+"""
+Checks that the pipeline, runner and cache modules import fast and without heavy frameworks:
+
+    python -m utils.check_import_time --budget 1.0
+
+Every module is imported in a fresh interpreter. The check fails (exit code 1) when an
+import takes longer than --budget seconds, or when it pulls in a framework that only
+model construction should load (torch, TensorFlow, LAVIS, ...). Models themselves are
+built on first use through src/model_registry.py.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules that must stay cheap to import (CLIs, workers and apps import them at startup)
+LIGHT_MODULES = [
+    "src.attributes",
+    "src.result_cache",
+    "src.crop_index",
+    "src.model_store",
+    "src.instrumentation",
+    "src.routing_policy",
+    "src.micro_batching",
+    "src.model_registry",
+    "src.char_detection",
+    "src.deepdanbooru_tagger",
+    "src.captioning",
+    "src.pipeline",
+    "src.pipeline2",
+    "src.staged_pipeline",
+    "src.batch_runner",
+    "src.video_pipeline",
+]
+
+# Frameworks loaded only when a model is built
+HEAVY_MODULES = [
+    "torch",
+    "torchvision",
+    "tensorflow",
+    "deepdanbooru",
+    "lavis",
+    "transformers",
+    "imgutils",
+    "onnxruntime",
+    "huggingface_hub",
+]
+
+_PROBE = """
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start_time
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure(module, repeat=3):
+    """Best import time of `module` over `repeat` fresh interpreters, and the heavy modules it loaded."""
+    best = None
+    for _ in range(repeat):
+        probe = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            capture_output=True,
+            text=True,
+        )
+        if probe.returncode != 0:
+            return {"module": module, "error": probe.stderr.strip().splitlines()[-1]}
+        result = json.loads(probe.stdout.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return {"module": module, "seconds": round(best["seconds"], 3), "heavy": best["heavy"]}
+
+
+def check(modules, budget, repeat=3):
+    """Measures every module; returns (results, failure messages)."""
+    results, failures = [], []
+    for module in modules:
+        result = measure(module, repeat)
+        results.append(result)
+        if "error" in result:
+            failures.append(f"{module}: import failed ({result['error']})")
+            continue
+        if result["seconds"] > budget:
+            failures.append(f"{module}: {result['seconds']}s exceeds the {budget}s budget")
+        if result["heavy"]:
+            failures.append(f"{module}: imports {', '.join(result['heavy'])} at module level")
+    return results, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=LIGHT_MODULES, help="Modules to check (default: all light modules)")
+    parser.add_argument("--budget", type=float, default=1.0, help="Longest allowed import time per module, in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per module (the best time counts)")
+    args = parser.parse_args()
+
+    results, failures = check(args.modules, args.budget, args.repeat)
+    for result in results:
+        if "error" in result:
+            print(f"{result['module']:<28} error: {result['error']}")
+        else:
+            heavy = f"  heavy: {', '.join(result['heavy'])}" if result["heavy"] else ""
+            print(f"{result['module']:<28} {result['seconds']:.3f}s{heavy}")
+
+    if failures:
+        print("\nImport-time check failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"\nAll {len(results)} modules import within {args.budget}s without heavy frameworks.")
@@ -0,0 +1,143 @@
+"""
+Accuracy-vs-latency comparison of the int8 dynamic-quantized BLIP-2 against full precision,
+on testing/test_images and the answers recorded in testing/testing_pipe1.txt / testing_pipe2.txt:
+
+    python -m utils.compare_quantization --pipeline 1 --variants fp32 int8 int8-vit --output quantization_pipe1.json
+
+For every variant, each image is run through the pipeline. The report gives the mean time
+per image, the agreement of the answers with the recorded reference, and the agreement
+with the fp32 run when fp32 is among the variants. The last one isolates the effect of
+quantization from other pipeline changes since the reference was recorded.
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from src.model_registry import get_cropper, get_extractor, get_tagger
+
+# Variant name -> extra CharacterAttributeExtractor arguments
+VARIANTS = {
+    "fp32": {},
+    "int8": {"quantize": "int8"},
+    "int8-vit": {"quantize": "int8", "quantize_vision": True},
+}
+
+
+def parse_reference(path):
+    """Parses a testing_pipe*.txt file into {image name: {"characters", "seconds", "acc"}}."""
+    with open(path, "r", encoding="utf-8") as f:
+        blocks = re.split(r"^input - ", f.read(), flags=re.MULTILINE)[1:]
+
+    reference = {}
+    for block in blocks:
+        name = block.splitlines()[0].strip()
+        output = re.search(r"output - \s*\n(.*?)\ntime - ", block, flags=re.DOTALL)
+        seconds = re.search(r"time - ([\d.]+) seconds", block)
+        acc = re.search(r"acc - (\S+)", block)
+        reference[name] = {
+            "characters": json.loads(output.group(1)) if output else {},
+            "seconds": float(seconds.group(1)) if seconds else None,
+            "acc": acc.group(1) if acc else None,
+        }
+    return reference
+
+
+def run_variant(pipeline, image_paths, model_name, model_type, extractor_kwargs):
+    """Runs every image through the pipeline with one extractor variant; returns {name: (characters, seconds)}."""
+    cropper = get_cropper()
+    extractor = get_extractor(model_name, model_type, **extractor_kwargs)
+    if pipeline == "2":
+        from src.pipeline2 import process_characters_batch
+        tagger = get_tagger()
+
+    results = {}
+    for path in image_paths:
+        start_time = time.time()
+        crops = cropper.detect_crops(path, "cropped_persons")
+        if pipeline == "1":
+            attributes = extractor.extract_attributes_batch(crops) if crops else []
+        else:
+            attributes = process_characters_batch(crops, tagger, extractor)
+        results[os.path.basename(path)] = (
+            {crop.key: attrs for crop, attrs in zip(crops, attributes)},
+            time.time() - start_time,
+        )
+        print(f"{os.path.basename(path)}: {results[os.path.basename(path)][1]:.2f} seconds")
+    return results
+
+
+def agreement(characters, reference_characters):
+    """(matching answers, compared answers) over the characters and attributes both runs have."""
+    matches = total = 0
+    for key, attributes in characters.items():
+        expected = reference_characters.get(key, {})
+        for attribute, value in attributes.items():
+            if attribute in expected:
+                total += 1
+                matches += int(str(value).strip().lower() == str(expected[attribute]).strip().lower())
+    return matches, total
+
+
+def summarize(results, reference):
+    matches = total = 0
+    for name, (characters, _) in results.items():
+        if name in reference:
+            m, t = agreement(characters, reference[name]["characters"])
+            matches, total = matches + m, total + t
+    seconds = [elapsed for _, elapsed in results.values()]
+    return {
+        "images": len(results),
+        "mean_seconds": round(sum(seconds) / max(len(seconds), 1), 3),
+        "agreement": round(matches / total, 4) if total else None,
+        "compared_answers": total,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pipeline", choices=["1", "2"], default="1")
+    parser.add_argument("--images", default="testing/test_images")
+    parser.add_argument("--reference", default=None, help="Default: testing/testing_pipe<pipeline>.txt")
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=["fp32", "int8"])
+    parser.add_argument("--model-name", default="blip2_t5")
+    parser.add_argument("--model-type", default="pretrain_flant5xl")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    reference = parse_reference(args.reference or f"testing/testing_pipe{args.pipeline}.txt")
+    image_paths = [os.path.join(args.images, name) for name in sorted(reference, key=lambda n: int(re.sub(r"\D", "", n) or 0))]
+    reference_seconds = [entry["seconds"] for entry in reference.values() if entry["seconds"] is not None]
+
+    report = {
+        "pipeline": args.pipeline,
+        "model": f"{args.model_name}/{args.model_type}",
+        "reference": {
+            "images": len(reference),
+            "mean_seconds": round(sum(reference_seconds) / max(len(reference_seconds), 1), 3),
+        },
+        "variants": {},
+    }
+    runs = {}
+    for variant in args.variants:
+        print(f"Running variant {variant}...")
+        runs[variant] = run_variant(args.pipeline, image_paths, args.model_name, args.model_type, VARIANTS[variant])
+        report["variants"][variant] = summarize(runs[variant], reference)
+
+    if "fp32" in runs:
+        # Same code, same crops: isolates the effect of quantization
+        fp32_reference = {name: {"characters": characters} for name, (characters, _) in runs["fp32"].items()}
+        for variant in runs:
+            if variant != "fp32":
+                report["variants"][variant]["agreement_with_fp32"] = summarize(runs[variant], fp32_reference)["agreement"]
+
+    print(json.dumps(report, indent=4))
+    print("\n| Variant | Mean time (s) | Agreement with reference | Agreement with fp32 |")
+    print("|:--------|--------------:|-------------------------:|--------------------:|")
+    for variant, stats in report["variants"].items():
+        print(f"| {variant} | {stats['mean_seconds']} | {stats['agreement']} | {stats.get('agreement_with_fp32', '-')} |")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
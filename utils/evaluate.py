@@ -0,0 +1,202 @@
+"""
+Accuracy and throughput of a pipeline configuration on the annotated dataset (utils/bucket_attribute_annotator.py):
+
+    python -m utils.evaluate --pipeline 2 --workers 4 --sample 500 --output eval_pipe2.json
+    python -m utils.evaluate --pipeline 2 --workers 4 --sample 500 --config '{"extractor": {"answer_mode": "score"}}'
+
+The labeled images run through the pipeline on a process pool (src/parallel_runner.py).
+Records are appended to --records, so an interrupted run resumes. By default every
+configuration gets its own records file, named by a hash of its settings (routing policy
+contents included), so a run never resumes from another configuration. Every annotated attribute bucket is then scored. An image counts as correct
+when one of its characters answers with one of the annotated tags: "blonde" matches
+"blonde_hair", and "female" matches "1girl". The report puts accuracy (overall and per
+attribute) next to images/sec and VLM calls per image, one operating point per run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+from src.attributes import ATTRIBUTE_QUESTIONS
+from src.routing_policy import bucket_for
+
+# Danbooru tags whose answer is not spelled out in the tag itself
+TAG_ALIASES = {
+    "1girl": {"female", "girl", "woman"},
+    "1boy": {"male", "boy", "man"},
+    "old man": {"elderly", "old", "male"},
+    "old woman": {"elderly", "old", "female"},
+    "child": {"child", "kid"},
+}
+# Words that name the attribute rather than answer it ("hair" alone says nothing)
+GENERIC_WORDS = {"hair", "eyes", "eye", "color", "colour"}
+NON_ANSWERS = {"", "unknown", "none", "n/a"}
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", str(text).replace("_", " ")).strip().lower()
+
+
+def matches(answer, tags):
+    """Whether a pipeline answer (possibly "tag, tag, ...") names one of the annotated tags."""
+    for piece in (_normalize(part) for part in str(answer).split(",")):
+        if piece in NON_ANSWERS:
+            continue
+        words = set(piece.split())
+        for tag in map(_normalize, tags):
+            if piece == tag or piece in TAG_ALIASES.get(tag, ()):
+                return True
+            if words - GENERIC_WORDS and words <= set(tag.split()):
+                return True
+    return False
+
+
+def answer_keys(bucket):
+    """Keys under which the pipelines answer a bucket: its tagger name and its VLM question(s)."""
+    return [bucket] + [question for question in ATTRIBUTE_QUESTIONS if bucket_for(question) == bucket and question != bucket]
+
+
+def character_answers(character, bucket):
+    """A character's answers for a bucket: the VLM's where it was asked, else the tagger's."""
+    bucket_key, *question_keys = answer_keys(bucket)
+    answers = [character[key] for key in question_keys if key in character]
+    if not answers and bucket_key in character:
+        answers = [character[bucket_key]]
+    return answers
+
+
+def select_images(annotations, sample=None, limit=None, seed=0):
+    """Annotated images that exist and have at least one label, optionally a seeded random sample."""
+    paths = sorted(
+        path for path, entry in annotations.items()
+        if os.path.exists(path) and any(entry["attributes"].values())
+    )
+    if sample and sample < len(paths):
+        paths = sorted(random.Random(seed).sample(paths, sample))
+    return paths[:limit] if limit else paths
+
+
+def score(records, annotations):
+    """Per-attribute and overall accuracy of the records against the annotations."""
+    per_attribute = {}
+    for record in records:
+        labels = annotations[record["input"]]["attributes"]
+        characters = list(record.get("characters", {}).values())
+        for bucket, tags in labels.items():
+            if not tags:
+                continue
+            answers = [answer for character in characters for answer in character_answers(character, bucket)]
+            stats = per_attribute.setdefault(bucket, {"samples": 0, "answered": 0, "correct": 0})
+            stats["samples"] += 1
+            stats["answered"] += int(any(_normalize(answer) not in NON_ANSWERS for answer in answers))
+            stats["correct"] += int(any(matches(answer, tags) for answer in answers))
+
+    for stats in per_attribute.values():
+        stats["accuracy"] = round(stats["correct"] / stats["samples"], 4)
+        stats["coverage"] = round(stats["answered"] / stats["samples"], 4)
+    samples = sum(stats["samples"] for stats in per_attribute.values())
+    correct = sum(stats["correct"] for stats in per_attribute.values())
+    return {
+        "accuracy": round(correct / samples, 4) if samples else None,
+        "macro_accuracy": round(sum(s["accuracy"] for s in per_attribute.values()) / len(per_attribute), 4) if per_attribute else None,
+        "labels": samples,
+        "attributes": dict(sorted(per_attribute.items())),
+    }
+
+
+def read_records(path, inputs):
+    """Latest record of every input in a batch-runner JSONL file."""
+    records = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                if record.get("input") in inputs:
+                    records[record["input"]] = record
+    return records
+
+
+def default_records_path(pipeline, config):
+    """Records file of one configuration: its name hashes the settings and the routing policy contents."""
+    from src.pipeline2 import ROUTING_POLICY_PATH
+
+    policy_path = config.get("routing_policy_path") or (ROUTING_POLICY_PATH if pipeline == "2" else None)
+    policy = None
+    if policy_path and os.path.exists(policy_path):
+        with open(policy_path, "rb") as f:
+            policy = hashlib.sha256(f.read()).hexdigest()
+    settings = json.dumps([pipeline, config, policy], sort_keys=True)
+    return f"eval_pipe{pipeline}_{hashlib.sha256(settings.encode()).hexdigest()[:12]}_records.jsonl"
+
+
+def run(paths, pipeline, records_path, workers, threads_per_worker, config):
+    """Runs the images through the pipeline (resuming `records_path`); returns images/sec of this run."""
+    from src.batch_runner import batched_records, load_pipeline, run_batch
+
+    if workers:
+        from src.parallel_runner import ParallelRunner
+
+        runner = ParallelRunner(pipeline, num_workers=workers, threads_per_worker=threads_per_worker, config=config)
+        reporter = run_batch(None, paths, records_path, process_records=runner.process_records)
+    else:
+        load_pipeline(pipeline, config=config)
+        reporter = run_batch(None, paths, records_path, process_records=batched_records(pipeline))
+    elapsed = time.time() - reporter.start_time
+    return round(reporter.processed / elapsed, 3) if reporter.processed else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--annotations", default="tags/annotated_output.json", help="Output of bucket_attribute_annotator.py")
+    parser.add_argument("--pipeline", choices=["1", "2"], default="2")
+    parser.add_argument("--config", default=None, help='Pipeline settings as JSON, e.g. \'{"extractor": {"answer_mode": "score"}}\'')
+    parser.add_argument("--routing-policy", default=None, help="Pipeline 2 routing policy JSON to evaluate")
+    parser.add_argument("--sample", type=int, default=None, help="Random subset of N labeled images")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of --sample (same seed, same subset)")
+    parser.add_argument("--limit", type=int, default=None, help="Use only the first N selected images")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes (0 = run in-process)")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--records", default=None, help="JSONL of raw records (default: eval_pipe<pipeline>_<settings hash>_records.jsonl)")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    config = json.loads(args.config) if args.config else {}
+    if args.routing_policy:
+        config["routing_policy_path"] = args.routing_policy
+    records_path = args.records or default_records_path(args.pipeline, config)
+
+    with open(args.annotations, "r", encoding="utf-8") as f:
+        annotations = json.load(f)
+    paths = select_images(annotations, sample=args.sample, limit=args.limit, seed=args.seed)
+    print(f"Evaluating pipeline {args.pipeline} on {len(paths)} labeled images (records: {records_path})...")
+
+    images_per_second = run(paths, args.pipeline, records_path, args.workers, args.threads_per_worker, config or None)
+    records = read_records(records_path, set(paths))
+    ok = [record for record in records.values() if "error" not in record]
+    vlm_counts = [record["vlm_calls"] for record in ok if "vlm_calls" in record]
+
+    report = {
+        "pipeline": args.pipeline,
+        "config": config,
+        "images": len(records),
+        "errors": len(records) - len(ok),
+        "images_per_second": images_per_second,
+        "mean_seconds_per_image": round(sum(r["seconds"] for r in ok) / len(ok), 3) if ok else None,
+        "characters_per_image": round(sum(r["num_characters"] for r in ok) / len(ok), 2) if ok else None,
+        "vlm_calls_per_image": round(sum(vlm_counts) / len(vlm_counts), 2) if vlm_counts else None,
+        **score(ok, annotations),
+    }
+
+    print(json.dumps(report, indent=4))
+    print("\n| Pipeline | Config | Accuracy | Images/s | VLM calls/image |")
+    print("|:---------|:-------|---------:|---------:|----------------:|")
+    print(f"| {args.pipeline} | {json.dumps(config) if config else 'default'} | {report['accuracy']} | "
+          f"{report['images_per_second']} | {report['vlm_calls_per_image']} |")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,36 @@
+"""
+Exports the DeepDanbooru Keras model to ONNX for the "onnx" tagger backend.
+
+Needs TensorFlow and tf2onnx (`pip install tf2onnx`) on the machine doing the export
+only; the serving side then runs on ONNX Runtime without TensorFlow:
+
+    python utils/export_deepdanbooru_onnx.py --output model-resnet_custom_v3.onnx
+    tagger = DanbooruTagger(backend="onnx", model_path="model-resnet_custom_v3.onnx")
+"""
+import argparse
+
+import huggingface_hub
+import tensorflow as tf
+import tf2onnx
+
+MODEL_REPO = "public-data/DeepDanbooru"
+MODEL_FILENAME = "model-resnet_custom_v3.h5"
+
+
+def export(output_path, opset=13):
+    model = tf.keras.models.load_model(huggingface_hub.hf_hub_download(MODEL_REPO, MODEL_FILENAME))
+    _, height, width, channels = model.input_shape
+
+    # Keep the batch dimension dynamic so the tagger can send batches of any size
+    input_signature = [tf.TensorSpec((None, height, width, channels), tf.float32, name="input")]
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=opset, output_path=output_path)
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="model-resnet_custom_v3.onnx", help="Where to write the .onnx model")
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+    args = parser.parse_args()
+
+    print(f"Exported {export(args.output, args.opset)}")
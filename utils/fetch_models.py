@@ -0,0 +1,144 @@
+"""
+Fills the local model store (src/model_store.py) on a machine with network, for nodes that run offline:
+
+    python -m utils.fetch_models --store models --taggers keras wd-onnx --vlm blip2_t5/pretrain_flant5xl --detector
+    rsync -a models/ node:/srv/models/
+    MODEL_STORE_DIR=/srv/models MODEL_STORE_OFFLINE=1 python -m src.batch_runner ...
+
+Tagger files are stored per Hugging Face commit. Each BLIP-2 variant is stored as
+safetensors in three parts, so serving nodes never unpickle weights: its checkpoint
+(Q-Former / projection) and its frozen ViT are memory-mapped, and its language model is
+saved with its tokenizer as a directory that `from_pretrained` reads model.safetensors
+from. --list and --verify inspect an existing store.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from src.model_store import ModelStore, convert_to_safetensors, save_safetensors, set_store
+
+# Tagger backend -> (Hugging Face repo, files)
+TAGGER_FILES = {
+    "keras": ("public-data/DeepDanbooru", ["model-resnet_custom_v3.h5", "tags.txt"]),
+    "onnx": ("public-data/DeepDanbooru", ["tags.txt"]),
+    "wd-onnx": ("SmilingWolf/wd-swinv2-tagger-v3", ["model.onnx", "selected_tags.csv"]),
+}
+
+
+def fetch_tagger(store, backend):
+    repo, filenames = TAGGER_FILES[backend]
+    for filename in filenames:
+        print(f"{repo}/{filename} -> {store.hf_file(repo, filename)}")
+
+
+def save_language_model(model, tokenizer, directory):
+    """
+    Saves a Hugging Face language model as a `from_pretrained` directory with a single
+    model.safetensors. Tied weights are stored once: `from_pretrained` ties them back.
+
+    Returns:
+        Dict[str, str]: File name -> path of every saved file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    model.config.save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+    state_dict, seen = {}, set()
+    for key, tensor in model.state_dict().items():
+        alias = (tensor.data_ptr(), tuple(tensor.shape))
+        if alias not in seen:
+            seen.add(alias)
+            state_dict[key] = tensor
+    save_safetensors(state_dict, os.path.join(directory, "model.safetensors"))
+    return {filename: os.path.join(directory, filename) for filename in os.listdir(directory)}
+
+
+def fetch_vlm(store, model_name, model_type, version):
+    """
+    Stores a BLIP-2 variant as safetensors: its LAVIS checkpoint, its frozen ViT (as LAVIS
+    leaves it for the configured precision) and its language model with the tokenizer.
+    """
+    from lavis.common.dist_utils import download_cached_file
+    from lavis.models import registry as lavis_registry
+    from omegaconf import OmegaConf
+
+    model_cls = lavis_registry.get_model_class(model_name)
+    config = OmegaConf.load(model_cls.default_config_path(model_type))
+    url = config.model.get("pretrained")
+    checkpoint = download_cached_file(url, check_hash=False, progress=True)
+
+    filename = f"{model_name}-{model_type}.safetensors"
+    with tempfile.TemporaryDirectory(dir=store.root) as tmp_dir:
+        converted = convert_to_safetensors(checkpoint, os.path.join(tmp_dir, filename))
+        store.install("blip2", version, {filename: converted}, source=url)
+    print(f"{url} -> {store.path('blip2', filename)}")
+
+    # Built once the LAVIS way (downloads the ViT and the language model), then saved part by part
+    model = model_cls.from_config(config.model)
+    with tempfile.TemporaryDirectory(dir=store.root) as tmp_dir:
+        if config.model.get("vit_model", "eva_clip_g") == "eva_clip_g":
+            vit_file = f"eva_vit_g-{config.model.get('vit_precision', 'fp16')}.safetensors"
+            save_safetensors(model.visual_encoder.state_dict(), os.path.join(tmp_dir, vit_file))
+            store.install("blip2", version, {vit_file: os.path.join(tmp_dir, vit_file)}, source="lavis:eva_vit_g.pth")
+            print(f"eva_vit_g -> {store.path('blip2', vit_file)}")
+
+        llm_key = "t5_model" if "t5_model" in config.model else "opt_model"
+        llm = model.t5_model if llm_key == "t5_model" else model.opt_model
+        tokenizer = model.t5_tokenizer if llm_key == "t5_model" else model.opt_tokenizer
+        files = save_language_model(llm, tokenizer, os.path.join(tmp_dir, "llm"))
+        store.install(config.model[llm_key], version, files, source=f"hf://{config.model[llm_key]}")
+        print(f"{config.model[llm_key]} -> {os.path.dirname(store.path(config.model[llm_key], 'model.safetensors'))}")
+    del model
+
+    # Loads it back from the store, as a serving node would
+    from src.vlm_blip3 import CharacterAttributeExtractor
+    CharacterAttributeExtractor(model_name=model_name, model_type=model_type, device="cpu")
+
+
+def fetch_detector():
+    from src.model_registry import get_cropper, registry
+
+    get_cropper()
+    registry.warm_up(["cropper"])  # imgutils downloads its detector on first use
+
+
+def print_status(store, verify=False):
+    for name, entry in store.status().items():
+        line = f"{name:<40} current={entry['current']}  versions={', '.join(entry['versions'])}"
+        if verify:
+            bad = store.verify(name)
+            line += f"  {'CORRUPT: ' + ', '.join(bad) if bad else 'ok'}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--store", default=os.environ.get("MODEL_STORE_DIR", "models"), help="Store directory (default: $MODEL_STORE_DIR or models)")
+    parser.add_argument("--taggers", nargs="*", choices=list(TAGGER_FILES), default=[], help="Tagger backends to fetch")
+    parser.add_argument("--onnx", default=None, help="Exported DeepDanbooru .onnx model to install (utils/export_deepdanbooru_onnx.py)")
+    parser.add_argument("--vlm", nargs="*", default=[], help="BLIP-2 variants as model_name/model_type")
+    parser.add_argument("--detector", action="store_true", help="Fetch the imgutils person detector")
+    parser.add_argument("--captioning", action="store_true", help="Fetch the BLIP captioning model (src/captioning.py)")
+    parser.add_argument("--version", default=time.strftime("%Y%m%d"), help="Version label of converted checkpoints")
+    parser.add_argument("--list", action="store_true", help="Show the stored models")
+    parser.add_argument("--verify", action="store_true", help="Show the stored models and check their checksums")
+    args = parser.parse_args()
+
+    # First: the Hugging Face / torch caches must point into the store before those libraries load
+    store = set_store(ModelStore(args.store, offline=False))
+
+    for backend in args.taggers:
+        fetch_tagger(store, backend)
+    if args.onnx:
+        store.install("deepdanbooru-onnx", args.version, {os.path.basename(args.onnx): args.onnx}, source=args.onnx)
+    for variant in args.vlm:
+        model_name, model_type = variant.split("/", 1)
+        fetch_vlm(store, model_name, model_type, args.version)
+    if args.detector:
+        fetch_detector()
+    if args.captioning:
+        from src.captioning import _load_model
+        _load_model()
+
+    if args.list or args.verify:
+        print_status(store, verify=args.verify)